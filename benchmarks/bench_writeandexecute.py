@@ -0,0 +1,173 @@
+# coding: utf-8
+"""Benchmarks for `%%writeandexecute`.
+
+The classes follow the conventions of airspeed velocity (asv), but can also
+be run without it by ``python benchmarks/run.py``.
+"""
+from __future__ import absolute_import
+
+import io
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+from ipyext.writeandexecute import WriteAndExecuteMagics
+
+from .common import KB, MB, ipython_shell, quiet
+
+
+def make_target(path, size, blocks):
+    """Writes a target file of about `size` bytes with `blocks` code blocks.
+
+    The block in the middle of the file is a small one with the identifier
+    ``target``, all others are filler.
+    """
+    per_block = max(1, (size // blocks) // 42)
+    body = u"x = 1  # some filler to make the file big\n" * per_block
+    with io.open(path, 'w', encoding='utf-8') as f:
+        f.write(u"# -*- coding: utf-8 -*-\n\n\n")
+        for i in range(blocks):
+            if i == blocks // 2:
+                f.write(u"# -- ==target== --\nx = 0\n\n# -- ==target== --\n\n\n")
+            f.write(u"# -- ==block%s== --\n%s\n# -- ==block%s== --\n\n\n" % (i, body, i))
+
+
+class SaveToFile(object):
+    """`_save_to_file` for different file sizes, numbers of code blocks and
+    kinds of changes.
+
+    ``replace`` changes a code block in the middle of the file, ``noop``
+    writes an unchanged block and ``rescan`` replaces a block in a file
+    which was changed by someone else (so the file has to be rescanned).
+    Adding a block is measured by `AppendToFile`.
+    """
+    params = [[1 * KB, 1 * MB, 10 * MB, 50 * MB],
+              [1, 100, 5000],
+              ['replace', 'noop', 'rescan']]
+    param_names = ['size', 'blocks', 'change']
+    timeout = 300
+
+    def setup(self, size, blocks, *args):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'functions.py')
+        make_target(self.path, size, blocks)
+        self.magics = WriteAndExecuteMagics()
+        self.identifier = 'target'
+        # build the index, as it would be in a running session
+        self.magics._save_to_file(self.path, self.identifier, u'x = 0\n')
+        assert os.path.getsize(self.path) >= size
+        self.counter = 0
+
+    def teardown(self, *args):
+        shutil.rmtree(self.tmpdir)
+
+    def time_save_to_file(self, size, blocks, change):
+        self.counter += 1
+        if change == 'noop':
+            self.magics._save_to_file(self.path, self.identifier, u'x = 0\n')
+        else:
+            if change == 'rescan':
+                self.magics._block_indexes.clear()
+            self.magics._save_to_file(self.path, self.identifier,
+                                      u'x = %s\n' % self.counter)
+
+
+class AppendToFile(SaveToFile):
+    """`_save_to_file` with a new code block.
+
+    Every call makes the file bigger, so each sample is a single call on a
+    new file of the given size and number of blocks.
+    """
+    params = [[1 * KB, 1 * MB, 10 * MB, 50 * MB],
+              [1, 100, 5000]]
+    param_names = ['size', 'blocks']
+    number = 1
+    repeat = 10
+
+    def time_save_to_file(self, size, blocks):
+        self.magics._save_to_file(self.path, 'new', u'x = 0\n')
+
+
+def _write_blocks(path, writer, writes, ready, start):
+    magics = WriteAndExecuteMagics()
+    ready.put(writer)
+    start.wait()
+    for i in range(writes):
+        magics._save_to_file(path, 'w%s_%s' % (writer, i % 10), u'x = %s\n' % i)
+
+
+class ConcurrentWriters(object):
+    """The same number of `_save_to_file` calls (160, each replacing or
+    adding a code block) from 1 to 16 processes writing into the same file.
+
+    With enough cores, the time should stay close to the one of a single
+    writer: the processes only serialize the check and the swap of the
+    file.
+    """
+    params = [1, 2, 4, 16]
+    param_names = ['writers']
+    number = 1
+    timeout = 300
+    total_writes = 160
+
+    def setup(self, writers):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'functions.py')
+        make_target(self.path, 100 * KB, 100)
+        ready = multiprocessing.Queue()
+        self.start = multiprocessing.Event()
+        self.processes = [multiprocessing.Process(
+            target=_write_blocks,
+            args=(self.path, n, self.total_writes // writers, ready, self.start))
+            for n in range(writers)]
+        for process in self.processes:
+            process.start()
+        # start timing once all of them are ready to write
+        for process in self.processes:
+            ready.get()
+
+    def teardown(self, writers):
+        self.start.set()
+        for process in self.processes:
+            process.join()
+        shutil.rmtree(self.tmpdir)
+
+    def time_writes(self, writers):
+        self.start.set()
+        for process in self.processes:
+            process.join()
+            assert process.exitcode == 0
+
+
+class MagicDispatch(object):
+    """Overhead of running cells with our magics in an in-process shell,
+    compared to a plain cell."""
+    params = ['plain', 'inactive', 'writeandexecute', 'writeandexecute_changed']
+    param_names = ['cell']
+
+    def setup(self, cell):
+        self.shell = ipython_shell()
+        self.tmpdir = tempfile.mkdtemp()
+        self.target = os.path.join(self.tmpdir, 'functions')
+        self.counter = 0
+        with quiet():
+            self.shell.run_cell("%load_ext ipyext.inactive")
+            self.shell.run_cell("%load_ext ipyext.writeandexecute")
+            self.shell.run_cell("%%writeandexecute -i block " + self.target + "\na = 0")
+
+    def teardown(self, cell):
+        shutil.rmtree(self.tmpdir)
+
+    def time_run_cell(self, cell):
+        self.counter += 1
+        with quiet():
+            if cell == 'plain':
+                self.shell.run_cell("a = 0")
+            elif cell == 'inactive':
+                self.shell.run_cell("%%inactive\na = 0")
+            elif cell == 'writeandexecute':
+                self.shell.run_cell("%%writeandexecute -i block " + self.target + "\na = 0")
+            else:
+                self.shell.run_cell("%%writeandexecute -i block " + self.target +
+                                    "\na = %s" % self.counter)
@@ -0,0 +1,21 @@
+# coding: utf-8
+"""Helpers for the benchmarks."""
+from __future__ import absolute_import
+
+from contextlib import contextmanager
+
+KB = 1024
+MB = 1024 * KB
+
+
+def ipython_shell():
+    from IPython.core.interactiveshell import InteractiveShell
+    return InteractiveShell.instance()
+
+
+@contextmanager
+def quiet():
+    """Swallows everything the code prints."""
+    from IPython.utils.io import capture_output
+    with capture_output():
+        yield
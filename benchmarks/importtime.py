@@ -0,0 +1,144 @@
+# coding: utf-8
+"""
+Checks the import and load time of ipyext against a budget
+
+Usage::
+
+    python benchmarks/importtime.py [--budget budget.json] [--repeat 5]
+                                    [-o results.json]
+
+For ``ipyext`` and each of its modules, the cumulative import time (as
+reported by ``python -X importtime``) is measured in a fresh interpreter,
+which already imported IPython, as a kernel has. Also measured is the time
+to ``load_ipython_extension`` (including the import) into a fresh
+``InteractiveShell``, for ``%load_ext ipyext`` and each single extension.
+
+Every measurement runs in ``--repeat`` new processes and the median is
+compared against the budget (in milliseconds, ``import_budget.json`` next
+to this script). The script exits with 1 if a budget is exceeded. The
+bytecode is cached in a temporary directory and written by a first,
+unmeasured run, so compiling the modules isn't measured.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+here = os.path.dirname(os.path.abspath(__file__))
+repo_root = os.path.dirname(here)
+sys.path.insert(0, repo_root)
+
+# what a kernel has imported before it loads the extensions
+PRELOAD = ("import IPython\n"
+           "from IPython.core.interactiveshell import InteractiveShell\n")
+
+LOAD = PRELOAD + """
+import io, json, sys, time
+from importlib import import_module
+ip = InteractiveShell.instance()
+stdout, sys.stdout = sys.stdout, io.StringIO()
+start = time.time()
+import_module(%r).load_ipython_extension(ip)
+elapsed = time.time() - start
+sys.stdout = stdout
+print(json.dumps(elapsed))
+"""
+
+
+def modules():
+    """Returns ipyext and all its modules with magics."""
+    import ipyext
+    return ['ipyext'] + [module for module, classname, line, cell in ipyext._MAGICS]
+
+
+def run_python(args, env):
+    proc = subprocess.Popen([sys.executable] + args, env=env, cwd=repo_root,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode:
+        raise RuntimeError("python %s failed:\n%s" % (" ".join(args), err.decode('utf-8')))
+    return out.decode('utf-8'), err.decode('utf-8')
+
+
+def import_time(module, env):
+    """Returns the cumulative import time of `module` in seconds."""
+    out, err = run_python(['-X', 'importtime', '-c', PRELOAD + 'import ' + module], env)
+    # import time: self [us] | cumulative | imported package
+    for line in err.splitlines():
+        parts = line.split('|')
+        if len(parts) == 3 and parts[2].strip() == module:
+            return int(parts[1]) / 1e6
+    # already imported by the preload
+    return 0.0
+
+
+def load_time(module, env):
+    """Returns the time to load the extension `module` in seconds."""
+    out, err = run_python(['-c', LOAD % module], env)
+    return json.loads(out.splitlines()[-1])
+
+
+def measure(repeat):
+    """Returns name -> median time in milliseconds of all measurements."""
+    cache = tempfile.mkdtemp(prefix='ipyext-pycache-')
+    env = dict(os.environ, PYTHONPYCACHEPREFIX=cache)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    env['PYTHONPATH'] = os.pathsep.join([repo_root] + [p for p in [env.get('PYTHONPATH')] if p])
+    try:
+        measurements = []
+        for module in modules():
+            measurements.append(('import ' + module, import_time, module))
+        for module in modules():
+            measurements.append(('load ' + module, load_time, module))
+        # write the bytecode
+        for name, func, module in measurements:
+            func(module, env)
+        results = {}
+        for name, func, module in measurements:
+            times = sorted(func(module, env) for _ in range(repeat))
+            results[name] = 1000 * times[len(times) // 2]
+        return results
+    finally:
+        shutil.rmtree(cache, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check the import time of ipyext.")
+    parser.add_argument('--budget', default=os.path.join(here, 'import_budget.json'),
+                        help="JSON file with the budget in milliseconds per measurement")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="number of processes per measurement (default: 5)")
+    parser.add_argument('-o', '--output', help="write the results (in ms) to this JSON file")
+    args = parser.parse_args(argv)
+
+    with open(args.budget) as f:
+        budget = json.load(f)
+    results = measure(args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    over = []
+    width = max(len(name) for name in results)
+    print("%-*s %10s %10s" % (width, 'measurement', 'ms', 'budget'))
+    for name in sorted(results):
+        limit = budget.get(name)
+        flag = ''
+        if limit is not None and results[name] > limit:
+            over.append(name)
+            flag = '  OVER BUDGET'
+        print("%-*s %10.2f %10s%s" % (width, name, results[name],
+                                      '-' if limit is None else '%.1f' % limit, flag))
+    if over:
+        print("\n%d measurement(s) over budget: %s" % (len(over), ", ".join(over)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
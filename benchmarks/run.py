@@ -0,0 +1,169 @@
+# coding: utf-8
+"""
+Runs the benchmarks without asv and writes the results as JSON
+
+Usage::
+
+    python benchmarks/run.py [-o results.json] [-k <name filter>] [--quick]
+                             [--compare old.json [--threshold 1.2]]
+
+Each benchmark is timed for every combination of its parameters. The JSON
+file contains the best and the median time per call (in seconds). With
+``--compare`` the results are compared against an older result file and
+the script exits with 1 if a benchmark got slower than ``threshold`` times
+the old time.
+"""
+from __future__ import print_function
+
+import argparse
+import datetime
+import glob
+import importlib
+import itertools
+import json
+import os
+import platform
+import sys
+import timeit
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+# smaller parameters for --quick
+QUICK_LIMITS = {'size': 1024 * 1024, 'blocks': 100}
+
+
+def iter_benchmarks(name_filter=None):
+    """Yields ``(name, class, method name)`` of all benchmarks."""
+    for path in sorted(glob.glob(os.path.join(here, 'bench_*.py'))):
+        modname = os.path.splitext(os.path.basename(path))[0]
+        module = importlib.import_module('benchmarks.' + modname)
+        for clsname in sorted(dir(module)):
+            cls = getattr(module, clsname)
+            if not isinstance(cls, type) or cls.__module__ != module.__name__:
+                continue
+            for methname in sorted(dir(cls)):
+                if not methname.startswith('time_'):
+                    continue
+                name = '%s.%s.%s' % (modname, clsname, methname)
+                if name_filter and name_filter not in name:
+                    continue
+                yield name, cls, methname
+
+
+def iter_params(cls, quick=False):
+    """Yields dicts of parameter name -> value for all combinations."""
+    params = getattr(cls, 'params', [])
+    names = getattr(cls, 'param_names', [])
+    if params and not isinstance(params[0], list):
+        params = [params]
+    for combination in itertools.product(*params):
+        values = dict(zip(names, combination))
+        if quick and any(values.get(k, 0) > limit for k, limit in QUICK_LIMITS.items()):
+            continue
+        yield values
+
+
+def time_benchmark(cls, methname, params, repeat):
+    bench = cls()
+    args = [params[name] for name in getattr(cls, 'param_names', [])]
+    func = getattr(bench, methname)
+    timer = timeit.Timer(lambda: func(*args))
+    number = getattr(cls, 'number', 0)
+    if number:
+        # as asv does: a new setup for every sample, for benchmarks which
+        # change their data (e.g. make a file bigger with each call)
+        times = []
+        for _ in range(repeat):
+            if hasattr(bench, 'setup'):
+                bench.setup(*args)
+            try:
+                times.append(timer.timeit(number) / number)
+            finally:
+                if hasattr(bench, 'teardown'):
+                    bench.teardown(*args)
+        times.sort()
+        return {'min': times[0], 'median': times[len(times) // 2],
+                'number': number, 'repeat': repeat}
+    if hasattr(bench, 'setup'):
+        bench.setup(*args)
+    try:
+        number, _ = timer.autorange()
+        times = sorted(t / number for t in timer.repeat(repeat=repeat, number=number))
+    finally:
+        if hasattr(bench, 'teardown'):
+            bench.teardown(*args)
+    return {'min': times[0], 'median': times[len(times) // 2],
+            'number': number, 'repeat': repeat}
+
+
+def result_key(result):
+    return result['name'] + json.dumps(result['params'], sort_keys=True)
+
+
+def compare(results, old_results, threshold):
+    """Prints the ratio to the old times and returns the regressions."""
+    old = dict((result_key(r), r) for r in old_results)
+    regressions = []
+    for result in results:
+        before = old.get(result_key(result))
+        if before is None:
+            continue
+        ratio = result['min'] / before['min']
+        flag = ''
+        if ratio > threshold:
+            flag = '  REGRESSION'
+            regressions.append(result)
+        print("%-60s %6.2fx%s" % (result['name'] + ' ' + json.dumps(result['params'], sort_keys=True),
+                                 ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-o', '--output', default='benchmark_results.json',
+                        help="file to write the results to")
+    parser.add_argument('-k', dest='name_filter', default=None,
+                        help="only run benchmarks containing this string")
+    parser.add_argument('--quick', action='store_true',
+                        help="skip the big files and block counts")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--compare', default=None,
+                        help="result file of an earlier run to compare with")
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help="ratio to the old time which counts as regression")
+    args = parser.parse_args(argv)
+
+    import IPython
+    from ipyext._version import __version__
+    results = []
+    for name, cls, methname in iter_benchmarks(args.name_filter):
+        for params in iter_params(cls, quick=args.quick):
+            result = time_benchmark(cls, methname, params, args.repeat)
+            result.update(name=name, params=params)
+            results.append(result)
+            print("%-60s %10.6f s" % (name + ' ' + json.dumps(params, sort_keys=True),
+                                     result['min']))
+
+    report = {
+        'date': datetime.datetime.now().isoformat(),
+        'ipyext': __version__,
+        'ipython': IPython.__version__,
+        'python': platform.python_version(),
+        'machine': platform.platform(),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    print("Results written to %s" % args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old_results = json.load(f)['results']
+        if compare(results, old_results, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,25 +1,22 @@
+"""Formats the documentation of all magics of ipyext as rst.
+
+The magics are read from the magic classes, no IPython shell is started.
+The ``automagics`` directive of ``sphinxext/magics.py`` uses these
+functions to document the magics when Sphinx reads the page.
+"""
+import hashlib
 import os
+import sys
 
-from IPython.core.alias import Alias
-from IPython.core.interactiveshell import InteractiveShell
-from IPython.core.magic import MagicAlias
 from IPython.utils.text import dedent, indent
 
-shell = InteractiveShell.instance()
-magics = shell.magics_manager.magics
-
-# Register our own magics
-
-ipy_magics = []
-for name, func in magics['line'].items():
-    ipy_magics.append(name)
-for name, func in magics['cell'].items():
-    ipy_magics.append(name)
+here = os.path.dirname(os.path.abspath(__file__))
+# document the ipyext next to the docs, even if another one is installed
+sys.path.insert(0, os.path.dirname(here))
 
 from ipyext import all_class_magics
-shell.register_magics(*all_class_magics)
 
-    
+
 def _strip_underline(line):
     chars = set(line.strip())
     if len(chars) == 1 and ('-' in chars or '=' in chars):
@@ -35,51 +32,42 @@ def format_docstring(func):
     lines = [_strip_underline(l) for l in docstring.splitlines()]
     return "\n".join(lines)
 
-output = [
-"Line magics",
-"===========",
-"",
-]
-
 # Case insensitive sort by name
 def sortkey(s): return s[0].lower()
 
-for name, func in sorted(magics['line'].items(), key=sortkey):
-    if name in ipy_magics:
-        continue
-    if isinstance(func, Alias) or isinstance(func, MagicAlias):
-        # Aliases are magics, but shouldn't be documented here
-        # Also skip aliases to other magics
-        continue
-    output.extend([".. magic:: {}".format(name),
-                   "",
-                   format_docstring(func),
-                   ""])
+def iter_magics(kind, magic_classes=None):
+    """Yields ``(name, function)`` of all magics of `kind` ('line' or
+    'cell'), sorted by name."""
+    magics = {}
+    for cls in magic_classes or all_class_magics:
+        for name, method in cls.magics[kind].items():
+            func = getattr(cls, method)
+            if kind == 'cell' and method == cls.magics['line'].get(name):
+                # Don't redocument line magics that double as cell magics
+                continue
+            magics[name] = func
+    return sorted(magics.items(), key=sortkey)
 
-output.extend([
-"Cell magics",
-"===========",
-"",
-])
+def magic_docs(magic_classes=None):
+    """Yields ``(kind, name, rst)`` of all magics, first the line magics, then
+    the cell magics, each sorted by name."""
+    for kind in ('line', 'cell'):
+        for name, func in iter_magics(kind, magic_classes):
+            yield kind, name, format_docstring(func)
 
-for name, func in sorted(magics['cell'].items(), key=sortkey):
-    if name in ipy_magics:
-        continue
-    
-    if name == "!":
-        # Special case - don't encourage people to use %%!
-        continue
-    if func == magics['line'].get(name, 'QQQP'):
-        # Don't redocument line magics that double as cell magics
-        continue
-    if isinstance(func, MagicAlias):
-        continue
-    output.extend([".. cellmagic:: {}".format(name),
-                   "",
-                   format_docstring(func),
-                   ""])
+def doc_hash(kind, name, doc):
+    """Returns the hash of the documentation of a magic."""
+    return hashlib.sha1(("%s %s\n%s" % (kind, name, doc)).encode('utf-8')).hexdigest()
 
-here = os.path.dirname(__file__)
-dest = os.path.join(here, 'source', 'magics-generated.txt')
-with open(dest, "w") as f:
-    f.write("\n".join(output))
+def to_rst(docs):
+    """Returns the rst lines for the ``(kind, name, rst)`` of `docs`."""
+    output = []
+    for kind, title, directive in [('line', "Line magics", 'magic'),
+                                   ('cell', "Cell magics", 'cellmagic')]:
+        output.extend([title, "=" * len(title), ""])
+        for doc_kind, name, doc in docs:
+            if doc_kind == kind:
+                output.extend([".. {}:: {}".format(directive, name), ""])
+                output.extend(doc.splitlines())
+                output.append("")
+    return output
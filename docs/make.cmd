@@ -25,8 +25,6 @@ FOR %%L IN (html pickle htmlhelp latex changes linkcheck) DO (
         )
         MD build\doctrees 2>NUL
         MD build\%1 || GOTO DIR_EXIST
-        python autogen_magics.py
-        @echo "Created auto-docs for line & cell magics"
         %SPHINXBUILD% -b %1 %ALLSPHINXOPTS% build\%1
         IF NOT ERRORLEVEL 0 GOTO ERROR
         ECHO.
@@ -50,7 +48,6 @@ FOR %%L IN (html pickle htmlhelp latex changes linkcheck) DO (
 
 IF "%1" == "clean" (
     RD /s /q build dist %SRCDIR%\api\generated 2>NUL
-    del %SRCDIR%\magics-generated.txt 2>NUL
 
     IF ERRORLEVEL 0 ECHO Build environment cleaned!
     GOTO END
@@ -59,7 +56,6 @@ IF "%1" == "clean" (
 ECHO.
 ECHO Please use "make [target]" where [target] is one of:
 ECHO.
-echo    magics    to generate the magics documenatation
 ECHO    html      to make standalone HTML files
 ECHO    jsapi     to make standalone HTML files for the Javascript API
 ECHO    pickle    to make pickle files (usable by e.g. sphinx-web)
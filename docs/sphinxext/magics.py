@@ -1,7 +1,36 @@
+"""Sphinx extension for the documentation of IPython magics.
+
+Adds the ``magic`` and ``cellmagic`` object types with their ``:magic:`` and
+``:cellmagic:`` roles and the ``automagics`` directive, which documents all
+magics of a package::
+
+    .. automagics:: ipyext
+
+The magics are read from ``all_class_magics`` of the package when the page
+is read. The hash of the documentation of every magic is kept in the build
+environment, so an incremental build only reads the page again if the
+documentation of one of its magics changed.
+"""
+import os
 import re
+import sys
+from importlib import import_module
+
+from docutils import nodes
+from docutils.statemachine import StringList
 from sphinx import addnodes
 from sphinx.domains.std import StandardDomain
 from sphinx.roles import XRefRole
+from sphinx.util import logging
+from sphinx.util.docutils import SphinxDirective
+from sphinx.util.nodes import nested_parse_with_titles
+
+# the docs directory, with autogen_magics.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from autogen_magics import doc_hash, magic_docs, to_rst
+
+logger = logging.getLogger(__name__)
 
 name_re = re.compile(r"[\w_]+")
 
@@ -35,8 +64,85 @@ class CellMagicRole(LineMagicRole):
     """Cross reference role displayed with a %% prefix"""
     prefix = "%%"
 
+def magic_hashes(modname):
+    """Returns the rst of all magics of the package `modname` and a dict of
+    ``"kind name"`` -> hash of the documentation of each magic."""
+    docs = list(magic_docs(import_module(modname).all_class_magics))
+    hashes = dict(("%s %s" % (kind, name), doc_hash(kind, name, doc))
+                  for kind, name, doc in docs)
+    return to_rst(docs), hashes
+
+
+class AutoMagicsDirective(SphinxDirective):
+    """Documents all magics in ``all_class_magics`` of a package."""
+    required_arguments = 1
+    has_content = False
+
+    def run(self):
+        modname = self.arguments[0]
+        try:
+            lines, hashes = magic_hashes(modname)
+        except Exception as e:
+            logger.warning("automagics: can't document the magics of %s: %s",
+                           modname, e, location=(self.env.docname, self.lineno))
+            return []
+        self.env.automagics_hashes.setdefault(self.env.docname, {})[modname] = hashes
+        source = "<automagics %s>" % modname
+        content = StringList(lines, source)
+        node = nodes.section()
+        node.document = self.state.document
+        nested_parse_with_titles(self.state, content, node)
+        return node.children
+
+
+def init_hashes(app):
+    # docname -> package -> hashes of the magics documented in the page
+    if not hasattr(app.env, 'automagics_hashes'):
+        app.env.automagics_hashes = {}
+
+def purge_hashes(app, env, docname):
+    env.automagics_hashes.pop(docname, None)
+
+def merge_hashes(app, env, docnames, other):
+    # pages read in parallel by other processes
+    for docname in docnames:
+        if docname in other.automagics_hashes:
+            env.automagics_hashes[docname] = other.automagics_hashes[docname]
+
+def outdated_pages(app, env, added, changed, removed):
+    """Returns the pages with magics whose documentation changed."""
+    current = {}
+    outdated = []
+    for docname, packages in sorted(env.automagics_hashes.items()):
+        if docname in changed or docname in removed:
+            continue
+        for modname, hashes in packages.items():
+            if modname not in current:
+                try:
+                    current[modname] = magic_hashes(modname)[1]
+                except Exception:
+                    current[modname] = None
+            if current[modname] != hashes:
+                changed_magics = sorted(
+                    key for key in set(hashes) | set(current[modname] or {})
+                    if hashes.get(key) != (current[modname] or {}).get(key))
+                logger.info("automagics: %s changed in %s",
+                            ", ".join(changed_magics) or modname, docname)
+                outdated.append(docname)
+                break
+    return outdated
+
+
 def setup(app):
     app.add_object_type('magic', 'magic', 'pair: %s; magic command', parse_magic)
     StandardDomain.roles['magic'] = LineMagicRole()
     app.add_object_type('cellmagic', 'cellmagic', 'pair: %s; cell magic', parse_cell_magic)
     StandardDomain.roles['cellmagic'] = CellMagicRole()
+    app.add_directive('automagics', AutoMagicsDirective)
+    app.connect('builder-inited', init_hashes)
+    app.connect('env-purge-doc', purge_hashes)
+    app.connect('env-merge-info', merge_hashes)
+    app.connect('env-get-outdated', outdated_pages)
+    return {'env_version': 1,
+            'parallel_read_safe': True,
+            'parallel_write_safe': True}
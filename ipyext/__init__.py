@@ -1,7 +1,107 @@
 # coding: utf-8
+"""IPython-extensions: more magic(s) for IPython
+
+``%load_ext ipyext`` makes all magics of this package available. The
+modules of the magics are only imported when one of their magics is used
+for the first time, so loading the extension costs next to nothing.
+"""
 from __future__ import absolute_import
 
-from .inactive import InactiveMagics
-from .writeandexecute import WriteAndExecuteMagics
+import sys
+from importlib import import_module
+
+from ._version import __version__
+
+# module, class, line magics and cell magics of all magics in this package,
+# so that they can be registered without importing the modules
+_MAGICS = [
+    ('ipyext.cached', 'CachedMagics', ['cached_clear'], ['cached']),
+    ('ipyext.inactive', 'InactiveMagics', [], ['inactive', 'lazy']),
+    ('ipyext.writeandexecute', 'WriteAndExecuteMagics',
+     ['writeandexecute_flush', 'writeandexecute_wait', 'writeandexecute_stats',
+      'writeandexecute_sync', 'writeandexecute_watch'],
+     ['writeandexecute']),
+]
+
+_CLASSES = dict((classname, module) for module, classname, line, cell in _MAGICS)
+
+
+def _get_all_class_magics():
+    return [getattr(import_module(module), classname)
+            for module, classname, line, cell in _MAGICS]
+
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        # import the magics only when they are needed (PEP 562)
+        if name == 'all_class_magics':
+            return _get_all_class_magics()
+        if name in _CLASSES:
+            return getattr(import_module(_CLASSES[name]), name)
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+else:
+    all_class_magics = _get_all_class_magics()
+    for _magics in all_class_magics:
+        globals()[_magics.__name__] = _magics
+
+
+# A magic which registers the real magics of `module` and then runs the real
+# magic `name`. Its docstring is the one of the real magic, so ``%name?``
+# imports `module` (but doesn't register its magics).
+class _Stub(object):
+
+    def __init__(self, ip, module, classname, kind, name):
+        self.ip = ip
+        self.module = module
+        self.classname = classname
+        self.kind = kind
+        self.__name__ = name
+
+    def __call__(self, *args):
+        if self.classname not in self.ip.magics_manager.registry:
+            # replaces all stubs of this module
+            import_module(self.module)._register_magics(self.ip)
+        return self.ip.magics_manager.magics[self.kind][self.__name__](*args)
+
+    @property
+    def __doc__(self):
+        cls = getattr(import_module(self.module), self.classname)
+        return getattr(cls, cls.magics[self.kind][self.__name__]).__doc__
+
+
+def _is_registered(ip, classname, line_magics, cell_magics):
+    """Tells if the magics of `classname` are registered and still there."""
+    magics = ip.magics_manager.magics
+    return (classname in ip.magics_manager.registry and
+            all(name in magics['line'] for name in line_magics) and
+            all(name in magics['cell'] for name in cell_magics))
+
+
+def load_ipython_extension(ip):
+    for module, classname, line_magics, cell_magics in _MAGICS:
+        if _is_registered(ip, classname, line_magics, cell_magics):
+            # the extension of this module is already loaded
+            continue
+        if module in sys.modules:
+            # already imported, no need for stubs
+            sys.modules[module]._register_magics(ip)
+            continue
+        for kind, names in (('line', line_magics), ('cell', cell_magics)):
+            for name in names:
+                ip.register_magic_function(_Stub(ip, module, classname, kind, name),
+                                           kind, name)
+    print("'ipyext' magics loaded.")
+
 
-all_class_magics = [InactiveMagics, WriteAndExecuteMagics]
\ No newline at end of file
+def unload_ipython_extension(ip):
+    for module, classname, line_magics, cell_magics in _MAGICS:
+        mod = sys.modules.get(module)
+        if mod is not None and hasattr(mod, 'unload_ipython_extension'):
+            mod.unload_ipython_extension(ip)
+        for kind, names in (('line', line_magics), ('cell', cell_magics)):
+            for name in names:
+                ip.magics_manager.magics[kind].pop(name, None)
+        # so that loading the extension again registers them again
+        magics = ip.magics_manager.registry.pop(classname, None)
+        if magics is not None and magics in ip.configurables:
+            ip.configurables.remove(magics)
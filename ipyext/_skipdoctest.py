@@ -0,0 +1,12 @@
+# coding: utf-8
+"""Decorator to skip doctests of the magics
+
+The same as ``IPython.testing.skipdoctest.skip_doctest``, but without
+importing IPython's testing package when the magics are loaded.
+"""
+
+
+def skip_doctest(f):
+    """Decorator - mark a function or method for skipping its doctest."""
+    f.skip_doctest = True
+    return f
@@ -0,0 +1,491 @@
+# encoding: utf-8
+
+# Copyright (c) IPython-extensions Development Team.
+# Distributed under the terms of the Modified BSD License.
+
+from __future__ import print_function
+
+import ast
+import hashlib
+import io
+import marshal
+import os
+import struct
+import sys
+import tempfile
+import time
+import types
+from contextlib import contextmanager
+from importlib import import_module
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from IPython.core.magic import (Magics, magics_class, cell_magic, line_magic)
+from IPython.display import publish_display_data
+from traitlets import Integer, Unicode
+
+from ._skipdoctest import skip_doctest
+from .inactive import _assigned_names
+
+# start of each entry in the store, change it if the format changes
+_ENTRY_MAGIC = b'IPYEXT-CACHED-1\n'
+_ENTRY_SUFFIX = '.cached'
+# pickle protocol 5 can pass large (numpy) buffers out of band, so they are
+# written to the file as they are
+_PROTOCOL = min(pickle.HIGHEST_PROTOCOL, 5)
+_replace = getattr(os, 'replace', os.rename)
+
+# statements which always assign their names
+_ASSIGNMENTS = tuple(getattr(ast, name) for name in
+                     ['Assign', 'AnnAssign', 'Import', 'ImportFrom', 'FunctionDef',
+                      'AsyncFunctionDef', 'ClassDef'] if hasattr(ast, name))
+
+
+class _NameReader(ast.NodeVisitor):
+    """Collects all names which a cell reads (also in functions)."""
+
+    def __init__(self):
+        self.names = set()
+
+    def visit_Name(self, node):
+        if not isinstance(node.ctx, ast.Store):
+            self.names.add(node.id)
+
+
+def _free_names(tree):
+    """Returns the names which a cell reads before it assigns them."""
+    assigned = set()
+    free = set()
+    for statement in tree.body:
+        reader = _NameReader()
+        reader.visit(statement)
+        free.update(reader.names - assigned)
+        if isinstance(statement, _ASSIGNMENTS):
+            assigned.update(_assigned_names(statement) or [])
+    return sorted(free)
+
+
+def _code_names(code):
+    """Returns the global (and attribute) names used by `code` and by the
+    code objects nested in it."""
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names.update(_code_names(const))
+    return names
+
+
+def _function_dependencies(func, namespace):
+    """Returns ``(label, value)`` of the values which `func` depends on besides
+    its code: the defaults of its arguments, the values in its closure and,
+    if it is defined in `namespace`, the globals it uses."""
+    deps = [('default', value) for value in func.__defaults__ or ()]
+    deps.extend(('kwdefault %s' % name, value) for name, value in
+                sorted((getattr(func, '__kwdefaults__', None) or {}).items()))
+    deps.extend(('closure', cell.cell_contents) for cell in func.__closure__ or ())
+    if namespace is not None and func.__globals__ is namespace:
+        deps.extend(('global %s' % name, namespace[name])
+                    for name in sorted(_code_names(func.__code__)) if name in namespace)
+    return deps
+
+
+def _fingerprint(value, namespace=None, _seen=None):
+    """Returns a digest which changes when `value` changes or None if there
+    is no cheap way to get one.
+
+    Functions defined in `namespace` (the user namespace) change also when
+    one of the globals they use changes, e.g. another function they call.
+    """
+    h = hashlib.sha1()
+    cls = type(value)
+    h.update(("%s.%s\0" % (cls.__module__, cls.__name__)).encode('utf-8'))
+    numpy = sys.modules.get('numpy')
+    pandas = sys.modules.get('pandas')
+    try:
+        if isinstance(value, types.ModuleType):
+            h.update(("%s %s" % (value.__name__, getattr(value, '__version__', ''))).encode('utf-8'))
+        elif isinstance(value, types.FunctionType):
+            h.update(("%s.%s\0" % (value.__module__, value.__name__)).encode('utf-8'))
+            h.update(marshal.dumps(value.__code__))
+            if _seen is None:
+                _seen = set()
+            # recursive functions use themselves
+            if id(value) not in _seen:
+                _seen.add(id(value))
+                for label, dep in _function_dependencies(value, namespace):
+                    fingerprint = _fingerprint(dep, namespace, _seen)
+                    if fingerprint is None:
+                        return None
+                    h.update(("\0%s=%s" % (label, fingerprint)).encode('utf-8'))
+        elif numpy is not None and isinstance(value, numpy.ndarray) and not value.dtype.hasobject:
+            h.update(("%s %s\0" % (value.dtype.str, value.shape)).encode('utf-8'))
+            h.update(numpy.ascontiguousarray(value).data)
+        elif pandas is not None and isinstance(value, (pandas.DataFrame, pandas.Series, pandas.Index)):
+            h.update(repr(value.dtypes if hasattr(value, 'dtypes') else value.dtype).encode('utf-8'))
+            h.update(pickle.dumps(list(getattr(value, 'columns', [])), _PROTOCOL))
+            h.update(pandas.util.hash_pandas_object(value).values.data)
+        else:
+            h.update(pickle.dumps(value, _PROTOCOL))
+    except Exception:
+        return None
+    return h.hexdigest()
+
+
+class _ModuleRef(object):
+    """Stands in for an imported module in a stored result: modules can't be
+    pickled, so it is imported again when the result is loaded."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __reduce__(self):
+        return import_module, (self.name,)
+
+
+def _storable(value):
+    """Returns `value` or, for a module which can be imported again, a
+    `_ModuleRef` to it."""
+    if (isinstance(value, types.ModuleType) and
+            sys.modules.get(value.__name__) is value):
+        return _ModuleRef(value.__name__)
+    return value
+
+
+def _dump(path, payload):
+    """Writes `payload` to the store entry `path` (atomically)."""
+    buffers = []
+    if _PROTOCOL >= 5:
+        data = pickle.dumps(payload, _PROTOCOL, buffer_callback=buffers.append)
+    else:
+        data = pickle.dumps(payload, _PROTOCOL)
+    fd, tmppath = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=os.path.dirname(path))
+    try:
+        with io.open(fd, 'wb') as f:
+            f.write(_ENTRY_MAGIC)
+            f.write(struct.pack('<QQ', len(data), len(buffers)))
+            f.write(data)
+            for buf in buffers:
+                raw = buf.raw()
+                f.write(struct.pack('<Q', raw.nbytes))
+                f.write(raw)
+        _replace(tmppath, path)
+    except BaseException:
+        os.unlink(tmppath)
+        raise
+
+
+def _load(path):
+    """Reads a store entry, raises ValueError if it's broken."""
+    with io.open(path, 'rb') as f:
+        if f.read(len(_ENTRY_MAGIC)) != _ENTRY_MAGIC:
+            raise ValueError("not a cache entry: %s" % path)
+        size, count = struct.unpack('<QQ', f.read(16))
+        data = f.read(size)
+        buffers = []
+        for _ in range(count):
+            nbytes, = struct.unpack('<Q', f.read(8))
+            buf = bytearray(nbytes)
+            if f.readinto(buf) != nbytes:
+                raise ValueError("truncated cache entry: %s" % path)
+            buffers.append(buf)
+    if len(data) != size:
+        raise ValueError("truncated cache entry: %s" % path)
+    if buffers:
+        return pickle.loads(data, buffers=buffers)
+    return pickle.loads(data)
+
+
+class _TeeStream(object):
+    """Writes to `stream` and records what was written."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+        return self.stream.write(data)
+
+    def getvalue(self):
+        return ''.join(self.chunks)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class _TeeDisplayPublisher(object):
+    """Publishes display data with `publisher` and records it."""
+
+    def __init__(self, publisher):
+        self.publisher = publisher
+        self.outputs = []
+
+    def publish(self, data, metadata=None, **kwargs):
+        if not kwargs.get('update'):
+            self.outputs.append((data, metadata or {}))
+        return self.publisher.publish(data, metadata=metadata, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.publisher, name)
+
+
+@contextmanager
+def _tee_output(shell):
+    """Records the stdout, stderr and display data of the code run inside,
+    which is still shown right away (unlike with `capture_output`).
+
+    Yields ``(stdout, stderr, display publisher)``.
+    """
+    stdout, stderr, display_pub = sys.stdout, sys.stderr, shell.display_pub
+    tee = (_TeeStream(stdout), _TeeStream(stderr), _TeeDisplayPublisher(display_pub))
+    sys.stdout, sys.stderr, shell.display_pub = tee
+    try:
+        yield tee
+    finally:
+        sys.stdout, sys.stderr, shell.display_pub = stdout, stderr, display_pub
+
+
+def _touch(path):
+    """Marks a store entry as used, for the LRU eviction."""
+    # the file system might use a coarse clock for the mtime
+    now = time.time()
+    try:
+        os.utime(path, (now, now))
+    except OSError:
+        pass
+
+
+@magics_class
+class CachedMagics(Magics):
+    """Magic to reuse the results of a cell."""
+
+    cache_dir = Unicode(u'', help="""Directory of the store of cell results.
+        Default: 'cached_cells' in the directory of the IPython
+        profile.""").tag(config=True)
+
+    cache_size = Integer(1024 * 1024 * 1024, help="""Maximum size of the store in
+        bytes. The least recently used results are removed first.""").tag(config=True)
+
+    @skip_doctest
+    @cell_magic
+    def cached(self, parameter_s='', cell=None):
+        """Runs a cell only if its result isn't stored yet.
+
+        The result of the cell (the variables it assigns, its output and
+        its displayed value) is stored under a key made from the (transformed)
+        code of the cell and the values of all the variables it reads. If the
+        cell is run again with the same code and the same values, the
+        variables are set from the store and the output is shown again,
+        without running the cell.
+
+        The values of numpy arrays and pandas objects are hashed, other
+        values are pickled for the key, functions are compared by their
+        code, the defaults of their arguments and their closure (functions
+        defined in the notebook also by the variables and functions they
+        use) and modules by their version. Modules which the cell imports
+        are stored by their name and imported again when the result is
+        used. A cell which reads or defines something else which can't be
+        pickled is run as usual, but not stored. Variables used only inside of `%magic` commands (``%time
+        x = y``) are not part of the key.
+
+        The store is kept in ``CachedMagics.cache_dir``, its size is limited by
+        ``CachedMagics.cache_size``. Results are written with pickle
+        (protocol 5, if available), with the data of large numpy arrays and
+        pandas objects written directly behind it.
+
+        Parameters
+        ----------
+
+        -f : (optional)
+            Run the cell even if its result is stored and store it again.
+            Default: -- (use a stored result)
+
+        -d : (optional)
+            Write some debugging output. Default: -- (no debugging output)
+
+        Examples:
+        ---------
+        ::
+
+            In [1]: %load_ext ipyext.cached
+            'cached' magic loaded.
+
+            In [2]: %%cached
+               ...: print("running...")
+               ...: a = 1
+               ...:
+            running...
+
+            In [3]: %%cached
+               ...: print("running...")
+               ...: a = 1
+               ...:
+            running...
+
+        The second time, the cell wasn't run, the output came from the store.
+        """
+        opts, args = self.parse_options(parameter_s, 'fd')
+        debug = 'd' in opts
+        shell = self.shell
+        code = shell.input_transformer_manager.transform_cell(cell)
+        cell_name = shell.compile.cache(code, shell.execution_count)
+        try:
+            tree = shell.transform_ast(shell.compile.ast_parse(code, filename=cell_name))
+        except SyntaxError:
+            # let IPython report it
+            shell.run_cell(code)
+            return
+
+        names = _assigned_names(tree)
+        key, problem = self._cache_key(code, tree)
+        if names is None:
+            problem = "the names it defines can't be determined"
+        if problem is not None:
+            print("Cell not cached: %s" % problem, file=sys.stderr)
+            return self._run(tree, cell_name)[1]
+
+        path = os.path.join(self._get_cache_dir(), key + _ENTRY_SUFFIX)
+        if 'f' not in opts and os.path.exists(path):
+            try:
+                payload = _load(path)
+            except Exception as e:
+                if debug:
+                    print("Could not read %s: %s" % (path, e))
+            else:
+                if debug:
+                    print("Using stored result %s" % key)
+                _touch(path)
+                return self._replay(payload)
+
+        with _tee_output(shell) as (stdout, stderr, display_pub):
+            success, result = self._run(tree, cell_name)
+        if not success:
+            return
+        ns = shell.user_ns
+        payload = {
+            'names': dict((name, _storable(ns[name])) for name in names if name in ns),
+            'stdout': stdout.getvalue(),
+            'stderr': stderr.getvalue(),
+            'outputs': display_pub.outputs,
+            'result': result,
+        }
+        problem = self._store(path, payload)
+        if problem is not None:
+            print("Cell not cached: %s" % problem, file=sys.stderr)
+        elif debug:
+            print("Stored result %s" % key)
+        return result
+
+    @line_magic
+    def cached_clear(self, parameter_s=''):
+        """Removes all stored results of `%%cached`."""
+        for path, size, mtime in self._entries():
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def _get_cache_dir(self):
+        cache_dir = self.cache_dir or os.path.join(self.shell.profile_dir.location,
+                                                   'cached_cells')
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        return cache_dir
+
+    def _cache_key(self, code, tree):
+        """Returns ``(key, None)`` or ``(None, problem)``."""
+        h = hashlib.sha1()
+        h.update(("%s %s\0" % (sys.version_info[:2], _PROTOCOL)).encode('utf-8'))
+        h.update(code.encode('utf-8'))
+        ns = self.shell.user_ns
+        for name in _free_names(tree):
+            if name in ns:
+                fingerprint = _fingerprint(ns[name], self.shell.user_global_ns)
+                if fingerprint is None:
+                    return None, "can't fingerprint the value of '%s'" % name
+            else:
+                fingerprint = '-'
+            h.update(("\0%s=%s" % (name, fingerprint)).encode('utf-8'))
+        return h.hexdigest(), None
+
+    def _run(self, tree, cell_name):
+        """Runs the cell in the user namespace, returns ``(success, value of
+        the last expression)``."""
+        shell = self.shell
+        body = list(tree.body)
+        last = None
+        if body and isinstance(body[-1], ast.Expr):
+            last = ast.Expression(body.pop().value)
+        try:
+            exec(shell.compile(ast.Module(body=body, type_ignores=[]), cell_name, 'exec'),
+                 shell.user_global_ns, shell.user_ns)
+            if last is not None:
+                return True, eval(shell.compile(last, cell_name, 'eval'),
+                                  shell.user_global_ns, shell.user_ns)
+        except Exception:
+            shell.showtraceback()
+            return False, None
+        return True, None
+
+    def _replay(self, payload):
+        self.shell.user_ns.update(payload['names'])
+        sys.stdout.write(payload['stdout'])
+        sys.stderr.write(payload['stderr'])
+        for data, metadata in payload['outputs']:
+            publish_display_data(data=data, metadata=metadata)
+        return payload['result']
+
+    def _store(self, path, payload):
+        """Writes the result of a cell to the store, returns a problem or None."""
+        main = self.shell.user_module.__name__
+        for name, value in payload['names'].items():
+            if (isinstance(value, (types.FunctionType, type)) and
+                    getattr(value, '__module__', None) == main):
+                # pickle would only store a reference to the user namespace
+                return "'%s' is defined in the notebook" % name
+        try:
+            _dump(path, payload)
+        except Exception as e:
+            return "can't store the results: %s" % e
+        _touch(path)
+        self._evict()
+
+    def _entries(self):
+        """Returns ``(path, size, mtime)`` of all stored results."""
+        cache_dir = self._get_cache_dir()
+        entries = []
+        for filename in os.listdir(cache_dir):
+            if not filename.endswith(_ENTRY_SUFFIX):
+                continue
+            path = os.path.join(cache_dir, filename)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((path, st.st_size, st.st_mtime))
+        return entries
+
+    def _evict(self):
+        """Removes the least recently used results until the store fits into
+        ``cache_size``."""
+        total = 0
+        for path, size, mtime in sorted(self._entries(), key=lambda e: e[2], reverse=True):
+            total += size
+            if total > self.cache_size:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                total -= size
+
+
+def _register_magics(ip):
+    ip.register_magics(CachedMagics)
+
+
+def load_ipython_extension(ip):
+    _register_magics(ip)
+    print ("'cached' magic loaded.")
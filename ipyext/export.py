@@ -0,0 +1,192 @@
+# encoding: utf-8
+"""
+Export the `%%writeandexecute` cells of notebooks without running them
+
+Usage::
+
+    ipyext-export [-j <jobs>] [-q] notebook.ipynb [notebook.ipynb ...]
+
+All `%%writeandexecute -i <identifier> <filename>` cells of the given
+notebooks are written into their target files, exactly as the magic would
+do it, but without starting a kernel and without executing any code.
+Relative filenames are relative to the directory of the notebook, as they
+are when the notebook runs. If several cells (in one or in several
+notebooks) use the same identifier for the same file, the last one wins.
+Each target file is written once. Notebooks which can't be read are
+reported and skipped, the exit code is then 1, as it is for target files
+which can't be written.
+
+The notebooks are read in parallel, as are the target files written.
+"""
+
+# Copyright (c) IPython-extensions Development Team.
+# Distributed under the terms of the Modified BSD License.
+
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import os
+import sys
+from collections import OrderedDict
+from getopt import getopt, GetoptError
+from multiprocessing import Pool, cpu_count
+
+from IPython.utils.process import arg_split
+
+from .writeandexecute import WriteAndExecuteMagics, _MAGIC_OPTIONS, _split_magic_cell
+
+
+def _transformer():
+    """Returns a function which transforms a cell like the shell would do."""
+    try:
+        from IPython.core.inputtransformer2 import TransformerManager
+    except ImportError:  # IPython < 7
+        from IPython.core.inputsplitter import IPythonInputSplitter as TransformerManager
+    return TransformerManager().transform_cell
+
+
+def _iter_code_cells(nb):
+    """Yields the source of all code cells of the notebook `nb` (a dict)."""
+    if 'worksheets' in nb:
+        # nbformat 3
+        cells = [cell for ws in nb['worksheets'] for cell in ws.get('cells', [])]
+        source_key = 'input'
+    else:
+        cells = nb.get('cells', [])
+        source_key = 'source'
+    for cell in cells:
+        if cell.get('cell_type') != 'code':
+            continue
+        source = cell.get(source_key, '')
+        if isinstance(source, list):
+            source = ''.join(source)
+        yield source
+
+
+def parse_magic_line(line):
+    """Parses the arguments of a `%%writeandexecute` line.
+
+    Returns ``(identifier, filename)``, raises ValueError for invalid
+    arguments.
+    """
+    try:
+        opts, args = getopt(arg_split(line, posix=os.name == 'posix'), _MAGIC_OPTIONS)
+    except GetoptError as e:
+        raise ValueError(e.msg)
+    opts = dict(opts)
+    if not opts.get('-i'):
+        raise ValueError('Missing indentifier')
+    if not args:
+        raise ValueError('Missing filename')
+    return opts['-i'], " ".join(args)
+
+
+def extract_blocks(nbpath):
+    """Returns the ``(target file, identifier, content)`` of all
+    `%%writeandexecute` cells of the notebook `nbpath` and a list of
+    problems with cells which were skipped."""
+    with io.open(nbpath, 'r', encoding='utf-8') as f:
+        nb = json.load(f)
+    nbdir = os.path.dirname(os.path.abspath(nbpath))
+    transform = None
+    blocks = []
+    problems = []
+    for number, source in enumerate(_iter_code_cells(nb), 1):
+        parts = _split_magic_cell(source)
+        if parts is None:
+            continue
+        line, cell = parts
+        if not cell.strip():
+            problems.append("%s, cell %s: cell body is empty" % (nbpath, number))
+            continue
+        try:
+            identifier, filename = parse_magic_line(line)
+        except ValueError as e:
+            problems.append("%s, cell %s: %s" % (nbpath, number, e))
+            continue
+        if transform is None:
+            transform = _transformer()
+        pypath = os.path.splitext(os.path.join(nbdir, filename))[0] + '.py'
+        blocks.append((pypath, identifier, transform(cell)))
+    return blocks, problems
+
+
+def read_notebook(nbpath):
+    """Extracts the blocks of one notebook. Returns ``(path, blocks,
+    problems, error message)``."""
+    try:
+        blocks, problems = extract_blocks(nbpath)
+    except (IOError, OSError, ValueError) as e:
+        # missing, unreadable or not a notebook (JSON)
+        return nbpath, [], [], str(e)
+    return nbpath, blocks, problems, None
+
+
+def write_target(item):
+    """Writes the blocks of one target file. Returns ``(path, changed
+    identifiers, error message)``."""
+    pypath, blocks = item
+    try:
+        changed = WriteAndExecuteMagics()._save_blocks(pypath, blocks)
+    except Exception as e:
+        return pypath, [], str(e)
+    return pypath, changed, None
+
+
+def export(notebooks, jobs=None, quiet=False):
+    """Writes the `%%writeandexecute` cells of `notebooks` into their target
+    files. Returns the number of errors."""
+    jobs = jobs or cpu_count()
+    pool = Pool(min(jobs, len(notebooks))) if jobs > 1 and len(notebooks) > 1 else None
+    try:
+        imap = pool.imap if pool is not None else map
+        # target file -> identifier -> content, in the order of the notebooks
+        targets = OrderedDict()
+        errors = 0
+        for nbpath, blocks, problems, error in imap(read_notebook, notebooks):
+            if error is not None:
+                errors += 1
+                print("Could not read %s: %s" % (nbpath, error), file=sys.stderr)
+            for problem in problems:
+                print("Skipped %s" % problem, file=sys.stderr)
+            for pypath, identifier, content in blocks:
+                targets.setdefault(pypath, OrderedDict())[identifier] = content
+
+        if pool is not None and len(targets) < 2:
+            imap = map
+        for pypath, changed, error in imap(write_target, targets.items()):
+            if error is not None:
+                errors += 1
+                print("Could not write %s: %s" % (pypath, error), file=sys.stderr)
+            elif not quiet:
+                if changed:
+                    print("Wrote %s (%s)" % (pypath, ", ".join(changed)))
+                else:
+                    print("Unchanged %s" % pypath)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='ipyext-export',
+        description="Write the %%writeandexecute cells of notebooks into their "
+                    "target files without running the notebooks.")
+    parser.add_argument('notebooks', nargs='+', metavar='notebook',
+                        help="notebook files (.ipynb)")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="number of processes (default: number of CPUs)")
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help="only print errors")
+    args = parser.parse_args(argv)
+    errors = export(args.notebooks, jobs=args.jobs, quiet=args.quiet)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
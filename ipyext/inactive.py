@@ -4,9 +4,318 @@
 # Copyright (c) IPython-extensions Development Team. 
 # Distributed under the terms of the Modified BSD License. 
 
+from __future__ import print_function
+
+import ast
+import glob
+import operator
+import os
+import sys
+import time
+
 from IPython.core.magic import (Magics, magics_class, cell_magic)
-from IPython.testing.skipdoctest import skip_doctest
 from IPython.core.error import UsageError
+from IPython.utils.process import arg_split
+
+from ._skipdoctest import skip_doctest
+
+# marks a name which was not in the user namespace before
+_missing = object()
+# directories changed less than that many seconds ago are globbed every time
+_RACY_SECONDS = 2
+
+
+class _NameCollector(ast.NodeVisitor):
+    """Collects the names which a cell binds in its namespace.
+
+    Bodies of functions, classes and lambdas and the targets of
+    comprehensions have their own namespace and are skipped. `complete` is
+    False if the names can't be known (``from module import *``).
+    """
+
+    def __init__(self):
+        self.names = []
+        self.complete = True
+
+    def add(self, name):
+        if name not in self.names:
+            self.names.append(name)
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Store):
+            self.add(node.id)
+
+    def visit_FunctionDef(self, node):
+        self.add(node.name)
+        for decorator in node.decorator_list:
+            self.visit(decorator)
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+    visit_ClassDef = visit_FunctionDef
+
+    def visit_Lambda(self, node):
+        pass
+
+    def visit_comprehension(self, node):
+        self.visit(node.iter)
+        for condition in node.ifs:
+            self.visit(condition)
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            if alias.name == '*':
+                self.complete = False
+            else:
+                self.add(alias.asname or alias.name.split('.')[0])
+
+    visit_ImportFrom = visit_Import
+
+    def visit_ExceptHandler(self, node):
+        # the name of the exception is deleted at the end of the handler
+        for statement in node.body:
+            self.visit(statement)
+
+
+def _assigned_names(tree):
+    """Returns the names bound by the module `tree` or None if they can't be
+    determined."""
+    collector = _NameCollector()
+    collector.visit(tree)
+    return collector.names if collector.complete else None
+
+
+class _LazyCell(object):
+    """A cell which runs when one of its names is used the first time."""
+
+    def __init__(self, shell, code, names):
+        self.shell = shell
+        self.code = code
+        # name -> proxy and value in the user namespace before the proxy
+        self.proxies = {}
+        self.previous = {}
+        self.done = False
+        ns = shell.user_ns
+        for name in names:
+            previous = ns.get(name, _missing)
+            if type(previous) is _LazyName:
+                # a lazy cell which was never run: go back to what was there before
+                previous = object.__getattribute__(previous, '_lazy_cell').previous[name]
+            self.previous[name] = previous
+            self.proxies[name] = ns[name] = _LazyName(self, name)
+            # %who, %whos and variable inspectors would run the cell
+            shell.user_ns_hidden[name] = self.proxies[name]
+
+    def run(self):
+        if self.done:
+            return
+        # the cell runs only once, even if it fails
+        self.done = True
+        ns = self.shell.user_ns
+        hidden = self.shell.user_ns_hidden
+        # the cell should see the names as they were before
+        for name, proxy in self.proxies.items():
+            if hidden.get(name) is proxy:
+                del hidden[name]
+            if ns.get(name) is proxy:
+                if self.previous[name] is _missing:
+                    del ns[name]
+                else:
+                    ns[name] = self.previous[name]
+        exec(self.code, self.shell.user_global_ns, ns)
+
+    def value(self, name):
+        self.run()
+        try:
+            value = self.shell.user_ns[name]
+        except KeyError:
+            value = _missing
+        if value is _missing or value is self.proxies[name]:
+            raise NameError("name '%s' was not defined by the lazy cell" % name)
+        return value
+
+
+def _resolve(proxy):
+    return object.__getattribute__(proxy, '_lazy_cell').value(
+        object.__getattribute__(proxy, '_lazy_name'))
+
+
+class _LazyName(object):
+    """Stands in for a name of a lazy cell and runs the cell on first use.
+
+    Everything done with the proxy is forwarded to the real value.
+    """
+
+    __slots__ = ('_lazy_cell', '_lazy_name', '__weakref__')
+
+    def __init__(self, cell, name):
+        object.__setattr__(self, '_lazy_cell', cell)
+        object.__setattr__(self, '_lazy_name', name)
+
+    def __getattribute__(self, name):
+        return getattr(_resolve(self), name)
+
+    def __setattr__(self, name, value):
+        setattr(_resolve(self), name, value)
+
+    def __delattr__(self, name):
+        delattr(_resolve(self), name)
+
+    def __dir__(self):
+        return dir(_resolve(self))
+
+    def __call__(self, *args, **kwargs):
+        return _resolve(self)(*args, **kwargs)
+
+    def __enter__(self):
+        return _resolve(self).__enter__()
+
+    def __exit__(self, *args):
+        return _resolve(self).__exit__(*args)
+
+    def __repr__(self):
+        # repr() is used to show values, e.g. by debuggers, which shouldn't
+        # run the cell
+        cell = object.__getattribute__(self, '_lazy_cell')
+        if not cell.done:
+            return "<%%%%lazy name '%s', not run yet>" % object.__getattribute__(self, '_lazy_name')
+        return repr(_resolve(self))
+
+    def __format__(self, format_spec):
+        return format(_resolve(self), format_spec)
+
+    def __reduce_ex__(self, protocol):
+        return _resolve(self).__reduce_ex__(protocol)
+
+
+def _forward(function):
+    def method(self, *args):
+        return function(_resolve(self), *args)
+    return method
+
+
+def _forward_reflected(function):
+    def method(self, other):
+        return function(other, _resolve(self))
+    return method
+
+
+for _name, _function in [('str', str), ('hash', hash), ('bool', bool),
+                         ('nonzero', bool), ('len', len), ('iter', iter),
+                         ('reversed', reversed), ('index', operator.index),
+                         ('int', int), ('float', float), ('complex', complex),
+                         ('round', round), ('neg', operator.neg), ('pos', operator.pos),
+                         ('abs', abs), ('invert', operator.invert),
+                         ('contains', operator.contains), ('getitem', operator.getitem),
+                         ('setitem', operator.setitem), ('delitem', operator.delitem),
+                         ('eq', operator.eq), ('ne', operator.ne), ('lt', operator.lt),
+                         ('le', operator.le), ('gt', operator.gt), ('ge', operator.ge)]:
+    setattr(_LazyName, '__%s__' % _name, _forward(_function))
+
+for _name in ['add', 'sub', 'mul', 'truediv', 'floordiv', 'mod', 'pow', 'lshift',
+              'rshift', 'and', 'xor', 'or', 'matmul', 'div']:
+    _function = getattr(operator, _name, None) or getattr(operator, _name + '_', None)
+    if _function is None:
+        # matmul on Python < 3.5, div on Python 3
+        continue
+    setattr(_LazyName, '__%s__' % _name, _forward(_function))
+    setattr(_LazyName, '__r%s__' % _name, _forward_reflected(_function))
+    setattr(_LazyName, '__i%s__' % _name, _forward(getattr(operator, 'i' + _name)))
+
+if hasattr(os, 'fspath'):
+    _LazyName.__fspath__ = _forward(os.fspath)
+
+
+def _file_signature(path):
+    """Returns ``(mtime, size, inode)`` of `path` or None if it doesn't exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    mtime = getattr(st, 'st_mtime_ns', None)
+    if mtime is None:  # Python 2
+        mtime = int(st.st_mtime * 1e9)
+    return (mtime, st.st_size, st.st_ino)
+
+
+def _split_inactive_options(parameter_s):
+    """Returns the inputs (``-i``) and outputs (``-o``) of a `%%inactive`
+    line.
+
+    Only ``-i VALUE`` and ``-o VALUE`` (as separate arguments) are used. All
+    other arguments, like ``-ignored``, are ignored, as `%%inactive` ignored
+    all its arguments before it knew ``-i`` and ``-o``.
+    """
+    options = {'-i': [], '-o': []}
+    args = arg_split(parameter_s, posix=os.name == 'posix')
+    while args:
+        arg = args.pop(0)
+        if arg in options and args:
+            options[arg].append(args.pop(0))
+    return options['-i'], options['-o']
+
+
+class _FreshnessCache(object):
+    """Decides if the outputs of a cell are newer than its inputs.
+
+    The files matching a glob pattern are reused as long as the directory
+    did not change and the decision is reused as long as none of the files
+    changed, so checking an unchanged cell only needs a few ``stat`` calls.
+    """
+
+    def __init__(self):
+        # (cwd, pattern) -> (signature of the directory, matching files)
+        self._globs = {}
+        # (cwd, inputs, outputs) -> (signatures of the files, up to date?)
+        self._results = {}
+
+    def expand(self, pattern):
+        """Returns the files matching `pattern`."""
+        if not glob.has_magic(pattern):
+            return [pattern]
+        directory = os.path.dirname(pattern)
+        if glob.has_magic(directory):
+            # several directories, which could all change
+            return sorted(glob.glob(pattern))
+        key = (os.getcwd(), pattern)
+        signature = _file_signature(directory or os.curdir)
+        cached = self._globs.get(key)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        matches = sorted(glob.glob(pattern))
+        # the mtime has a coarse resolution, so a directory which was just
+        # changed could change again without a new mtime
+        if signature is not None and signature[0] < (time.time() - _RACY_SECONDS) * 1e9:
+            self._globs[key] = (signature, matches)
+        return matches
+
+    def up_to_date(self, inputs, outputs):
+        """Returns True if all `outputs` exist and are newer than all
+        `inputs` (both lists of glob patterns)."""
+        files = []
+        for patterns in (inputs, outputs):
+            expanded = []
+            for pattern in patterns:
+                matches = self.expand(pattern)
+                if not matches:
+                    # a missing output or input: run the cell and let it complain
+                    return False
+                expanded.extend(matches)
+            files.append(expanded)
+        signatures = tuple(tuple(_file_signature(path) for path in paths) for paths in files)
+        key = (os.getcwd(), tuple(inputs), tuple(outputs))
+        cached = self._results.get(key)
+        if cached is not None and cached[0] == signatures:
+            return cached[1]
+        input_signatures, output_signatures = signatures
+        if None in output_signatures or None in input_signatures:
+            result = False
+        else:
+            newest_input = max([sig[0] for sig in input_signatures] or [None])
+            oldest_output = min(sig[0] for sig in output_signatures)
+            result = newest_input is None or oldest_output > newest_input
+        self._results[key] = (signatures, result)
+        return result
+
 
 @magics_class
 class InactiveMagics(Magics):
@@ -15,12 +324,36 @@ class InactiveMagics(Magics):
     Useful for temporary deactivating a cell.    
     """
 
+    def __init__(self, shell=None, **kwargs):
+        super(InactiveMagics, self).__init__(shell=shell, **kwargs)
+        self._freshness = _FreshnessCache()
+
     @skip_doctest
     @cell_magic
     def inactive(self, parameter_s='', cell=None):
         """Magic to *not* execute a cell.
         
         This magic can be used to mark a cell (temporary) as inactive.
+
+        With ``-o``, the cell is only inactive as long as the files it
+        creates are up to date, like a rule of ``make``: the cell is not
+        executed if all outputs exist and are newer than all inputs,
+        otherwise it is run. The files are only checked again if they (or
+        the directories of the glob patterns) changed, so this is cheap
+        enough for many cells.
+
+        Parameters
+        ----------
+
+        -i <input> : (optional)
+            File or glob pattern of files the cell reads. Can be given
+            multiple times. Default: -- (no inputs)
+
+        -o <output> : (optional)
+            File or glob pattern of files the cell writes. Can be given
+            multiple times. Default: -- (never execute the cell)
+
+        All other arguments are ignored.
         
         Examples:
         ---------
@@ -33,13 +366,90 @@ class InactiveMagics(Magics):
                ...: print("code not run...")
                ...:
             Cell inactive: not executed!
+
+            In [3]: %%inactive -i data/*.csv -o summary.csv
+               ...: summarize('data', 'summary.csv')
+               ...:
+            Cell inactive: outputs are up to date, not executed!
         """
         if cell is None:
             raise UsageError('empty cell, nothing to ignore :-)')
-        print("Cell inactive: not executed!")
-        
+        inputs, outputs = _split_inactive_options(parameter_s)
+        if not outputs:
+            if inputs:
+                raise UsageError('Missing outputs: include "-o <output>"')
+            print("Cell inactive: not executed!")
+            return
+        if self._freshness.up_to_date(inputs, outputs):
+            print("Cell inactive: outputs are up to date, not executed!")
+            return
+        self.shell.run_cell(cell)
 
-            
-def load_ipython_extension(ip):
+    @skip_doctest
+    @cell_magic
+    def lazy(self, parameter_s='', cell=None):
+        """Magic to execute a cell only when one of its names is used.
+
+        The names which the cell assigns (variables, functions, classes and
+        imports) are found without running the cell and are set to
+        placeholders. The first time one of them is used, the cell is run
+        (once) and the placeholder passes everything on to the real value.
+        This makes notebooks with expensive, but rarely used setup cells
+        faster to run.
+
+        The cell runs in the user namespace, like a normal cell, but at the
+        time a name is used first, so it sees the variables as they are
+        then. Errors of the cell are raised where the name is used. Cells
+        with ``from module import *`` or without any names are run right
+        away. Names assigned inside of `%magic` commands (``%time x = 1``)
+        are not found. ``type()`` of a placeholder is not the type of the
+        real value, but ``isinstance()`` works.
+
+        Until the cell ran, ``%who`` and ``%whos`` don't list its names and
+        ``repr()`` of a placeholder doesn't run it. Tab completion of a name
+        can run the cell, as the completer looks at the type of the value.
+
+        Examples:
+        ---------
+        ::
+
+            In [1]: %load_ext ipyext.inactive
+            'inactive' magic loaded.
+
+            In [2]: %%lazy
+               ...: print("running...")
+               ...: data = list(range(5))
+               ...:
+            Cell lazy: executed when one of these names is used: data
+
+            In [3]: len(data)
+            running...
+            Out[3]: 5
+        """
+        if cell is None:
+            raise UsageError('empty cell, nothing to run :-)')
+        shell = self.shell
+        code = shell.input_transformer_manager.transform_cell(cell)
+        cell_name = shell.compile.cache(code, shell.execution_count)
+        try:
+            tree = shell.transform_ast(shell.compile.ast_parse(code, filename=cell_name))
+        except SyntaxError:
+            # let IPython report it
+            shell.run_cell(code)
+            return
+        names = _assigned_names(tree)
+        if not names:
+            print("Cell lazy: names not known, executed right away!", file=sys.stderr)
+            shell.run_cell(code)
+            return
+        _LazyCell(shell, shell.compile(tree, cell_name, 'exec'), names)
+        print("Cell lazy: executed when one of these names is used: %s" % ", ".join(names))
+
+
+def _register_magics(ip):
     ip.register_magics(InactiveMagics)
+
+
+def load_ipython_extension(ip):
+    _register_magics(ip)
     print ("'inactive' magic loaded.")
\ No newline at end of file
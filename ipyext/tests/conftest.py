@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""Fixtures for the tests of ipyext.
+
+Each test process (with pytest-xdist: each worker) starts one IPython
+shell in the process, so the magics run (and are measured by coverage) in
+the same process as the tests. Every test runs in its own temporary working
+directory, so tests which write files can run at the same time.
+"""
+
+from __future__ import absolute_import
+
+import os
+import sys
+
+import pytest
+
+from IPython import get_ipython
+from IPython.testing.globalipapp import start_ipython
+
+
+@pytest.fixture(scope='session')
+def ip():
+    """The IPython shell of this test process."""
+    start_ipython()
+    return get_ipython()
+
+
+@pytest.fixture(scope='session', autouse=True)
+def coverage_file():
+    """Makes the processes started by the magics (in the working directory
+    of a test) write their coverage data next to the data of this process,
+    where it is combined."""
+    try:
+        from coverage import Coverage
+    except ImportError:
+        return
+    cov = Coverage.current()
+    if cov is not None:
+        os.environ['COVERAGE_FILE'] = os.path.abspath(cov.config.data_file)
+
+
+@pytest.fixture(autouse=True)
+def isolated_cwd(ip, tmp_path, monkeypatch):
+    """Runs the test in a temporary working directory and forgets the
+    modules which the test imported from it."""
+    monkeypatch.chdir(tmp_path)
+    modules = set(sys.modules)
+    yield str(tmp_path)
+    tmp_dir = os.path.realpath(str(tmp_path)) + os.sep
+    for name in set(sys.modules) - modules:
+        path = getattr(sys.modules[name], '__file__', None)
+        if path and os.path.realpath(path).startswith(tmp_dir):
+            del sys.modules[name]
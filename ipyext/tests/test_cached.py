@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""Tests for the %%cached magic.
+The IPython shell is started by conftest.py.
+"""
+
+from __future__ import absolute_import
+
+import os
+from unittest import skipIf
+
+from IPython.testing import tools as tt
+from IPython.utils.io import capture_output
+from IPython.utils.tempdir import TemporaryDirectory
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+# how often the cells were run, the cells call count_run(), which doesn't
+# change the key (as a list in the user namespace would)
+RUNS = []
+
+
+def count_run():
+    RUNS.append(1)
+
+
+# what was shown when the cell called record_progress(), of the output
+# captured in CAPTURED[0]
+PROGRESS = []
+CAPTURED = []
+
+
+def record_progress():
+    captured = CAPTURED[0]
+    PROGRESS.append(('first' in captured.stdout, len(captured.outputs)))
+
+
+CELL = """print('running')
+count_run()
+cached_total = sum(cached_input)
+cached_total * 2"""
+
+
+def _load(ip, cache_dir):
+    with tt.AssertPrints("'cached' magic loaded"):
+        ip.run_cell("%reload_ext ipyext.cached")
+    ip.run_cell("%%config CachedMagics.cache_dir = %r" % cache_dir)
+    ip.run_cell("%config CachedMagics.cache_size = 1073741824")
+    ip.user_ns['count_run'] = count_run
+    del RUNS[:]
+
+
+def test_cached(ip):
+    with TemporaryDirectory() as td:
+        _load(ip, td)
+        ip.run_cell("cached_input = [1, 2, 3]")
+        with tt.AssertPrints("running"):
+            ip.run_cell("%%cached\n" + CELL)
+        assert RUNS == [1]
+
+        # not run again, but everything is restored
+        ip.run_cell("del cached_total")
+        with capture_output() as captured:
+            result = ip.run_cell("%%cached\n" + CELL)
+        assert captured.stdout.count("running") == 1
+        assert result.result == 12
+        assert ip.user_ns['cached_total'] == 6
+        assert RUNS == [1]
+
+        # other values of the variables it reads, other code or -f run it again
+        ip.run_cell("cached_input = [1, 2]")
+        ip.run_cell("%%cached\n" + CELL)
+        assert ip.user_ns['cached_total'] == 3
+        assert RUNS == [1, 1]
+        ip.run_cell("%%cached\n" + CELL + " # changed")
+        assert RUNS == [1, 1, 1]
+        ip.run_cell("%%cached -f\n" + CELL)
+        assert RUNS == [1, 1, 1, 1]
+        ip.run_cell("cached_input = [1, 2, 3]")
+        ip.run_cell("%%cached\n" + CELL)
+        assert RUNS == [1, 1, 1, 1]
+
+        # display output is replayed
+        cell = ("%%cached\nfrom IPython.display import publish_display_data\n"
+                "publish_display_data({'text/html': '<b>x</b>'})")
+        ip.run_cell(cell)
+        with capture_output() as captured:
+            ip.run_cell(cell)
+        assert captured.outputs[0].data['text/html'] == '<b>x</b>'
+
+        # the output is shown while the cell runs, not only at its end
+        ip.user_ns['record_progress'] = record_progress
+        cell = ("%%cached\nprint('first')\n"
+                "publish_display_data({'text/html': '<b>y</b>'})\n"
+                "record_progress()\nprint('second')")
+        with capture_output() as captured:
+            CAPTURED[:] = [captured]
+            ip.run_cell(cell)
+        assert PROGRESS == [(True, 1)]
+        assert 'second' in captured.stdout
+        with capture_output() as captured:
+            ip.run_cell(cell)
+        assert PROGRESS == [(True, 1)]
+        assert captured.stdout.count('first') == 1
+        assert 'second' in captured.stdout
+        assert captured.outputs[0].data['text/html'] == '<b>y</b>'
+
+        # imported modules are imported again
+        cell = ("%%cached\ncount_run()\nimport os.path as cached_path\n"
+                "import json, xml.dom\ncached_joined = cached_path.join('a', 'b')")
+        with tt.AssertNotPrints("not cached", channel='stderr'):
+            ip.run_cell(cell)
+        ip.run_cell("del cached_path, json, xml, cached_joined")
+        runs = len(RUNS)
+        ip.run_cell(cell)
+        assert len(RUNS) == runs
+        import json
+        import xml
+        assert ip.user_ns['cached_path'] is os.path
+        assert ip.user_ns['json'] is json
+        assert ip.user_ns['xml'] is xml
+        assert ip.user_ns['cached_joined'] == os.path.join('a', 'b')
+
+        # functions change with the globals they use, their defaults and
+        # their closures
+        ip.run_cell("cached_scale = 2\n"
+                    "def cached_helper(x):\n    return x * cached_scale\n"
+                    "def cached_apply(x, offset=1):\n    return cached_helper(x) + offset\n"
+                    "def cached_adder(n):\n    return lambda x: x + n\n"
+                    "cached_add = cached_adder(1)\n"
+                    "def cached_fact(n):\n    return 1 if n <= 1 else n * cached_fact(n - 1)")
+        cell = ("%%cached\ncount_run()\n"
+                "cached_applied = cached_apply(3) + cached_add(0) + cached_fact(3)")
+        runs = len(RUNS)
+        for change, expected in [("", 14), ("", 14), ("cached_scale = 3", 17),
+                                 ("def cached_helper(x):\n    return x", 11),
+                                 ("def cached_apply(x, offset=2):\n"
+                                  "    return cached_helper(x) + offset", 12),
+                                 ("cached_add = cached_adder(2)", 13)]:
+            ip.run_cell(change)
+            ip.run_cell(cell)
+            assert ip.user_ns['cached_applied'] == expected
+        assert len(RUNS) == runs + 5
+
+        # failing cells and functions defined in the cell are not stored
+        with tt.AssertPrints("ZeroDivisionError"):
+            ip.run_cell("%%cached\ncount_run()\n1/0")
+        with tt.AssertPrints("ZeroDivisionError"):
+            ip.run_cell("%%cached\ncount_run()\n1/0")
+        with tt.AssertPrints("'cached_func' is defined in the notebook", channel='stderr'):
+            ip.run_cell("%%cached\ndef cached_func():\n    pass")
+
+        ip.run_cell("%cached_clear")
+        assert [f for f in os.listdir(td) if not f.startswith('.')] == []
+
+
+def test_cached_eviction(ip):
+    with TemporaryDirectory() as td:
+        _load(ip, td)
+        for i in range(3):
+            ip.run_cell("%%cached\ncount_run()\ncached_value = 'x' * 100000 + '{}'".format(i))
+        assert len(os.listdir(td)) == 3
+        # the first one was used last
+        ip.run_cell("%%cached\ncount_run()\ncached_value = 'x' * 100000 + '0'")
+        ip.run_cell("%config CachedMagics.cache_size = 250000")
+        ip.run_cell("%%cached\ncount_run()\ncached_value = 'x' * 100000 + '3'")
+        assert len(os.listdir(td)) == 2
+        ip.run_cell("%%cached\ncount_run()\ncached_value = 'x' * 100000 + '0'")
+        assert len(RUNS) == 4
+
+
+@skipIf(numpy is None, "needs numpy")
+def test_cached_numpy(ip):
+    with TemporaryDirectory() as td:
+        _load(ip, td)
+        ip.run_cell("import numpy as np\ncached_input = np.arange(100000.)")
+        cell = "%%cached\ncount_run()\ncached_array = cached_input * 2"
+        ip.run_cell(cell)
+        ip.run_cell("del cached_array")
+        ip.run_cell(cell)
+        assert RUNS == [1]
+        numpy.testing.assert_array_equal(ip.user_ns['cached_array'],
+                                         numpy.arange(100000.) * 2)
+        # the data is written as it is, not as part of the pickle
+        size = os.path.getsize(os.path.join(td, os.listdir(td)[0]))
+        assert size < 800000 + 2000
+
+        ip.run_cell("cached_input[0] = 1")
+        ip.run_cell(cell)
+        assert RUNS == [1, 1]
+
+
+@skipIf(pandas is None, "needs pandas")
+def test_cached_pandas(ip):
+    with TemporaryDirectory() as td:
+        _load(ip, td)
+        ip.run_cell("import pandas as pd\n"
+                    "cached_input = pd.DataFrame({'a': range(1000), 'b': ['x'] * 1000})")
+        cell = "%%cached\ncount_run()\ncached_frame = cached_input.assign(c=cached_input.a * 2)"
+        ip.run_cell(cell)
+        ip.run_cell(cell)
+        assert RUNS == [1]
+        assert list(ip.user_ns['cached_frame'].c[:3]) == [0, 2, 4]
+        ip.run_cell("cached_input.loc[3, 'b'] = 'y'")
+        ip.run_cell(cell)
+        assert RUNS == [1, 1]
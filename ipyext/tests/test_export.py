@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""Tests for the ipyext-export script."""
+
+from __future__ import absolute_import
+
+import io
+import json
+import os
+
+import pytest
+
+from IPython.testing import tools as tt
+from IPython.utils.io import capture_output
+from IPython.utils.tempdir import TemporaryDirectory
+
+from ipyext.export import main, parse_magic_line
+
+
+def write_notebook(path, sources):
+    cells = [{"cell_type": "code", "execution_count": None, "metadata": {},
+              "outputs": [], "source": source.splitlines(True)} for source in sources]
+    cells.insert(1, {"cell_type": "markdown", "metadata": {}, "source": ["# Title"]})
+    nb = {"cells": cells, "metadata": {}, "nbformat": 4, "nbformat_minor": 0}
+    with io.open(path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(nb))
+
+
+def test_parse_magic_line():
+    assert parse_magic_line("-i bla dir/functions") == ('bla', 'dir/functions')
+    assert parse_magic_line("-d -i bla functions.py") == ('bla', 'functions.py')
+    with pytest.raises(ValueError):
+        parse_magic_line("functions.py")
+    with pytest.raises(ValueError):
+        parse_magic_line("-i bla")
+
+
+def test_export_like_magic(ip):
+    with tt.AssertPrints("'writeandexecute' magic loaded"):
+        ip.run_cell("%reload_ext ipyext.writeandexecute")
+
+    sources = [
+        "%%writeandexecute -i one functions\na = 1\n%time b = 2",
+        "print('not exported')",
+        "%%writeandexecute -i two functions.py\ndef f():\n    return 2",
+        "%%writeandexecute -i three functions\nc = 3",
+    ]
+    with TemporaryDirectory() as td:
+        # what the magic writes when running the notebook
+        by_magic = os.path.join(td, 'magic')
+        for source in sources:
+            if source.startswith('%%'):
+                line, cell = source.split('\n', 1)
+                line = line.replace('functions', os.path.join(by_magic, 'functions'))
+                ip.run_cell(line + '\n' + cell)
+
+        nbdir = os.path.join(td, 'notebooks')
+        os.mkdir(nbdir)
+        write_notebook(os.path.join(nbdir, 'nb.ipynb'), sources)
+        with capture_output() as captured:
+            assert main([os.path.join(nbdir, 'nb.ipynb')]) == 0
+        assert ("Wrote %s (one, two, three)" % os.path.join(nbdir, 'functions.py')
+                in captured.stdout)
+
+        with io.open(os.path.join(by_magic, 'functions.py'), encoding='utf-8') as f:
+            expected = f.read()
+        with io.open(os.path.join(nbdir, 'functions.py'), encoding='utf-8') as f:
+            exported = f.read()
+        # the blocks are written at once, so only the blank lines between
+        # them may differ
+        assert ([line for line in exported.splitlines() if line] ==
+                [line for line in expected.splitlines() if line])
+        assert "get_ipython().run_line_magic('time', 'b = 2')" in exported
+
+        # nothing changed on a second run
+        with capture_output() as captured:
+            assert main([os.path.join(nbdir, 'nb.ipynb')]) == 0
+        assert "Unchanged" in captured.stdout
+
+
+def test_export_several_notebooks():
+    with TemporaryDirectory() as td:
+        notebooks = []
+        for i in range(4):
+            path = os.path.join(td, 'nb%s.ipynb' % i)
+            write_notebook(path, ["%%%%writeandexecute -i block%s lib/functions\nx%s = %s" % (i, i, i),
+                                  "%%%%writeandexecute -i shared lib/functions\ny = %s" % i,
+                                  "%%%%writeandexecute -i own other%s\nz = 1" % i])
+            notebooks.append(path)
+        # a broken cell is reported and skipped
+        path = os.path.join(td, 'broken.ipynb')
+        write_notebook(path, ["%%writeandexecute lib/functions\nx = 1"])
+        notebooks.append(path)
+
+        with capture_output() as captured:
+            assert main(['-q', '-j', '3'] + notebooks) == 0
+        assert "Missing indentifier" in captured.stderr
+
+        with io.open(os.path.join(td, 'lib', 'functions.py'), encoding='utf-8') as f:
+            content = f.read()
+        for i in range(4):
+            assert "x%s = %s" % (i, i) in content
+            assert os.path.exists(os.path.join(td, 'other%s.py' % i))
+        # the last notebook wins
+        assert "y = 3" in content
+        assert content.count("# -- ==shared== --") == 2
+
+
+def test_export_unreadable_notebooks():
+    with TemporaryDirectory() as td:
+        good = os.path.join(td, 'good.ipynb')
+        write_notebook(good, ["%%writeandexecute -i one functions\nx = 1"])
+        missing = os.path.join(td, 'missing.ipynb')
+        malformed = os.path.join(td, 'malformed.ipynb')
+        with io.open(malformed, 'w', encoding='utf-8') as f:
+            f.write(u'{"cells": [')
+
+        for jobs in ['1', '3']:
+            with capture_output() as captured:
+                assert main(['-q', '-j', jobs, missing, good, malformed]) == 1
+            assert "Could not read %s" % missing in captured.stderr
+            assert "Could not read %s" % malformed in captured.stderr
+            # the other notebooks are still exported
+            with io.open(os.path.join(td, 'functions.py'), encoding='utf-8') as f:
+                assert "x = 1" in f.read()
@@ -1,15 +1,13 @@
 # -*- coding: utf-8 -*-
 """Tests for various magic functions.
-Needs to be run by nose (to make ipython session available).
+The IPython shell is started by conftest.py.
 """
 
 from __future__ import absolute_import
 
+import glob
 import io
 import os
-import sys
-import warnings
-from unittest import TestCase, skipIf
 
 try:
     from importlib import invalidate_caches   # Required from Python 3.3
@@ -17,20 +15,173 @@ except ImportError:
     def invalidate_caches():
         pass
 
-import nose.tools as nt
-
-from IPython import get_ipython
 from IPython.testing import tools as tt
-from IPython.utils import py3compat
 from IPython.utils.io import capture_output
 
 
-def test_time():
-    ip = get_ipython() 
+def test_time(ip):
     
     with tt.AssertPrints("'inactive' magic loaded"):
         ip.run_cell("%reload_ext ipyext.inactive")
     
     with tt.AssertPrints("Cell inactive: not executed!"):
         with tt.AssertNotPrints("code not run", suppress=False):
-            ip.run_cell("%%inactive\nprint('code not run...')")
\ No newline at end of file
+            ip.run_cell("%%inactive\nprint('code not run...')")
+
+    # other arguments are ignored, as they always were
+    with tt.AssertPrints("Cell inactive: not executed!"):
+        with tt.AssertNotPrints("code not run", suppress=False):
+            ip.run_cell("%%inactive -x too slow for now\nprint('code not run...')")
+    # also the ones which start like -i or -o
+    with tt.AssertPrints("Cell inactive: not executed!"):
+        with tt.AssertNotPrints("code not run", suppress=False):
+            ip.run_cell("%%inactive -ignored -output\nprint('code not run...')")
+
+def test_lazy_names():
+    import ast
+    from ipyext.inactive import _assigned_names
+    tree = ast.parse("import os.path\n"
+                     "from sys import argv as args\n"
+                     "a = b = 1\n"
+                     "c, (d, e) = 1, (2, 3)\n"
+                     "f += 1\n"
+                     "g.attr = h[0] = 1\n"
+                     "def func(x):\n    inner = x\n"
+                     "class Cls(object):\n    member = 1\n"
+                     "for i in range(3):\n    if i:\n        j = i\n"
+                     "squares = [k * k for k in range(3)]\n"
+                     "try:\n    pass\nexcept Exception as err:\n    handled = 1\n"
+                     "with open('x') as fh:\n    pass\n"
+                     "key = lambda y: y\n")
+    assert _assigned_names(tree) == ['os', 'args', 'a', 'b', 'c', 'd', 'e', 'f', 'func',
+                                     'Cls', 'i', 'j', 'squares', 'handled', 'fh', 'key']
+    assert _assigned_names(ast.parse("from os import *")) is None
+
+
+def test_lazy(ip):
+    with tt.AssertPrints("'inactive' magic loaded"):
+        ip.run_cell("%reload_ext ipyext.inactive")
+
+    ip.run_cell("lazy_runs = []\nlazy_count = 10")
+    with tt.AssertPrints("executed when one of these names is used: lazy_data, "
+                         "lazy_count, lazy_func"):
+        with tt.AssertNotPrints("running", suppress=False):
+            ip.run_cell("%%lazy\n"
+                        "print('running')\n"
+                        "lazy_runs.append(1)\n"
+                        "lazy_data = list(range(5))\n"
+                        "lazy_count += 1\n"
+                        "def lazy_func(x):\n"
+                        "    return x * 2")
+    assert ip.user_ns['lazy_runs'] == []
+
+    # the first use runs the cell, which sees the old values
+    with tt.AssertPrints("running", suppress=False):
+        ip.run_cell("lazy_result = len(lazy_data)")
+    assert ip.user_ns['lazy_result'] == 5
+    assert ip.user_ns['lazy_count'] == 11
+    assert ip.user_ns['lazy_runs'] == [1]
+    ip.run_cell("lazy_result = lazy_func(3) + lazy_count")
+    assert ip.user_ns['lazy_result'] == 17
+    assert ip.user_ns['lazy_runs'] == [1]
+
+    # proxies held elsewhere pass everything on to the value
+    ip.run_cell("%%lazy\nlazy_list = [1, 2]")
+    ip.run_cell("lazy_holder = [lazy_list]")
+    ip.run_cell("lazy_result = (lazy_holder[0] + [3], 2 in lazy_holder[0], "
+                "isinstance(lazy_holder[0], list), lazy_holder[0] == [1, 2])")
+    assert ip.user_ns['lazy_result'] == ([1, 2, 3], True, True, True)
+    assert type(ip.user_ns['lazy_list']) is list
+
+    # errors are raised where the name is used, only the first time
+    ip.run_cell("%%lazy\nlazy_error = 1 / 0")
+    with tt.AssertPrints("ZeroDivisionError"):
+        ip.run_cell("lazy_error + 1")
+    with tt.AssertPrints("NameError"):
+        ip.run_cell("lazy_error + 1")
+
+    # %who, %whos and repr() don't run the cell, but showing the value does
+    ip.run_cell("%%lazy\nprint('running')\nlazy_hidden = 12345")
+    with capture_output() as captured:
+        ip.run_cell("%who")
+        ip.run_cell("%whos")
+    assert 'lazy_hidden' not in captured.stdout
+    assert 'running' not in captured.stdout
+    assert repr(ip.user_ns['lazy_hidden']) == "<%%lazy name 'lazy_hidden', not run yet>"
+    with capture_output() as captured:
+        ip.run_cell("lazy_hidden", store_history=True)
+    assert 'running' in captured.stdout
+    assert '12345' in captured.stdout
+    assert 'lazy_hidden' not in ip.user_ns_hidden
+    with tt.AssertPrints("lazy_hidden"):
+        ip.run_cell("%who")
+
+    # names which can't be found make the cell run right away
+    with tt.AssertPrints("from os.path", suppress=False):
+        ip.run_cell("%%lazy\nfrom os.path import *\nprint('from os.path')")
+
+
+def test_inactive_outputs(ip):
+    from IPython.utils.tempdir import TemporaryWorkingDirectory
+
+    with tt.AssertPrints("'inactive' magic loaded"):
+        ip.run_cell("%reload_ext ipyext.inactive")
+
+    def touch(path, mtime):
+        with io.open(path, 'a'):
+            pass
+        os.utime(path, (mtime, mtime))
+
+    cell = ("%%inactive -i data/*.csv -i config.txt -o result.txt -o 'plots/*.png'\n"
+            "print('regenerated')")
+    with TemporaryWorkingDirectory():
+        os.mkdir('data')
+        os.mkdir('plots')
+        touch('data/a.csv', 1000)
+        touch('config.txt', 1000)
+        # missing outputs
+        with tt.AssertPrints("regenerated"):
+            ip.run_cell(cell)
+        touch('result.txt', 2000)
+        with tt.AssertPrints("regenerated"):
+            ip.run_cell(cell)
+        touch('plots/a.png', 2000)
+        with tt.AssertPrints("outputs are up to date"):
+            with tt.AssertNotPrints("regenerated", suppress=False):
+                ip.run_cell(cell)
+        # a changed input, a new input or an old output
+        touch('config.txt', 3000)
+        with tt.AssertPrints("regenerated"):
+            ip.run_cell(cell)
+        touch('config.txt', 1000)
+        with tt.AssertPrints("outputs are up to date"):
+            ip.run_cell(cell)
+        touch('data/b.csv', 3000)
+        with tt.AssertPrints("regenerated"):
+            ip.run_cell(cell)
+        os.unlink('data/b.csv')
+        touch('plots/b.png', 500)
+        with tt.AssertPrints("regenerated"):
+            ip.run_cell(cell)
+
+        # unchanged directories are not globbed again
+        os.unlink('plots/b.png')
+        for directory in ('data', 'plots', '.'):
+            os.utime(directory, (1000, 1000))
+        with tt.AssertPrints("outputs are up to date"):
+            ip.run_cell(cell)
+        glob_calls = []
+        real_glob = glob.glob
+        glob.glob = lambda pattern: glob_calls.append(pattern) or real_glob(pattern)
+        try:
+            with tt.AssertPrints("outputs are up to date"):
+                ip.run_cell(cell)
+        finally:
+            glob.glob = real_glob
+        assert glob_calls == []
+
+        # only outputs
+        with tt.AssertPrints("outputs are up to date"):
+            ip.run_cell("%%inactive -o result.txt\nprint('regenerated')")
+        with tt.AssertPrints("Missing outputs", channel='stderr'):
+            ip.run_cell("%%inactive -i config.txt\nprint('regenerated')")
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""Tests for loading all magics with %load_ext ipyext.
+The IPython shell is started by conftest.py.
+"""
+
+from __future__ import absolute_import
+
+import os
+import subprocess
+import sys
+from importlib import import_module
+from unittest import skipIf
+
+from IPython.testing import tools as tt
+
+import ipyext
+
+# the tests run in a temporary directory, the subprocesses import this ipyext
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(ipyext.__file__)))
+
+_LOAD = """
+import sys
+from IPython.core.interactiveshell import InteractiveShell
+ip = InteractiveShell.instance()
+ip.run_line_magic('load_ext', 'ipyext')
+print(sorted(name for name in sys.modules if name.startswith('ipyext.')))
+ip.run_cell_magic('inactive', '', 'print(1)')
+print(sorted(name for name in sys.modules if name.startswith('ipyext.')))
+"""
+
+
+def test_magics_table():
+    # the stubs must match the real magics
+    for module, classname, line_magics, cell_magics in ipyext._MAGICS:
+        cls = getattr(import_module(module), classname)
+        assert sorted(cls.magics['line']) == sorted(line_magics)
+        assert sorted(cls.magics['cell']) == sorted(cell_magics)
+    assert ([cls.__name__ for cls in ipyext.all_class_magics] ==
+            [classname for module, classname, line, cell in ipyext._MAGICS])
+
+
+def test_stub_docstrings(ip):
+    import inspect
+    for module, classname, line_magics, cell_magics in ipyext._MAGICS:
+        cls = getattr(import_module(module), classname)
+        for kind, names in (('line', line_magics), ('cell', cell_magics)):
+            for name in names:
+                stub = ipyext._Stub(ip, module, classname, kind, name)
+                doc = getattr(cls, cls.magics[kind][name]).__doc__
+                assert stub.__doc__ == doc
+                assert inspect.getdoc(stub) == inspect.cleandoc(doc)
+
+
+def test_load_imports_nothing():
+    out = subprocess.check_output([sys.executable, '-c', _LOAD], cwd=_ROOT).decode('utf-8')
+    lines = out.splitlines()
+    assert lines[0] == "'ipyext' magics loaded."
+    assert lines[1] == "['ipyext._version']"
+    assert lines[2] == "Cell inactive: not executed!"
+    assert lines[3] == "['ipyext._skipdoctest', 'ipyext._version', 'ipyext.inactive']"
+
+
+@skipIf(sys.version_info < (3, 7), "needs python -X importtime")
+def test_import_time():
+    out = subprocess.check_output(
+        [sys.executable, '-X', 'importtime', '-c', 'import IPython.core.magic, ipyext'],
+        stderr=subprocess.STDOUT, cwd=_ROOT).decode('utf-8')
+    # import time: self [us] | cumulative | imported package
+    cumulative = [int(line.split('|')[1]) for line in out.splitlines()
+                  if line.split('|')[-1].strip() == 'ipyext']
+    assert len(cumulative) == 1
+    # with IPython already imported, this should be far below a millisecond
+    assert cumulative[0] < 20000
+
+
+def test_load_ext(ip):
+    ip.run_cell("%unload_ext ipyext")
+    with tt.AssertPrints("'ipyext' magics loaded."):
+        ip.run_cell("%load_ext ipyext")
+    with tt.AssertPrints("Cell inactive: not executed!"):
+        ip.run_cell("%%inactive\nprint('not executed')")
+    with tt.AssertPrints("Cell inactive: not executed!"):
+        ip.run_cell("%%inactive\nprint('not executed')")
+    assert 'InactiveMagics' in ip.magics_manager.registry
+    ip.run_cell("%unload_ext ipyext")
+    assert 'lazy' not in ip.magics_manager.magics['cell']
+    assert 'InactiveMagics' not in ip.magics_manager.registry
+
+    # load -> unload -> load: all magics work again
+    with tt.AssertPrints("'ipyext' magics loaded."):
+        ip.run_cell("%load_ext ipyext")
+    with tt.AssertPrints("Cell inactive: not executed!"):
+        ip.run_cell("%%inactive\nprint('not executed')")
+    # imports and registers the real magics of ipyext.cached (in the test profile)
+    ip.run_cell("%cached_clear")
+    ip.run_cell("%unload_ext ipyext")
+    with tt.AssertPrints("'ipyext' magics loaded."):
+        ip.run_cell("%load_ext ipyext")
+    for kind, name in [('cell', 'inactive'), ('cell', 'lazy'), ('cell', 'cached'),
+                       ('line', 'cached_clear'), ('cell', 'writeandexecute')]:
+        assert name in ip.magics_manager.magics[kind]
+    with tt.AssertPrints("Cell inactive: not executed!"):
+        ip.run_cell("%%inactive\nprint('not executed')")
+    with tt.AssertPrints("Cell lazy"):
+        ip.run_cell("%%lazy\nipyext_lazy = 1")
+    ip.run_cell("%unload_ext ipyext")
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""Tests for the automagics directive of the docs (docs/sphinxext/magics.py).
+"""
+
+from __future__ import absolute_import
+
+import io
+import os
+import sys
+from unittest import skipIf
+
+from IPython.utils.tempdir import TemporaryDirectory
+
+try:
+    import sphinx
+except ImportError:
+    sphinx = None
+
+SPHINXEXT = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))), 'docs', 'sphinxext')
+
+MODULE = '''
+from IPython.core.magic import Magics, magics_class, line_magic, cell_magic
+
+@magics_class
+class FakeMagics(Magics):
+    @line_magic
+    def fake_line%(n)d(self, line):
+        """%(doc)s"""
+
+    @cell_magic
+    def fake_cell%(n)d(self, line, cell):
+        """Docs of the cell magic."""
+
+all_class_magics = [FakeMagics]
+'''
+
+CONF = '''
+import os, sys
+sys.path.insert(0, %r)
+sys.path.insert(0, os.path.abspath('.'))
+extensions = ['magics']
+'''
+
+# more pages than sphinx needs to read them in parallel, each documents the
+# magics of its own module
+PAGES = ['index'] + ['page%d' % i for i in range(6)]
+
+
+def write_module(srcdir, n, doc):
+    with io.open(os.path.join(srcdir, 'fakemagics%d.py' % n), 'w') as f:
+        f.write(MODULE % dict(n=n, doc=doc))
+    sys.modules.pop('fakemagics%d' % n, None)
+
+
+def build(srcdir, parallel=2):
+    """Builds the docs in `srcdir`, returns the app and the pages read."""
+    from sphinx.application import Sphinx
+    read = []
+    app = Sphinx(srcdir, srcdir, os.path.join(srcdir, '_build'),
+                 os.path.join(srcdir, '_build', '.doctrees'), 'html',
+                 status=io.StringIO(), warning=io.StringIO(), parallel=parallel)
+    app.connect('env-before-read-docs', lambda app, env, docnames: read.extend(docnames))
+    app.build()
+    return app, sorted(read)
+
+
+@skipIf(sphinx is None or not os.path.isdir(SPHINXEXT), "needs sphinx and the docs")
+def test_automagics():
+    with TemporaryDirectory() as srcdir:
+        with io.open(os.path.join(srcdir, 'conf.py'), 'w') as f:
+            f.write(CONF % SPHINXEXT)
+        with io.open(os.path.join(srcdir, 'index.rst'), 'w') as f:
+            f.write(u"Index\n=====\n\n.. toctree::\n\n   %s\n" % "\n   ".join(PAGES[1:]))
+        for n, page in enumerate(PAGES[1:]):
+            with io.open(os.path.join(srcdir, page + '.rst'), 'w') as f:
+                f.write(u"%s\n=====\n\n.. automagics:: fakemagics%d\n" % (page, n))
+            write_module(srcdir, n, "First docs of the line magic.")
+        try:
+            app, read = build(srcdir)
+            # declared safe, so nothing keeps sphinx from reading in parallel
+            assert app.is_parallel_allowed('read')
+            assert app.is_parallel_allowed('write')
+            assert app._warning.getvalue() == ''
+            assert read == PAGES
+            # the hashes of the pages read by the workers are merged
+            hashes = app.env.automagics_hashes
+            assert sorted(hashes) == PAGES[1:]
+            assert sorted(hashes['page3']['fakemagics3']) == ['cell fake_cell3', 'line fake_line3']
+            with io.open(os.path.join(srcdir, '_build', 'page3.html'), encoding='utf-8') as f:
+                html = f.read()
+            assert '%fake_line3' in html
+            assert '%%fake_cell3' in html
+            assert 'First docs of the line magic.' in html
+
+            # nothing changed, nothing to read
+            app, read = build(srcdir)
+            assert read == []
+
+            # only the page with the changed magic is read again
+            write_module(srcdir, 3, "Second docs of the line magic.")
+            app, read = build(srcdir)
+            assert read == ['page3']
+            with io.open(os.path.join(srcdir, '_build', 'page3.html'), encoding='utf-8') as f:
+                assert 'Second docs of the line magic.' in f.read()
+        finally:
+            for n in range(len(PAGES) - 1):
+                sys.modules.pop('fakemagics%d' % n, None)
+            sys.modules.pop('magics', None)
@@ -1,15 +1,17 @@
 # -*- coding: utf-8 -*-
 """Tests for various magic functions.
-Needs to be run by nose (to make ipython session available).
+The IPython shell is started by conftest.py.
 """
 
 from __future__ import absolute_import
 
 import io
+import json
 import os
 import sys
-import warnings
-from unittest import TestCase, skipIf
+import time
+import traceback
+from unittest import skipIf
 
 try:
     from importlib import invalidate_caches   # Required from Python 3.3
@@ -17,21 +19,15 @@ except ImportError:
     def invalidate_caches():
         pass
 
-import nose.tools as nt
-
-from IPython import get_ipython
 from IPython.testing import tools as tt
-from IPython.utils import py3compat
 from IPython.utils.io import capture_output
 from IPython.utils.tempdir import TemporaryDirectory
 
-from IPython.core.error import UsageError
-
+# written into the temporary working directory of each test (see conftest.py)
 TF_NAME = "xxx_temp_foo.py"
 
-def test_writeandexecute_basics():
-    ip = get_ipython()
 
+def test_writeandexecute_basics(ip):
     with tt.AssertPrints("'writeandexecute' magic loaded"):
         ip.run_cell("%reload_ext ipyext.writeandexecute")
 
@@ -41,14 +37,12 @@ def test_writeandexecute_basics():
     
     with io.open(TF_NAME, 'r', encoding='utf-8') as tf:
         content = tf.read()
-        nt.assert_in("# -*- coding: utf-8 -*-", content)
-        nt.assert_in("# -- ==bla== --", content)
-        nt.assert_in("print('Hello world')", content)
+        assert "# -*- coding: utf-8 -*-" in content
+        assert "# -- ==bla== --" in content
+        assert "print('Hello world')" in content
     os.unlink(TF_NAME)
 
-def test_writeandexecute_userrrors():
-    ip = get_ipython()
-
+def test_writeandexecute_userrrors(ip):
     with tt.AssertPrints("'writeandexecute' magic loaded"):
         ip.run_cell("%reload_ext ipyext.writeandexecute")
 
@@ -71,12 +65,15 @@ def test_writeandexecute_userrrors():
         with tt.AssertPrints("Missing filename", channel='stderr'):
             ip.run_cell("%%writeandexecute -i bla\nprint('Hello world')")
 
-    nt.assert_false(os.path.exists(TF_NAME))
+    # outputs without a worker process
+    with tt.AssertNotPrints("Hello world"):
+        with tt.AssertPrints('include "-p"', channel='stderr'):
+            ip.run_cell("%%writeandexecute -o a -i bla xxx_temp_foo\nprint('Hello world')")
 
+    assert not os.path.exists(TF_NAME)
 
-def test_writeandexecute_content():
-    ip = get_ipython()
 
+def test_writeandexecute_content(ip):
     with tt.AssertPrints("'writeandexecute' magic loaded"):
         ip.run_cell("%reload_ext ipyext.writeandexecute")
 
@@ -120,4 +117,738 @@ def test_writeandexecute_content():
         # make sure that only the second one got written to the file
         with io.open(TF_NAME, 'r', encoding='utf-8') as tf:
             content = tf.read()
-            nt.assert_in("print('Hello world2')", content)
+            assert "print('Hello world2')" in content
+
+
+def test_writeandexecute_index(ip, monkeypatch):
+    from ipyext import writeandexecute
+    from ipyext.writeandexecute import _scan_markers, _sidecar_path
+
+    with tt.AssertPrints("'writeandexecute' magic loaded"):
+        ip.run_cell("%reload_ext ipyext.writeandexecute")
+    # after the reload, which runs the module again
+    scanned = []
+    scan_file = writeandexecute._scan_file
+    def counting_scan_file(pypath):
+        scanned.append(pypath)
+        return scan_file(pypath)
+    monkeypatch.setattr(writeandexecute, '_scan_file', counting_scan_file)
+    monkeypatch.setattr(writeandexecute, '_is_racy', lambda signature: False)
+    magics = ip.magics_manager.registry['WriteAndExecuteMagics']
+    ip.run_cell("%config WriteAndExecuteMagics.index_sidecar = True")
+    sidecar = _sidecar_path(TF_NAME)
+
+    def check_index():
+        with io.open(TF_NAME, 'rb') as tf:
+            markers = _scan_markers(tf.read())
+        index = magics._block_indexes[os.path.abspath(TF_NAME)]
+        assert index.markers == markers
+        return markers
+
+    try:
+        with tt.make_tempfile(TF_NAME):
+            ip.run_cell("%%writeandexecute -i one xxx_temp_foo\nx = 1")
+            ip.run_cell("%%writeandexecute -i two xxx_temp_foo\ny = 2")
+            ip.run_cell("%%writeandexecute -i one xxx_temp_foo\nx = 'one'\nz = 3")
+            markers = check_index()
+            assert sorted(markers) == ['one', 'two']
+            assert os.path.exists(sidecar)
+            # the file we wrote ourself is never scanned again (the empty
+            # file from make_tempfile is scanned once)
+            assert len(scanned) == 1
+
+            # changes from outside invalidate the index: the stat signature
+            # doesn't match anymore, so the file is scanned again
+            with io.open(TF_NAME, 'r', encoding='utf-8') as tf:
+                content = tf.read()
+            with io.open(TF_NAME, 'w', encoding='utf-8') as tf:
+                tf.write(u"# a new header\n" + content)
+            ip.run_cell("%%writeandexecute -i two xxx_temp_foo\ny = 'two'")
+            assert len(scanned) == 2
+            check_index()
+
+            with io.open(TF_NAME, 'r', encoding='utf-8') as tf:
+                content = tf.read()
+            assert content.startswith("# a new header\n")
+            assert "x = 'one'\nz = 3" in content
+            assert "y = 'two'" in content
+            assert "y = 2" not in content
+            assert content.index("x = 'one'") < content.index("y = 'two'")
+    finally:
+        ip.run_cell("%config WriteAndExecuteMagics.index_sidecar = False")
+        if os.path.exists(sidecar):
+            os.unlink(sidecar)
+
+
+def test_writeandexecute_racy_signature(ip, monkeypatch):
+    from ipyext import writeandexecute
+    from ipyext.writeandexecute import (_BlockIndex, _is_racy, _sidecar_path,
+                                        _stat_signature)
+
+    with tt.AssertPrints("'writeandexecute' magic loaded"):
+        ip.run_cell("%reload_ext ipyext.writeandexecute")
+    magics = ip.magics_manager.registry['WriteAndExecuteMagics']
+
+    ip.run_cell("%%writeandexecute -i one xxx_temp_foo\nx = 1")
+    # a coarse mtime (as on FAT or some network file systems) of just now
+    now = int(time.time()) * 10**9
+    os.utime(TF_NAME, ns=(now, now))
+    assert _is_racy(_stat_signature(TF_NAME))
+    index = magics._get_index(TF_NAME)
+    assert index.racy
+    # not trusted, even though the signature didn't change
+    assert magics._get_index(TF_NAME) is not index
+
+    # neither is a sidecar index with the same racy signature
+    ip.run_cell("%config WriteAndExecuteMagics.index_sidecar = True")
+    try:
+        signature = _stat_signature(TF_NAME)
+        _BlockIndex(signature, {}).save(_sidecar_path(TF_NAME))
+        magics._block_indexes.clear()
+        assert _is_racy(signature)
+        assert list(magics._get_index(TF_NAME).markers) == ['one']
+        # and no sidecar is written for a racy signature
+        os.unlink(_sidecar_path(TF_NAME))
+        with monkeypatch.context() as m:
+            m.setattr(writeandexecute, '_is_racy', lambda signature: True)
+            ip.run_cell("%%writeandexecute -i two xxx_temp_foo\ny = 2")
+        assert not os.path.exists(_sidecar_path(TF_NAME))
+    finally:
+        ip.run_cell("%config WriteAndExecuteMagics.index_sidecar = False")
+
+    # an old coarse mtime or a fine one can be trusted
+    old = now - 10 * 10**9
+    os.utime(TF_NAME, ns=(old, old))
+    assert not _is_racy(_stat_signature(TF_NAME))
+    os.utime(TF_NAME, ns=(now + 123, now + 123))
+    assert not _is_racy(_stat_signature(TF_NAME))
+    index = magics._get_index(TF_NAME)
+    assert magics._get_index(TF_NAME) is index
+
+
+def test_writeandexecute_unchanged(ip):
+    with tt.AssertPrints("'writeandexecute' magic loaded"):
+        ip.run_cell("%reload_ext ipyext.writeandexecute")
+
+    with tt.make_tempfile(TF_NAME):
+        ip.run_cell("%%writeandexecute -i one xxx_temp_foo\nx = 1")
+        ip.run_cell("%%writeandexecute -i two xxx_temp_foo\ny = 2")
+        before = os.stat(TF_NAME)
+
+        # the same content again: executed, but the file is not touched
+        ip.run_cell("y = 0")
+        with tt.AssertPrints("Unchanged, file not written"):
+            ip.run_cell("%%writeandexecute -d -i two xxx_temp_foo\ny = 2")
+        with tt.AssertPrints("y=2"):
+            ip.run_cell("print('y=%s' % y)")
+        after = os.stat(TF_NAME)
+        assert before.st_ino == after.st_ino
+        assert before.st_mtime == after.st_mtime
+
+        # a changed block is written by replacing the whole file
+        with tt.AssertPrints("Wrote cell to file"):
+            ip.run_cell("%%writeandexecute -d -i two xxx_temp_foo\ny = 3")
+        assert before.st_ino != os.stat(TF_NAME).st_ino
+
+        # no temporary files are left behind
+        leftovers = [f for f in os.listdir('.')
+                     if f.startswith('.' + TF_NAME) and f.endswith('.tmp')]
+        assert leftovers == []
+
+
+def test_writeandexecute_buffered(ip):
+    with tt.AssertPrints("'writeandexecute' magic loaded"):
+        ip.run_cell("%reload_ext ipyext.writeandexecute")
+
+    with tt.make_tempfile(TF_NAME):
+        os.unlink(TF_NAME)
+        # buffered cells are executed, but not written
+        with tt.AssertPrints("Hello world1", suppress=False):
+            ip.run_cell("%%writeandexecute -b -i one xxx_temp_foo\nprint('Hello world1')")
+        ip.run_cell("%%writeandexecute -b -i two xxx_temp_foo\nb = 2")
+        ip.run_cell("%%writeandexecute -b -i one xxx_temp_foo\na = 1")
+        assert not os.path.exists(TF_NAME)
+
+        # ... until they are flushed in one go
+        with capture_output() as captured:
+            ip.run_cell("%writeandexecute_flush -d")
+        assert captured.stdout.count("Wrote cell to file") == 1
+        with io.open(TF_NAME, 'r', encoding='utf-8') as tf:
+            content = tf.read()
+        assert "Hello world1" not in content
+        assert content.index("a = 1") < content.index("b = 2")
+
+        # a direct write includes the buffered blocks for the same file
+        ip.run_cell("%%writeandexecute -b -i three xxx_temp_foo\nc = 3")
+        ip.run_cell("%%writeandexecute -i one xxx_temp_foo\na = 'one'")
+        with io.open(TF_NAME, 'r', encoding='utf-8') as tf:
+            content = tf.read()
+        assert "a = 'one'" in content
+        assert "c = 3" in content
+
+        # unloading the extension writes the buffer
+        ip.run_cell("%%writeandexecute -b -i four xxx_temp_foo\nd = 4")
+        ip.run_cell("%reload_ext ipyext.writeandexecute")
+        with io.open(TF_NAME, 'r', encoding='utf-8') as tf:
+            assert "d = 4" in tf.read()
+
+
+def test_writeandexecute_sync(ip):
+    with tt.AssertPrints("'writeandexecute' magic loaded"):
+        ip.run_cell("%reload_ext ipyext.writeandexecute")
+
+    with tt.make_tempfile(TF_NAME):
+        ip.run_cell("sync_runs = []", store_history=True)
+        ip.run_cell("%%writeandexecute -i one xxx_temp_foo\nsync_runs.append(1)", store_history=True)
+        ip.run_cell("%%writeandexecute -i two xxx_temp_foo.py\nb = 2", store_history=True)
+        ip.run_cell("%%writeandexecute -i one xxx_temp_foo\nsync_runs.append(2)\n%time a = 1",
+                    store_history=True)
+        ip.run_cell("%%writeandexecute xxx_temp_foo\nbroken = 1", store_history=True)
+        assert ip.user_ns['sync_runs'] == [1, 2]
+        os.unlink(TF_NAME)
+
+        with capture_output() as captured:
+            ip.run_cell("%writeandexecute_sync")
+        assert "(one, two)" in captured.stdout
+        # nothing was executed
+        assert ip.user_ns['sync_runs'] == [1, 2]
+        with io.open(TF_NAME, 'r', encoding='utf-8') as tf:
+            content = tf.read()
+        assert "sync_runs.append(1)" not in content
+        assert "get_ipython().run_line_magic('time', 'a = 1')" in content
+        assert "broken" not in content
+        assert content.count("# -- ==one== --") == 2
+        assert content.count("# -- ==two== --") == 2
+
+        # an up to date file isn't written again
+        mtime = os.stat(TF_NAME).st_mtime
+        with tt.AssertPrints("Unchanged"):
+            ip.run_cell("%writeandexecute_sync -d")
+        assert os.stat(TF_NAME).st_mtime == mtime
+
+
+try:
+    from multiprocessing import shared_memory   # Required from Python 3.8
+except ImportError:
+    shared_memory = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+@skipIf(not shared_memory, "needs multiprocessing.shared_memory")
+def test_writeandexecute_pool(ip):
+    with tt.AssertPrints("'writeandexecute' magic loaded"):
+        ip.run_cell("%reload_ext ipyext.writeandexecute")
+    ip.run_cell("%config WriteAndExecuteMagics.pool_workers = 2")
+
+    with tt.make_tempfile(TF_NAME):
+        ip.run_cell("%%writeandexecute -i square xxx_temp_foo\ndef square(x):\n    return x * x")
+        # the block runs in a worker, which can import the target file
+        ip.run_cell("%%writeandexecute -p -o a,b -i one xxx_temp_foo\n"
+                    "from xxx_temp_foo import square\n"
+                    "import os\n"
+                    "a = square(4)\n"
+                    "b = os.getpid()")
+        ip.run_cell("%%writeandexecute -p -o c -i two xxx_temp_foo\nc = [3] * 3")
+        with tt.AssertNotPrints("failed"):
+            ip.run_cell("%writeandexecute_wait")
+        assert ip.user_ns['a'] == 16
+        assert ip.user_ns['b'] != os.getpid()
+        assert ip.user_ns['c'] == [3, 3, 3]
+        with io.open(TF_NAME, 'r', encoding='utf-8') as tf:
+            assert "c = [3] * 3" in tf.read()
+
+        # errors come back with the traceback from the worker
+        with tt.AssertPrints("ZeroDivisionError", channel='stderr', suppress=False):
+            ip.run_cell("%%writeandexecute -p -i three xxx_temp_foo\n1/0")
+            ip.run_cell("%writeandexecute_wait")
+        with tt.AssertPrints("name 'missing' is not defined", channel='stderr', suppress=False):
+            ip.run_cell("%%writeandexecute -p -o missing -i three xxx_temp_foo\nx = 1")
+            ip.run_cell("%writeandexecute_wait")
+
+        if numpy is not None:
+            ip.run_cell("%%writeandexecute -p -o small,big -i four xxx_temp_foo\n"
+                        "import numpy as np\n"
+                        "small = np.arange(10)\n"
+                        "big = np.arange(1000000, dtype=float).reshape(1000, 1000)")
+            ip.run_cell("%writeandexecute_wait")
+            numpy.testing.assert_array_equal(ip.user_ns['small'], numpy.arange(10))
+            numpy.testing.assert_array_equal(
+                ip.user_ns['big'], numpy.arange(1000000, dtype=float).reshape(1000, 1000))
+
+        # -l: the line numbers of the target file
+        ip.run_cell("%%writeandexecute -p -l -o line -i five xxx_temp_foo\n"
+                    "import sys\n"
+                    "line = sys._getframe().f_lineno")
+        ip.run_cell("%writeandexecute_wait")
+        with io.open(TF_NAME, 'r', encoding='utf-8') as tf:
+            lines = tf.read().splitlines()
+        assert lines[ip.user_ns['line'] - 1] == "line = sys._getframe().f_lineno"
+
+        # unloading the extension shuts the pool down
+        ip.run_cell("%reload_ext ipyext.writeandexecute")
+
+
+def test_writeandexecute_flush_timeout(ip):
+    with tt.AssertPrints("'writeandexecute' magic loaded"):
+        ip.run_cell("%reload_ext ipyext.writeandexecute")
+
+    ip.run_cell("%config WriteAndExecuteMagics.buffer_writes = True")
+    ip.run_cell("%config WriteAndExecuteMagics.flush_timeout = 0.05")
+    try:
+        with tt.make_tempfile(TF_NAME):
+            os.unlink(TF_NAME)
+            ip.run_cell("%%writeandexecute -i one xxx_temp_foo\na = 1")
+            for i in range(100):
+                if os.path.exists(TF_NAME):
+                    break
+                time.sleep(0.05)
+            with io.open(TF_NAME, 'r', encoding='utf-8') as tf:
+                assert "a = 1" in tf.read()
+    finally:
+        ip.run_cell("%config WriteAndExecuteMagics.buffer_writes = False")
+        ip.run_cell("%config WriteAndExecuteMagics.flush_timeout = 10.0")
+
+
+def test_writeandexecute_async(ip):
+    with tt.AssertPrints("'writeandexecute' magic loaded"):
+        ip.run_cell("%reload_ext ipyext.writeandexecute")
+
+    ip.run_cell("%config WriteAndExecuteMagics.async_writes = True")
+    try:
+        with tt.make_tempfile(TF_NAME):
+            os.unlink(TF_NAME)
+            with tt.AssertPrints("Hello world", suppress=False):
+                ip.run_cell("%%writeandexecute -i one xxx_temp_foo\nprint('Hello world')")
+            ip.run_cell("%%writeandexecute -i two xxx_temp_foo\nb = 2")
+            ip.run_cell("%writeandexecute_wait")
+            with io.open(TF_NAME, 'r', encoding='utf-8') as tf:
+                content = tf.read()
+            assert "print('Hello world')" in content
+            assert "b = 2" in content
+
+            # errors are reported, but the cell is still executed
+            with io.open(TF_NAME, 'a', encoding='utf-8') as tf:
+                tf.write(u"\n# -- ==blub== --\n")
+            with tt.AssertPrints("Found only one line with identifier", channel='stderr'):
+                with tt.AssertPrints("Hello world2", suppress=False):
+                    ip.run_cell("%%writeandexecute -i blub xxx_temp_foo\nprint('Hello world2')")
+                ip.run_cell("%writeandexecute_wait")
+    finally:
+        ip.run_cell("%config WriteAndExecuteMagics.async_writes = False")
+
+
+def test_writeandexecute_execution(ip):
+    with tt.AssertPrints("'writeandexecute' magic loaded"):
+        ip.run_cell("%reload_ext ipyext.writeandexecute")
+
+    with tt.make_tempfile(TF_NAME):
+        # the value of the last expression is displayed
+        with tt.AssertPrints("42"):
+            ip.run_cell("%%writeandexecute -i one xxx_temp_foo\na = 41\na + 1")
+        assert ip.user_ns['a'] == 41
+
+        # exceptions are reported and stop the execution
+        with tt.AssertPrints("ValueError: boom", suppress=False):
+            with tt.AssertNotPrints("not reached!", suppress=False):
+                ip.run_cell("%%writeandexecute -i two xxx_temp_foo\n"
+                            "raise ValueError('boom')\nprint('not reached' + '!')")
+
+        # syntax errors are reported, but the code is still written
+        with tt.AssertPrints("SyntaxError", suppress=False):
+            ip.run_cell("%%writeandexecute -i three xxx_temp_foo\na = (")
+        with io.open(TF_NAME, 'r', encoding='utf-8') as tf:
+            assert "a = (" in tf.read()
+
+        # magics are transformed
+        with tt.AssertPrints("magic=1"):
+            ip.run_cell("%%writeandexecute -i four xxx_temp_foo\n"
+                        "%colors NoColor\nprint('magic=1')")
+
+
+def test_writeandexecute_code_cache(ip):
+    with tt.AssertPrints("'writeandexecute' magic loaded"):
+        ip.run_cell("%reload_ext ipyext.writeandexecute")
+    cache = ip.magics_manager.registry['WriteAndExecuteMagics']._code_cache
+
+    with tt.make_tempfile(TF_NAME):
+        ip.run_cell("%%writeandexecute -i one xxx_temp_foo\na = 1")
+        assert (cache.hits, cache.misses) == (0, 1)
+        with tt.AssertPrints("a=1"):
+            ip.run_cell("%%writeandexecute -i one xxx_temp_foo\na = 1\nprint('a=%s' % a)")
+        with tt.AssertPrints("a=1"):
+            ip.run_cell("%%writeandexecute -i one xxx_temp_foo\na = 1\nprint('a=%s' % a)")
+        assert (cache.hits, cache.misses) == (1, 2)
+        # same code, but another identifier
+        ip.run_cell("%%writeandexecute -i two xxx_temp_foo\na = 1")
+        assert (cache.hits, cache.misses) == (1, 3)
+
+        # the traceback of a cached cell names the current cell
+        cell = "%%writeandexecute -i three xxx_temp_foo\ndef f():\n    1/0\nf()"
+        for i in range(2):
+            with capture_output() as captured:
+                ip.run_cell(cell, store_history=True)
+            # in the frames of the cell and of the function defined in it
+            assert captured.stdout.count("Cell In[%d]" % (ip.execution_count - 1)) == 2
+        assert (cache.hits, cache.misses) == (2, 4)
+
+        # the cache is limited by size
+        ip.run_cell("%config WriteAndExecuteMagics.code_cache_size = 1")
+        try:
+            ip.run_cell("%%writeandexecute -i one xxx_temp_foo\na = 2")
+            assert cache.size == 0
+        finally:
+            ip.run_cell("%config WriteAndExecuteMagics.code_cache_size = 33554432")
+
+
+def test_writeandexecute_write_pyc(ip):
+    try:
+        from importlib.util import cache_from_source
+    except ImportError:
+        cache_from_source = lambda path: path + 'c'
+
+    with tt.AssertPrints("'writeandexecute' magic loaded"):
+        ip.run_cell("%reload_ext ipyext.writeandexecute")
+
+    pyc = cache_from_source(os.path.abspath(TF_NAME))
+    ip.run_cell("%config WriteAndExecuteMagics.write_pyc = True")
+    try:
+        with tt.make_tempfile(TF_NAME):
+            ip.run_cell("%%writeandexecute -i one xxx_temp_foo\na = 1")
+            assert os.path.exists(pyc)
+    finally:
+        ip.run_cell("%config WriteAndExecuteMagics.write_pyc = False")
+        if os.path.exists(pyc):
+            os.unlink(pyc)
+
+
+def test_writeandexecute_hot_patch(ip):
+    with tt.AssertPrints("'writeandexecute' magic loaded"):
+        ip.run_cell("%reload_ext ipyext.writeandexecute")
+
+    with TemporaryDirectory() as td:
+        modname = 'xxx_temp_hotpatch'
+        target = os.path.join(td, modname)
+        sys.path.insert(0, td)
+        ip.run_cell("%config WriteAndExecuteMagics.hot_patch = True")
+        try:
+            ip.run_cell("%%writeandexecute -i cls " + target + "\nclass A(object):\n    pass")
+            ip.run_cell("%%writeandexecute -i func " + target + "\ndef f():\n    return 1")
+            invalidate_caches()
+            module = __import__(modname)
+            A = module.A
+            assert module.f() == 1
+
+            # only the changed block is run in the module
+            with tt.AssertPrints("Updating module %s with block func" % modname):
+                with tt.AssertNotPrints("block cls", suppress=False):
+                    ip.run_cell("%%writeandexecute -d -i cls " + target + "\nclass A(object):\n    pass")
+                    ip.run_cell("%%writeandexecute -d -i func " + target + "\ndef f():\n    return 2")
+            assert module.f() == 2
+            assert module.A is A
+        finally:
+            ip.run_cell("%config WriteAndExecuteMagics.hot_patch = False")
+            sys.path.remove(td)
+            sys.modules.pop(modname, None)
+
+
+def test_writeandexecute_file_line_numbers(ip):
+    with tt.AssertPrints("'writeandexecute' magic loaded"):
+        ip.run_cell("%reload_ext ipyext.writeandexecute")
+
+    two = "%%writeandexecute -l -i two xxx_temp_foo\nx = 2\n\ndef two():\n    return 1 / 0"
+    with tt.make_tempfile(TF_NAME):
+        ip.run_cell("%%writeandexecute -i one xxx_temp_foo\ndef one():\n    return 1")
+        ip.run_cell(two)
+        with io.open(TF_NAME, 'r', encoding='utf-8') as tf:
+            lines = tf.read().splitlines()
+        code = ip.user_ns['two'].__code__
+        assert code.co_filename == os.path.abspath(TF_NAME)
+        assert lines[code.co_firstlineno - 1] == "def two():"
+        # tracebacks point into the file
+        try:
+            ip.user_ns['two']()
+        except ZeroDivisionError:
+            frame = traceback.extract_tb(sys.exc_info()[2])[-1]
+        assert frame[1] == lines.index("    return 1 / 0") + 1
+        assert frame[3] == "return 1 / 0"
+        # without -l, the block is a cell
+        assert ip.user_ns['one'].__code__.co_filename != os.path.abspath(TF_NAME)
+
+        # the file is written right away, also the buffered block before it
+        ip.run_cell("%%writeandexecute -b -i one xxx_temp_foo\n# two\n# more lines\n"
+                    "def one():\n    return 1")
+        ip.run_cell("%config WriteAndExecuteMagics.buffer_writes = True")
+        try:
+            ip.run_cell(two.replace(" -l", ""))
+            assert ip.user_ns['two'].__code__.co_filename != os.path.abspath(TF_NAME)
+            ip.run_cell("%config WriteAndExecuteMagics.file_line_numbers = True")
+            ip.run_cell(two.replace(" -l", ""))
+        finally:
+            ip.run_cell("%config WriteAndExecuteMagics.buffer_writes = False")
+            ip.run_cell("%config WriteAndExecuteMagics.file_line_numbers = False")
+        with io.open(TF_NAME, 'r', encoding='utf-8') as tf:
+            lines = tf.read().splitlines()
+        assert "# more lines" in lines
+        code = ip.user_ns['two'].__code__
+        assert lines[code.co_firstlineno - 1] == "def two():"
+
+
+def test_writeandexecute_sqlite_store(ip):
+    import sqlite3
+
+    with tt.AssertPrints("'writeandexecute' magic loaded"):
+        ip.run_cell("%reload_ext ipyext.writeandexecute")
+
+    # a store which doesn't override save_blocks writes into the file
+    from ipyext.writeandexecute import BlockStore
+    store = BlockStore(parent=ip.magics_manager.registry['WriteAndExecuteMagics'])
+    assert store.save_blocks('xxx_temp_bar.py', {'one': u'a = 1\n'}) == ['one']
+    with io.open('xxx_temp_bar.py', 'r', encoding='utf-8') as tf:
+        assert "# -- ==one== --\na = 1\n" in tf.read()
+
+    db = os.path.abspath('blocks.sqlite')
+    ip.run_cell("%%config SQLiteBlockStore.path = %r" % db)
+    ip.run_cell("%config WriteAndExecuteMagics.store_class = "
+                "'ipyext.writeandexecute.SQLiteBlockStore'")
+    try:
+        with open(TF_NAME, 'w') as tf:
+            tf.write("# written by hand\n")
+        ip.run_cell("%%writeandexecute -i one xxx_temp_foo\na = 1")
+        ip.run_cell("%%writeandexecute -i two xxx_temp_foo\nb = 2")
+        assert ip.user_ns['b'] == 2
+        # the file is written after each cell, in the usual format
+        with io.open(TF_NAME, 'r', encoding='utf-8') as tf:
+            content = tf.read()
+        assert content.startswith("# written by hand\n")
+        assert "# -- ==one== --\na = 1\n\n# -- ==one== --" in content
+        assert content.index("a = 1") < content.index("b = 2")
+        rows = sqlite3.connect(db).execute(
+            "SELECT file, identifier, content, dirty FROM blocks ORDER BY id").fetchall()
+        assert rows == [(os.path.abspath(TF_NAME), 'one', 'a = 1\n', 0),
+                        (os.path.abspath(TF_NAME), 'two', 'b = 2\n', 0)]
+
+        # an unchanged block doesn't touch the file
+        before = os.stat(TF_NAME)
+        with tt.AssertPrints("Unchanged, file not written"):
+            ip.run_cell("%%writeandexecute -d -i one xxx_temp_foo\na = 1")
+        assert os.stat(TF_NAME).st_ino == before.st_ino
+        # but a block which was edited in the file is written again
+        with io.open(TF_NAME, 'r', encoding='utf-8') as tf:
+            content = tf.read()
+        with io.open(TF_NAME, 'w', encoding='utf-8') as tf:
+            tf.write(content.replace("a = 1\n", "a = 'edited'\n"))
+        ip.run_cell("%%writeandexecute -i one xxx_temp_foo\na = 1")
+        with io.open(TF_NAME, 'r', encoding='utf-8') as tf:
+            assert tf.read() == content
+
+        # on demand, the file is written on flush, for -l and on exit
+        ip.run_cell("%config SQLiteBlockStore.write_files = 'demand'")
+        ip.run_cell("%%writeandexecute -i one xxx_temp_foo\na = 'one'")
+        ip.run_cell("%%writeandexecute -i three xxx_temp_foo\nc = 3")
+        with io.open(TF_NAME, 'r', encoding='utf-8') as tf:
+            content = tf.read()
+        assert "a = 'one'" not in content
+        assert "c = 3" not in content
+        ip.run_cell("%writeandexecute_flush")
+        with io.open(TF_NAME, 'r', encoding='utf-8') as tf:
+            content = tf.read()
+        assert "a = 'one'" in content
+        assert "c = 3" in content
+        ip.run_cell("%%writeandexecute -i two xxx_temp_foo\nb = 'two'")
+        ip.run_cell("%%writeandexecute -l -i four xxx_temp_foo\nd = 4")
+        with io.open(TF_NAME, 'r', encoding='utf-8') as tf:
+            content = tf.read()
+        assert "b = 'two'" in content
+        assert "d = 4" in content
+
+        # a missing file is written with all blocks
+        os.unlink(TF_NAME)
+        ip.run_cell("%%writeandexecute -i five xxx_temp_foo\ne = 5")
+        ip.run_cell("%reload_ext ipyext.writeandexecute")
+        with io.open(TF_NAME, 'r', encoding='utf-8') as tf:
+            content = tf.read()
+        for line in ["a = 'one'", "b = 'two'", "c = 3", "d = 4", "e = 5"]:
+            assert line in content
+    finally:
+        ip.run_cell("%config WriteAndExecuteMagics.store_class = "
+                    "'ipyext.writeandexecute.FileBlockStore'")
+        ip.run_cell("%config SQLiteBlockStore.write_files = 'commit'")
+        ip.run_cell("%reload_ext ipyext.writeandexecute")
+
+
+def wait_for_changes(magics, count, timeout=10):
+    deadline = time.time() + timeout
+    while len(magics._watch_changes) < count and time.time() < deadline:
+        time.sleep(0.01)
+    return len(magics._watch_changes)
+
+
+def test_writeandexecute_watch(ip):
+    with tt.AssertPrints("'writeandexecute' magic loaded"):
+        ip.run_cell("%reload_ext ipyext.writeandexecute")
+    magics = ip.magics_manager.registry['WriteAndExecuteMagics']
+    ip.run_cell("%config WriteAndExecuteMagics.watch_interval = 0.01")
+
+    try:
+        ip.run_cell("watch_runs = []")
+        ip.run_cell("%%writeandexecute -i one xxx_temp_foo\nwatch_runs.append('one')")
+        with tt.AssertPrints("Watching all target files (1 so far)"):
+            ip.run_cell("%writeandexecute_watch")
+        ip.run_cell("%%writeandexecute -i two xxx_temp_foo\nwatch_runs.append('two')")
+        # a new target file is watched, too
+        ip.run_cell("%%writeandexecute -i three xxx_temp_bar\nwatch_runs.append('three')")
+        # our own writes are not run again
+        time.sleep(0.1)
+        assert wait_for_changes(magics, 1, timeout=0) == 0
+        ip.run_cell("pass")
+        assert ip.user_ns['watch_runs'] == ['one', 'two', 'three']
+
+        # only the changed blocks are run, before the next cell
+        with io.open(TF_NAME, 'r', encoding='utf-8') as tf:
+            content = tf.read()
+        content = content.replace("watch_runs.append('two')",
+                                  "watch_runs.append('TWO')\n1/0")
+        content += "\n# -- ==four== --\nwatch_runs.append('four')\n# -- ==four== --\n"
+        with io.open(TF_NAME, 'w', encoding='utf-8') as tf:
+            tf.write(content)
+        assert wait_for_changes(magics, 2) == 2
+        assert ip.user_ns['watch_runs'] == ['one', 'two', 'three']
+        with capture_output() as captured:
+            ip.run_cell("watch_runs.append('cell')")
+        assert "Running changed code block two of %s" % os.path.abspath(TF_NAME) in captured.stdout
+        assert ip.user_ns['watch_runs'] == ['one', 'two', 'three', 'TWO', 'four', 'cell']
+        # with the line numbers of the file
+        lineno = content.splitlines().index("1/0") + 1
+        assert "%s:%d" % (TF_NAME, lineno) in captured.stdout
+        ip.run_cell("pass")
+        assert ip.user_ns['watch_runs'] == ['one', 'two', 'three', 'TWO', 'four', 'cell']
+
+        # the changed block runs before the cell which writes it again
+        with io.open(TF_NAME, 'w', encoding='utf-8') as tf:
+            tf.write(content.replace("watch_runs.append('four')", "watch_runs.append('FOUR')"))
+        assert wait_for_changes(magics, 1) == 1
+        ip.run_cell("%%writeandexecute -i four xxx_temp_foo\nwatch_runs.append('4')")
+        assert ip.user_ns['watch_runs'][-3:] == ['cell', 'FOUR', '4']
+        time.sleep(0.1)
+        ip.run_cell("pass")
+        assert ip.user_ns['watch_runs'][-1] == '4'
+
+        with tt.AssertPrints("Stopped watching files"):
+            ip.run_cell("%writeandexecute_watch -s")
+        with io.open(TF_NAME, 'a', encoding='utf-8') as tf:
+            tf.write(u"\n# -- ==five== --\nwatch_runs.append('five')\n# -- ==five== --\n")
+        time.sleep(0.1)
+        ip.run_cell("pass")
+        assert ip.user_ns['watch_runs'][-1] == '4'
+
+        # only the given files
+        with tt.AssertPrints("Watching file: %s" % os.path.abspath("xxx_temp_bar.py")):
+            ip.run_cell("%writeandexecute_watch -d xxx_temp_bar")
+        assert list(magics._watched) == [os.path.abspath('xxx_temp_bar.py')]
+    finally:
+        ip.run_cell("%config WriteAndExecuteMagics.watch_interval = 1.0")
+        ip.run_cell("%reload_ext ipyext.writeandexecute")
+    assert magics._watcher is None
+
+
+def test_writeandexecute_chunked_copy(ip):
+    from ipyext import writeandexecute
+
+    with tt.AssertPrints("'writeandexecute' magic loaded"):
+        ip.run_cell("%reload_ext ipyext.writeandexecute")
+
+    # use tiny chunks, so that markers and blocks span several of them
+    chunk_size = writeandexecute._CHUNK_SIZE
+    writeandexecute._CHUNK_SIZE = 7
+    try:
+        with tt.make_tempfile(TF_NAME):
+            for i in range(5):
+                ip.run_cell("%%%%writeandexecute -i block%s xxx_temp_foo\nx%s = %s" % (i, i, i))
+            ip.run_cell("%%writeandexecute -i block2 xxx_temp_foo\nx2 = 'two'")
+            with io.open(TF_NAME, 'a', encoding='utf-8') as tf:
+                tf.write(u"\n# -- ==block3== --\n")
+            with tt.AssertPrints("Found more than two lines with identifier '# -- ==block3== --' "
+                                 "in file 'xxx_temp_foo.py' in line 37", suppress=False):
+                ip.run_cell("%%writeandexecute -i block3 xxx_temp_foo\nx3 = 'three'")
+            with io.open(TF_NAME, 'r', encoding='utf-8') as tf:
+                content = tf.read()
+    finally:
+        writeandexecute._CHUNK_SIZE = chunk_size
+
+    expected = [u"x0 = 0", u"x1 = 1", u"x2 = 'two'", u"x3 = 3", u"x4 = 4"]
+    assert [l for l in content.splitlines() if l.startswith("x")] == expected
+
+
+_CONCURRENT_WRITER = """
+import sys
+sys.path.insert(0, %r)
+from ipyext.writeandexecute import WriteAndExecuteMagics
+magics = WriteAndExecuteMagics()
+for i in range(10):
+    magics._save_to_file(%r, 'w%%s_%%s' %% (%s, i), 'x = %%s\\n' %% i)
+for i in range(10):
+    magics._save_to_file(%r, 'w%%s_%%s' %% (%s, i), 'x = %%s\\n' %% (i + 100))
+"""
+
+
+def test_writeandexecute_concurrent_writers():
+    import subprocess
+    import ipyext
+    from ipyext.writeandexecute import _scan_markers
+    root = os.path.dirname(os.path.dirname(os.path.abspath(ipyext.__file__)))
+
+    with TemporaryDirectory() as td:
+        target = os.path.join(td, 'shared.py')
+        writers = [subprocess.Popen([sys.executable, '-c',
+                                     _CONCURRENT_WRITER % (root, target, n, target, n)])
+                   for n in range(16)]
+        for writer in writers:
+            assert writer.wait() == 0
+
+        with io.open(target, 'rb') as tf:
+            data = tf.read()
+        markers = _scan_markers(data)
+        assert len(markers) == 160
+        for identifier, offsets in markers.items():
+            assert len(offsets) == 2
+            block = data[offsets[0][1]:offsets[1][0]].decode('utf-8')
+            assert block.strip() == 'x = 1%02d' % int(identifier.split('_')[1])
+        # the lock file is removed after each write
+        assert sorted(os.listdir(td)) == ['shared.py']
+
+
+def test_writeandexecute_stats(ip):
+    with tt.AssertPrints("'writeandexecute' magic loaded"):
+        ip.run_cell("%reload_ext ipyext.writeandexecute")
+
+    with tt.make_tempfile(TF_NAME):
+        with tt.AssertPrints("Timing for bla in xxx_temp_foo.py: parse"):
+            ip.run_cell("%%writeandexecute -t -i bla xxx_temp_foo\na = 1")
+        ip.run_cell("%%writeandexecute -i bla xxx_temp_foo\na = 2")
+        ip.run_cell("%%writeandexecute -i blub xxx_temp_foo\nb = 1")
+
+        with capture_output() as captured:
+            ip.run_cell("%writeandexecute_stats")
+        table = captured.stdout.splitlines()
+        assert table[0].split() == ['file', 'identifier', 'phase', 'count',
+                                    'total', '[s]', 'p50', '[ms]', 'p95', '[ms]']
+        total_bla = [l.split() for l in table if 'bla' in l and 'total' in l]
+        assert total_bla[0][:4] == [TF_NAME, 'bla', 'total', '2']
+
+        with capture_output() as captured:
+            ip.run_cell("%writeandexecute_stats -j -r")
+        rows = json.loads(captured.stdout)
+        phases = set(row['phase'] for row in rows if row['identifier'] == 'blub')
+        for phase in ['transform', 'scan', 'write', 'compile', 'run', 'total']:
+            assert phase in phases
+        for row in rows:
+            assert 0 <= row['p50'] <= row['p95'] <= row['total']
+
+        # -r resets the statistics
+        with capture_output() as captured:
+            ip.run_cell("%writeandexecute_stats -j")
+        assert json.loads(captured.stdout) == []
@@ -4,19 +4,938 @@
 # Copyright (c) IPython-extensions Development Team.
 # Distributed under the terms of the Modified BSD License.
 
+from __future__ import print_function
+
 import os
 import io
+import ast
+import errno
+import json
+import mmap
+import inspect
+import marshal
+import hashlib
+import shutil
+import sys
+import time
+import random
+import atexit
+import tempfile
+import threading
+import types
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+try:
+    from importlib import invalidate_caches
+except ImportError:  # Python 2
+    def invalidate_caches():
+        pass
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
 
 from IPython.utils import py3compat
 
-from IPython.core.magic import (Magics, magics_class, cell_magic)
-from IPython.testing.skipdoctest import skip_doctest
-from IPython.core.error import UsageError
+from IPython.core.magic import (Magics, magics_class, cell_magic, line_magic)
+from IPython.core.error import UsageError, InputRejected
+from traitlets import Bool, Enum, Float, Integer, Type, Unicode
+from traitlets.config.configurable import Configurable
+
+from ._skipdoctest import skip_doctest
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:
+    _replace = os.replace
+except AttributeError:
+    # Python 2: rename is only atomic (and only works on existing files) on POSIX
+    _replace = os.rename
+
+# getopt options of %%writeandexecute, also used by ipyext.export
+_MAGIC_OPTIONS = 'i:dbtplo:'
+
+_FILE_HEADER = b'# -*- coding: utf-8 -*-\n\n\n'
+_CHUNK_SIZE = 1 << 20
+# seconds to wait before the first retry of a write which lost against a
+# concurrent write, doubled for every further retry
+_RETRY_DELAY = 0.002
+_MAX_RETRY_DELAY = 0.25
+
+_clock = getattr(time, 'perf_counter', time.time)
+# there are no coroutines (and no IPython which returns them) before Python 3.5
+_iscoroutine = getattr(inspect, 'iscoroutine', lambda obj: False)
+# numpy arrays from a worker process which are at least that large (in bytes)
+# are passed through shared memory instead of being pickled
+_SHARED_MEMORY_MIN_SIZE = 1 << 20
+# number of timings per file, identifier and phase kept for the percentiles
+_MAX_TIMINGS = 1000
+# files with a coarse mtime which changed less than that many seconds ago
+# could change again without a new signature
+_RACY_SECONDS = 2
+
+# in-process part of the file locks: the OS locks are per process
+_swap_lock = threading.Lock()
+
+# the umask can only be read by setting it, which is not safe while other
+# threads create files, so read it once while the module is imported
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+class _ConcurrentWrite(Exception):
+    """The target file was changed while we prepared the new version."""
+
+
+_MARKER_PREFIX = b'# -- =='
+_MARKER_SUFFIX = b'== --'
+
+
+def _code_identifier(identifier):
+    return u"# -- ==%s== --" % identifier
+
+
+def _split_magic_cell(source):
+    """Returns ``(line, cell)`` of a `%%writeandexecute` cell, or None if
+    `source` is something else."""
+    source = source.lstrip()
+    line, _, cell = source.partition('\n')
+    magic_name, _, line = line.partition(' ')
+    if magic_name != '%%writeandexecute':
+        return None
+    return line, cell
+
+
+def _stat_signature(pypath):
+    """Returns ``(mtime, size, inode, ctime)`` of `pypath`.
+
+    A changed signature means the file was changed since we last looked at
+    it and any cached information about its content is stale. An unchanged
+    signature can only be trusted if it isn't racy (see `_is_racy`).
+    """
+    return _signature(os.stat(pypath))
+
+
+def _signature(st):
+    mtime = getattr(st, 'st_mtime_ns', None)
+    if mtime is None:  # Python 2
+        mtime = int(st.st_mtime * 1e9)
+    ctime = getattr(st, 'st_ctime_ns', None)
+    if ctime is None:
+        ctime = int(st.st_ctime * 1e9)
+    return [mtime, st.st_size, st.st_ino, ctime]
+
+
+def _is_racy(signature):
+    """Tells if the file could be changed without changing `signature`
+    (taken just now).
+
+    On file systems with a coarse mtime (whole milliseconds or worse), a
+    change in the same tick keeps the mtime and a replaced file can get the
+    inode of the old one, with the same size. This can only happen shortly
+    after the last change.
+    """
+    mtime = signature[0]
+    return mtime % 1000000 == 0 and mtime > (time.time() - _RACY_SECONDS) * 1e9
+
+
+def _digest(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def _write_temp(pypath, chunks, fsync=True):
+    """Writes `chunks` (bytes) to a new temporary file next to `pypath` and
+    returns its path.
+
+    Use `_commit_temp` to move it over `pypath`.
+    """
+    d, name = os.path.split(os.path.realpath(pypath))
+    fd, tmppath = tempfile.mkstemp(dir=d, prefix='.%s.' % name, suffix='.tmp')
+    try:
+        with io.open(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
+    except BaseException:
+        os.unlink(tmppath)
+        raise
+    return tmppath
+
+
+def _commit_temp(tmppath, pypath):
+    """Atomically replaces `pypath` by the temporary file `tmppath`, keeping
+    the permissions of `pypath`."""
+    pypath = os.path.realpath(pypath)
+    if os.path.exists(pypath):
+        shutil.copymode(pypath, tmppath)
+    else:
+        os.chmod(tmppath, 0o666 & ~_UMASK)
+    _replace(tmppath, pypath)
+
+
+def _atomic_write(pypath, chunks, fsync=True):
+    """Writes `chunks` (bytes) to `pypath` without ever exposing a partially
+    written file."""
+    tmppath = _write_temp(pypath, chunks, fsync=fsync)
+    try:
+        _commit_temp(tmppath, pypath)
+    except BaseException:
+        os.unlink(tmppath)
+        raise
+
+
+def _lock_path(pypath):
+    d, name = os.path.split(os.path.realpath(pypath))
+    return os.path.join(d, '.%s.lock' % name)
+
+
+@contextmanager
+def _file_lock(pypath):
+    """Holds an exclusive lock for `pypath` (an advisory lock on a lock file
+    next to it, if `fcntl` is available).
+
+    All processes using `%%writeandexecute` only hold this lock to check
+    that the file is unchanged and to swap in the new version. The lock
+    file is removed by the holder before it releases the lock.
+    """
+    with _swap_lock:
+        if fcntl is None:
+            yield
+            return
+        path = _lock_path(pypath)
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX)
+                # the previous holder may have removed the file while we
+                # waited, then another process can lock a new one
+                held = os.fstat(fd)
+                current = os.stat(path)
+            except OSError as e:
+                os.close(fd)
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            except BaseException:
+                os.close(fd)
+                raise
+            if (held.st_ino, held.st_dev) == (current.st_ino, current.st_dev):
+                break
+            os.close(fd)
+        try:
+            yield
+        finally:
+            os.unlink(path)
+            # closing the file releases the lock
+            os.close(fd)
+
+
+def _run_sync(value):
+    """Returns the result of `value`, driving it to completion if it is a
+    coroutine (`run_code` is a coroutine function in IPython >= 7)."""
+    if not _iscoroutine(value):
+        return value
+    try:
+        value.send(None)
+    except StopIteration as e:
+        return e.value
+    raise RuntimeError("%%writeandexecute can't run code which awaits")
+
+
+def _split_interactive(nodes, interactivity):
+    """Splits `nodes` into the nodes to run in 'exec' mode and the ones to
+    run in 'single' mode (which displays the values of expressions).
+
+    Mirrors what `InteractiveShell.run_ast_nodes` does for the given
+    `interactivity`.
+    """
+    if not nodes:
+        return [], []
+    if interactivity == 'last_expr_or_assign':
+        last = nodes[-1]
+        target = None
+        if isinstance(last, ast.Assign) and len(last.targets) == 1:
+            target = last.targets[0]
+        elif isinstance(last, (ast.AugAssign, getattr(ast, 'AnnAssign', ast.AugAssign))):
+            target = last.target
+        if isinstance(target, ast.Name):
+            expr = ast.Expr(ast.Name(target.id, ast.Load()))
+            ast.fix_missing_locations(expr)
+            nodes = nodes + [expr]
+        interactivity = 'last_expr'
+    if interactivity == 'last_expr':
+        interactivity = 'last' if isinstance(nodes[-1], ast.Expr) else 'none'
+    if interactivity == 'none':
+        return nodes, []
+    elif interactivity == 'last':
+        return nodes[:-1], nodes[-1:]
+    elif interactivity == 'all':
+        return [], nodes
+    raise ValueError("Interactivity was %r" % interactivity)
+
+
+class _CodeCache(object):
+    """A LRU cache of compiled code, limited by the (marshalled) size of the
+    cached code objects in bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        # re-insert to mark it as most recently used
+        self._entries[key] = entry
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, code):
+        size = sum(len(marshal.dumps(c)) for c in code)
+        if key in self._entries:
+            self.size -= self._entries.pop(key)[1]
+        if size <= self.max_bytes:
+            self._entries[key] = (code, size)
+            self.size += size
+        while self.size > self.max_bytes:
+            old_key, (old_code, old_size) = self._entries.popitem(last=False)
+            self.size -= old_size
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+
+def _find_module(pypath):
+    """Returns the imported module which was loaded from `pypath` or None."""
+    stem = os.path.splitext(os.path.basename(pypath))[0]
+    realpath = None
+    for module in list(sys.modules.values()):
+        filename = getattr(module, '__file__', None)
+        if not filename or os.path.splitext(os.path.basename(filename))[0] != stem:
+            continue
+        if realpath is None:
+            realpath = os.path.realpath(pypath)
+        if os.path.realpath(os.path.splitext(filename)[0] + '.py') == realpath:
+            return module
+    return None
+
+
+def _scan_file(pypath):
+    """Like `_scan_markers`, but for a file, which is mapped into memory
+    instead of being read."""
+    with io.open(pypath, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            # empty files can't be mapped
+            return {}
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return _scan_markers(data)
+        finally:
+            data.close()
+
+
+def _read_range(f, start, end):
+    """Yields the content of the open file `f` between `start` and `end`
+    (None: up to the end of the file) in chunks."""
+    f.seek(start)
+    while end is None or start < end:
+        size = _CHUNK_SIZE if end is None else min(_CHUNK_SIZE, end - start)
+        chunk = f.read(size)
+        if not chunk:
+            break
+        start += len(chunk)
+        yield chunk
+
+
+def _count_lines(pypath, end):
+    """Returns the line number of the byte offset `end` in `pypath`."""
+    with io.open(pypath, 'rb') as f:
+        return sum(chunk.count(b'\n') for chunk in _read_range(f, 0, end)) + 1
+
+
+def _splice_file(f, splices):
+    """Yields the content of the open file `f` (None: an empty file) with
+    the ``(start, end, replacement)`` `splices` (sorted by `start`) applied.
+
+    Unchanged parts are copied from the original file in chunks, so only the
+    replacements are kept in memory.
+    """
+    pos = 0
+    for start, end, replacement in splices:
+        if f is not None:
+            for chunk in _read_range(f, pos, start):
+                yield chunk
+        yield replacement
+        pos = end
+    if f is not None:
+        for chunk in _read_range(f, pos, None):
+            yield chunk
+
+
+class _SharedArray(object):
+    """A numpy array which a worker process put into shared memory."""
+
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+    @classmethod
+    def share(cls, value):
+        """Returns a `_SharedArray` for large numpy arrays and `value`
+        itself for everything else."""
+        numpy = sys.modules.get('numpy')
+        if (numpy is None or type(value) is not numpy.ndarray or
+                value.dtype.hasobject or value.nbytes < _SHARED_MEMORY_MIN_SIZE):
+            return value
+        try:
+            from multiprocessing import shared_memory
+        except ImportError:  # Python < 3.8
+            return value
+        shm = shared_memory.SharedMemory(create=True, size=value.nbytes)
+        try:
+            view = numpy.ndarray(value.shape, value.dtype, buffer=shm.buf)
+            view[...] = value
+            del view
+        finally:
+            shm.close()
+        return cls(shm.name, value.shape, value.dtype)
+
+    def load(self):
+        """Returns the array and frees the shared memory."""
+        import numpy
+        from multiprocessing import shared_memory
+        shm = shared_memory.SharedMemory(name=self.name)
+        try:
+            view = numpy.ndarray(self.shape, self.dtype, buffer=shm.buf)
+            value = view.copy()
+            del view
+        finally:
+            shm.close()
+            shm.unlink()
+        return value
+
+
+def _compile_block(code_content, filename, lineno=1):
+    """Compiles a code block as code of `filename`, starting at `lineno`."""
+    tree = compile(code_content, filename, 'exec', ast.PyCF_ONLY_AST, dont_inherit=True)
+    if lineno > 1:
+        ast.increment_lineno(tree, lineno - 1)
+    return compile(tree, filename, 'exec', dont_inherit=True)
+
+
+def _with_filename(code, filename):
+    """Returns `code` and the code objects nested in it as code of
+    `filename`."""
+    consts = tuple(_with_filename(const, filename)
+                   if isinstance(const, types.CodeType) else const
+                   for const in code.co_consts)
+    return code.replace(co_filename=filename, co_consts=consts)
+
+
+def _run_in_worker(pypath, code_content, names, cwd, lineno=1):
+    """Runs a code block in a worker process of the process pool.
+
+    The block is run in a new namespace, with the directory of the target
+    file `pypath` in ``sys.path``. Its line numbers start at `lineno`.
+    Returns a dict with the values of `names`, large numpy arrays as
+    `_SharedArray`.
+    """
+    os.chdir(cwd)
+    directory = os.path.dirname(pypath)
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    # the target file was just written, so import it again if the block uses it
+    module = _find_module(pypath)
+    if module is not None:
+        del sys.modules[module.__name__]
+    invalidate_caches()
+    namespace = {'__name__': os.path.splitext(os.path.basename(pypath))[0],
+                 '__file__': pypath}
+    exec(_compile_block(code_content, pypath, lineno), namespace)
+    results = {}
+    for name in names:
+        if name not in namespace:
+            raise NameError("name '%s' is not defined by the code block" % name)
+        results[name] = _SharedArray.share(namespace[name])
+    return results
+
+
+class _PhaseTimer(object):
+    """Measures how long the phases of a `%%writeandexecute` call take.
+
+    Each call of `lap` adds the time since the last call to the given phase.
+    """
+
+    def __init__(self):
+        self.phases = OrderedDict()
+        self._last = _clock()
+
+    def lap(self, phase):
+        now = _clock()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self._last
+        self._last = now
+
+    @property
+    def total(self):
+        return sum(self.phases.values())
+
+    def format(self):
+        parts = ["%s %.1f ms" % (phase, 1000 * t) for phase, t in self.phases.items()]
+        parts.append("total %.1f ms" % (1000 * self.total))
+        return ", ".join(parts)
+
+
+def _percentile(values, percent):
+    """Nearest-rank percentile of the sorted list `values`."""
+    rank = int(round(percent / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+class _TimingStats(object):
+    """Collects the phase timings of all `%%writeandexecute` calls of the
+    session, per target file and identifier."""
+
+    def __init__(self):
+        # (path, identifier) -> phase -> [count, total, deque of times]
+        self._stats = OrderedDict()
+
+    def add(self, pypath, identifier, timer):
+        phases = self._stats.setdefault((pypath, identifier), OrderedDict())
+        for phase, t in list(timer.phases.items()) + [('total', timer.total)]:
+            entry = phases.setdefault(phase, [0, 0.0, deque(maxlen=_MAX_TIMINGS)])
+            entry[0] += 1
+            entry[1] += t
+            entry[2].append(t)
+
+    def clear(self):
+        self._stats.clear()
+
+    def rows(self):
+        """Returns a list of dicts with the statistics per file, identifier
+        and phase (times in seconds)."""
+        rows = []
+        for (pypath, identifier), phases in self._stats.items():
+            for phase, (count, total, times) in phases.items():
+                times = sorted(times)
+                rows.append(OrderedDict([
+                    ('file', pypath), ('identifier', identifier), ('phase', phase),
+                    ('count', count), ('total', total),
+                    ('p50', _percentile(times, 50)), ('p95', _percentile(times, 95))]))
+        return rows
+
+    def format_table(self):
+        header = ('file', 'identifier', 'phase', 'count', 'total [s]', 'p50 [ms]', 'p95 [ms]')
+        lines = [header]
+        for row in self.rows():
+            lines.append((row['file'], row['identifier'], row['phase'], str(row['count']),
+                          "%.4f" % row['total'], "%.2f" % (1000 * row['p50']),
+                          "%.2f" % (1000 * row['p95'])))
+        widths = [max(len(line[i]) for line in lines) for i in range(len(header))]
+        return "\n".join("  ".join(value.ljust(width) for value, width in zip(line, widths)).rstrip()
+                         for line in lines)
+
+
+def _sidecar_path(pypath):
+    d, name = os.path.split(os.path.abspath(pypath))
+    return os.path.join(d, '.%s.blockindex' % name)
+
+
+def _scan_markers(data):
+    """Finds all identifier lines in `data` (bytes).
+
+    Returns a dict mapping each identifier to a list of ``[start, end]``
+    byte offsets of the lines containing it (without the newline).
+    """
+    markers = {}
+    minlen = len(_MARKER_PREFIX) + len(_MARKER_SUFFIX)
+    pos = data.find(_MARKER_PREFIX)
+    while pos != -1:
+        start = data.rfind(b'\n', 0, pos) + 1
+        end = data.find(b'\n', pos)
+        if end == -1:
+            end = len(data)
+        line = data[start:end].strip()
+        if (len(line) >= minlen and line.startswith(_MARKER_PREFIX)
+                and line.endswith(_MARKER_SUFFIX)):
+            identifier = line[len(_MARKER_PREFIX):-len(_MARKER_SUFFIX)]
+            identifier = identifier.decode('utf-8', 'replace')
+            markers.setdefault(identifier, []).append([start, end])
+        pos = data.find(_MARKER_PREFIX, end)
+    return markers
+
+
+class _BlockIndex(object):
+    """Maps identifiers to the byte offsets of their lines in a target file.
+
+    The index belongs to the file state described by `signature` (see
+    `_stat_signature`) and must be rebuilt if the file was changed by
+    somebody else. `hashes` caches the digest of the blocks we know, so
+    that rewriting a block with the same content can be skipped.
+    """
+
+    def __init__(self, signature, markers, hashes=None):
+        self.signature = signature
+        # the file must be scanned again, even if the signature is the same
+        self.racy = signature is not None and _is_racy(signature)
+        self.markers = markers
+        self.hashes = hashes or {}
+        # identifier -> line number of its first marker, counted when needed
+        self.linenos = {}
+
+    def splice(self, start, end, replacement):
+        """Updates the offsets after ``data[start:end]`` was replaced by
+        `replacement`.
+
+        Markers before the replaced range are kept, markers after it are
+        moved and markers inside `replacement` are added. Only the
+        replacement is scanned, not the whole file.
+        """
+        delta = len(replacement) - (end - start)
+        markers = {}
+        for identifier, offsets in self.markers.items():
+            kept = []
+            for s, e in offsets:
+                if e <= start:
+                    kept.append([s, e])
+                elif s >= end:
+                    kept.append([s + delta, e + delta])
+            if len(kept) != len(offsets):
+                self.hashes.pop(identifier, None)
+            if kept:
+                markers[identifier] = kept
+        for identifier, offsets in _scan_markers(replacement).items():
+            kept = markers.setdefault(identifier, [])
+            kept.extend([s + start, e + start] for s, e in offsets)
+            kept.sort()
+            self.hashes.pop(identifier, None)
+        self.markers = markers
+        self.linenos = {}
+
+    @classmethod
+    def load(cls, path, signature):
+        """Loads an index from a sidecar file.
+
+        Returns None if there is no sidecar file or if it doesn't belong to
+        a file with the given `signature`.
+        """
+        try:
+            with io.open(path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if state.get('signature') != signature:
+            return None
+        return cls(signature, state['markers'], state.get('hashes'))
+
+    def save(self, path):
+        state = {'signature': self.signature, 'markers': self.markers,
+                 'hashes': self.hashes}
+        _atomic_write(path, [json.dumps(state).encode('utf-8')], fsync=False)
+
+
+def _read_blocks(pypath):
+    """Reads the code blocks of `pypath`.
+
+    Returns the stat signature of the version read and a dict mapping each
+    identifier to ``(digest, code, lineno)``: the digest of the block (as in
+    `_BlockIndex.hashes`), the code between the two identifier lines and
+    the line number of its first line. Identifiers which aren't found
+    exactly two times are left out.
+    """
+    with io.open(pypath, 'rb') as f:
+        signature = _signature(os.fstat(f.fileno()))
+        data = f.read()
+    blocks = {}
+    for identifier, offsets in _scan_markers(data).items():
+        if len(offsets) != 2:
+            continue
+        (start, end), (second, _) = offsets
+        code = data[end + 1:second].decode('utf-8', 'replace')
+        blocks[identifier] = (_digest(data[start:second]), code,
+                              data.count(b'\n', 0, start) + 2)
+    return signature, blocks
+
+
+class _WatchedFile(object):
+    """What `%writeandexecute_watch` knows about a target file: the stat
+    signature of the version it scanned last and the digests of the code
+    blocks in it."""
+
+    def __init__(self):
+        self.signature = None
+        self.racy = False
+        self.digests = {}
+        # counts our own writes, a scan which started before one is dropped
+        self.generation = 0
+
+
+class BlockStore(Configurable):
+    """Base class of the stores of the `%%writeandexecute` code blocks.
+
+    A store gets the code blocks of a target file and is responsible to get
+    them into that file. Its parent is the `WriteAndExecuteMagics`, whose
+    `_write_blocks` writes code blocks into a file. Select the store with
+    ``WriteAndExecuteMagics.store_class``.
+
+    By default, the code blocks are written directly into the target file,
+    so a store only needs to override what it does differently.
+    """
+
+    def save_blocks(self, pypath, blocks, debug=False, timer=None):
+        """Stores the code `blocks` (identifier -> content) of the target
+        file `pypath`. Returns the identifiers of the blocks which were
+        changed or added."""
+        return self.parent._write_blocks(pypath, blocks, debug=debug, timer=timer)
+
+    def materialize(self, pypaths=None, debug=False):
+        """Writes the stored code blocks into the target files `pypaths`
+        (None: all files). Returns a list of ``(path, error)`` for the files
+        which couldn't be written."""
+        return []
+
+    def close(self):
+        pass
+
+
+class FileBlockStore(BlockStore):
+    """Writes the code blocks directly into the target files (the default
+    store)."""
+
+
+_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS blocks (
+    id INTEGER PRIMARY KEY,
+    file TEXT NOT NULL,
+    identifier TEXT NOT NULL,
+    content TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    dirty INTEGER NOT NULL DEFAULT 1,
+    UNIQUE (file, identifier)
+);
+CREATE INDEX IF NOT EXISTS dirty_blocks ON blocks (file) WHERE dirty;
+"""
+
+
+class SQLiteBlockStore(BlockStore):
+    """Keeps the code blocks in a SQLite database and writes the target files
+    from it.
+
+    The blocks are stored by (absolute path of the file, identifier), so
+    storing a block is a lookup in an index, no matter how many blocks and
+    files there are. Changed blocks are marked until they are written into
+    their file, in the same format as without the store and without
+    touching the rest of the file. A file which doesn't exist is written
+    with all its blocks. With ``write_files = 'commit'``, a block which is
+    stored again unchanged is still compared with the file, so that an
+    edit of the block in the file is undone as without the store.
+    """
+
+    path = Unicode('', help="""Path of the database. Default: writeandexecute.sqlite
+        in the profile directory.""").tag(config=True)
+
+    write_files = Enum(['commit', 'demand'], 'commit', help="""When to write the
+        changed code blocks into their files: 'commit' writes them after
+        each %%writeandexecute, 'demand' only on %writeandexecute_flush,
+        when a file is needed (-p and -l) and on exit.""").tag(config=True)
+
+    def __init__(self, **kwargs):
+        super(SQLiteBlockStore, self).__init__(**kwargs)
+        self._db = None
+        # the connection is shared with the writer and timer threads
+        self._lock = threading.RLock()
+
+    def _connect(self):
+        if self._db is None:
+            import sqlite3
+            path = self.path or os.path.join(self.parent.shell.profile_dir.location,
+                                             'writeandexecute.sqlite')
+            self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self._db.executescript(_STORE_SCHEMA)
+        return self._db
+
+    def save_blocks(self, pypath, blocks, debug=False, timer=None):
+        if timer is None:
+            timer = _PhaseTimer()
+        pypath = os.path.abspath(pypath)
+        changed = []
+        with self._lock:
+            db = self._connect()
+            with db:
+                for identifier, content in blocks.items():
+                    content = py3compat.cast_unicode(content)
+                    digest = _digest(content.encode('utf-8'))
+                    cursor = db.execute(
+                        "UPDATE blocks SET content = ?, digest = ?, dirty = 1 "
+                        "WHERE file = ? AND identifier = ? AND digest != ?",
+                        (content, digest, pypath, identifier, digest))
+                    if not cursor.rowcount:
+                        cursor = db.execute(
+                            "INSERT OR IGNORE INTO blocks (file, identifier, content, digest) "
+                            "VALUES (?, ?, ?, ?)", (pypath, identifier, content, digest))
+                    if cursor.rowcount:
+                        changed.append(identifier)
+                    elif self.write_files == 'commit':
+                        # the block in the file could have been edited since
+                        # it was written: let _write_blocks compare with it
+                        db.execute("UPDATE blocks SET dirty = 1 "
+                                   "WHERE file = ? AND identifier = ?",
+                                   (pypath, identifier))
+            timer.lap('store')
+            if self.write_files == 'commit':
+                self._write_file(pypath, debug=debug, timer=timer)
+            elif debug:
+                print("Stored cell for file: %s" % pypath)
+        return changed
+
+    def materialize(self, pypaths=None, debug=False):
+        errors = []
+        with self._lock:
+            if pypaths is None:
+                pypaths = [row[0] for row in self._connect().execute(
+                    "SELECT DISTINCT file FROM blocks WHERE dirty")]
+            for pypath in pypaths:
+                try:
+                    self._write_file(os.path.abspath(pypath), debug=debug)
+                except Exception as e:
+                    errors.append((pypath, e))
+        return errors
+
+    def _write_file(self, pypath, debug=False, timer=None):
+        """Writes the changed blocks of `pypath` into the file."""
+        db = self._connect()
+        if not os.path.isfile(pypath):
+            with db:
+                db.execute("UPDATE blocks SET dirty = 1 WHERE file = ?", (pypath,))
+        rows = db.execute("SELECT identifier, content, digest FROM blocks "
+                          "WHERE file = ? AND dirty ORDER BY id", (pypath,)).fetchall()
+        if not rows:
+            if debug:
+                print("Unchanged, file not written: %s" % pypath)
+            return
+        blocks = OrderedDict((identifier, content) for identifier, content, digest in rows)
+        self.parent._write_blocks(pypath, blocks, debug=debug, timer=timer)
+        with db:
+            # blocks changed in the meantime stay marked
+            db.executemany("UPDATE blocks SET dirty = 0 "
+                           "WHERE file = ? AND identifier = ? AND digest = ?",
+                           [(pypath, identifier, digest) for identifier, content, digest in rows])
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
 
 @magics_class
 class WriteAndExecuteMagics(Magics):
     """Magic to save a cell into a .py file."""
 
+    index_sidecar = Bool(False, help="""Also store the block index of each
+        target file in a hidden sidecar file next to it, so that a new session
+        doesn't have to rescan the file.""").tag(config=True)
+
+    buffer_writes = Bool(False, help="""Don't write the code blocks to the
+        files right away but collect them and write each file only once, on
+        %writeandexecute_flush, after `flush_timeout` or on exit.""").tag(config=True)
+
+    flush_timeout = Float(10.0, help="""Write buffered code blocks after that
+        many seconds without a new block. 0 disables the timeout.""").tag(config=True)
+
+    code_cache_size = Integer(32 * 1024 * 1024, help="""Maximum size in bytes of
+        the cache of compiled code blocks, so that re-running an unchanged
+        block doesn't parse and compile it again. 0 disables the
+        cache.""").tag(config=True)
+
+    hot_patch = Bool(False, help="""If the target file is already imported as a
+        module, run the changed code block in that module, so that it is up to
+        date without reloading it.""").tag(config=True)
+
+    write_pyc = Bool(False, help="""Also write the .pyc file whenever a target
+        file was written, so that importing it doesn't need to compile
+        it.""").tag(config=True)
+
+    timing = Bool(False, help="""Print how long the phases of each
+        %%writeandexecute call took (like the -t option).""").tag(config=True)
+
+    write_retries = Integer(100, help="""How often to retry a write which lost
+        against a concurrent write from another process (or thread) to the
+        same file.""").tag(config=True)
+
+    async_writes = Bool(False, help="""Write the files in a background thread,
+        so that the cell is executed without waiting for the file system.
+        Errors are reported after the next cell and %writeandexecute_wait
+        waits until all files are written.""").tag(config=True)
+
+    file_line_numbers = Bool(False, help="""Compile the code blocks with the path
+        of the target file as filename and with their line numbers in that
+        file (like the -l option), so that tracebacks, profilers and
+        coverage point into the target file.""").tag(config=True)
+
+    store_class = Type(FileBlockStore, klass=BlockStore, help="""Where the code
+        blocks are stored: FileBlockStore writes them directly into the
+        target files, SQLiteBlockStore keeps them in a database and writes
+        the files from there.""").tag(config=True)
+
+    pool_workers = Integer(0, help="""Number of worker processes of the process
+        pool which runs the code blocks of %%writeandexecute -p. 0 uses one
+        per CPU.""").tag(config=True)
+
+    watch_interval = Float(1.0, help="""How often (in seconds)
+        %writeandexecute_watch checks if the watched files were
+        changed.""").tag(config=True)
+
+    def __init__(self, shell=None, **kwargs):
+        super(WriteAndExecuteMagics, self).__init__(shell=shell, **kwargs)
+        # absolute path of a target file -> _BlockIndex
+        self._block_indexes = {}
+        self._code_cache = _CodeCache(self.code_cache_size)
+        # (module name, identifier) -> digest of the code last run in that module
+        self._patched = {}
+        self._timing_stats = _TimingStats()
+        # buffered writes: path of a target file -> OrderedDict(identifier -> content)
+        self._pending = OrderedDict()
+        self._pending_debug = False
+        self._flush_timer = None
+        self._atexit_registered = False
+        # async writes: (path, blocks, debug) jobs for the writer thread,
+        # which writes them in order
+        self._write_queue = queue.Queue()
+        self._writer = None
+        # (path, exception) of writes which failed outside of a cell
+        self._write_errors = []
+        # process pool for -p and its running blocks: future -> (identifier, debug)
+        self._pool = None
+        self._futures = OrderedDict()
+        # the BlockStore, created when the first block is stored
+        self._store = None
+        # %writeandexecute_watch: absolute path -> _WatchedFile, the changed
+        # blocks to run before the next cell ((path, identifier) -> (code,
+        # lineno)) and the polling thread with its stop event
+        self._watched = {}
+        self._watch_all = False
+        self._watch_changes = OrderedDict()
+        self._watch_debug = False
+        self._watcher = None
+        self._watch_stop = None
+        # protects the buffer against the flush timer
+        self._lock = threading.RLock()
+        # protects the indexes and the files against the timer and writer threads
+        self._write_lock = threading.RLock()
+
     @skip_doctest
     @cell_magic
     def writeandexecute(self, parameter_s='', cell=None):
@@ -44,6 +963,32 @@ class WriteAndExecuteMagics(Magics):
         -d : (optional)
             Write some debugging output. Default: -- (no debugging output)
 
+        -b : (optional)
+            Buffer the code block instead of writing it right away, see
+            below. Default: -- (write the file, unless
+            ``WriteAndExecuteMagics.buffer_writes`` is set)
+
+        -t : (optional)
+            Print how long the phases of the magic took: transforming the
+            cell, scanning and writing the file, compiling and running the
+            code. Default: -- (only print it if
+            ``WriteAndExecuteMagics.timing`` is set). The timings of all
+            calls are available with ``%writeandexecute_stats``.
+
+        -p : (optional)
+            Run the code block in a worker process, see below. Default: --
+            (run it in the kernel)
+
+        -o <names> : (optional)
+            Comma separated names of variables which a code block run with
+            ``-p`` returns into the user namespace, only allowed with
+            ``-p``. Default: -- (nothing)
+
+        -l : (optional)
+            Compile the code block as part of the target file, see below.
+            Default: -- (compile it as a cell, unless
+            ``WriteAndExecuteMagics.file_line_numbers`` is set)
+
 
         Examples:
         ---------
@@ -72,10 +1017,76 @@ class WriteAndExecuteMagics(Magics):
 
         Cell content is transformed, so `%magic` commands are executed, but
         `get_ipython()` must be available, i.e. the code must be executed in
-        an IPython session.
+        an IPython session. The transformed content is compiled and run
+        directly, so it isn't transformed a second time. The compiled code is
+        cached, so re-running an unchanged cell doesn't compile it again (see
+        ``WriteAndExecuteMagics.code_cache_size``). Set
+        ``WriteAndExecuteMagics.write_pyc`` to also write the .pyc file of
+        the target file.
+
+        If the target file is already imported, e.g. by ``import functions``,
+        ``%config WriteAndExecuteMagics.hot_patch = True`` also runs changed
+        code blocks in the namespace of that module, so that it is up to date
+        without reloading the whole module.
+
+        The file is only written if the content of the code block changed
+        and is replaced atomically, so other processes never see a half
+        written file. Several kernels can write into the same file: if the
+        file was changed by another writer while the new version was
+        prepared, the write is retried. The positions of the identifiers in each file are kept
+        in an index, so the file is only rescanned if it was changed by
+        something else.
+        Use ``%config WriteAndExecuteMagics.index_sidecar = True`` to also
+        keep that index in a hidden file next to the target file.
+
+        When running many cells which write into the same file, use ``-b``
+        or ``%config WriteAndExecuteMagics.buffer_writes = True`` to collect
+        the code blocks and write each file only once: on
+        ``%writeandexecute_flush``, after ``flush_timeout`` seconds without
+        a new block or when IPython exits.
+
+        On slow file systems, ``%config WriteAndExecuteMagics.async_writes =
+        True`` writes the files in a background thread and executes the
+        cell right away. Use ``%writeandexecute_wait`` to wait for the writes
+        to finish, e.g. before importing the written file.
+
+        For projects with many code blocks, ``%config
+        WriteAndExecuteMagics.store_class =
+        'ipyext.writeandexecute.SQLiteBlockStore'`` keeps the blocks in a
+        SQLite database (``SQLiteBlockStore.path``) and only writes the
+        changed blocks into the target files: after each cell or, with
+        ``SQLiteBlockStore.write_files = 'demand'``, only on
+        ``%writeandexecute_flush``, for ``-p`` and ``-l`` and on exit.
+
+        With ``-p``, the file is written right away and the code block runs
+        in a worker process of a process pool (see
+        ``WriteAndExecuteMagics.pool_workers``), so several long running
+        blocks can run at the same time without blocking the kernel. The
+        block runs in a new namespace of the worker, not in the user
+        namespace, so it must not use `%magic` commands. The directory of
+        the target file is in ``sys.path``, so the block can import the
+        target file (and other files next to it). Once the block is
+        finished, the variables given by ``-o`` are copied into the user
+        namespace: they are pickled, large numpy arrays are passed through
+        shared memory. This happens after the next cell or on
+        ``%writeandexecute_wait``.
+
+        With ``-l`` (or ``%config WriteAndExecuteMagics.file_line_numbers =
+        True``), the code block is compiled with the path of the target file
+        as filename and with the line numbers it has in that file, instead
+        of as an ``<ipython-input-N>`` cell. Tracebacks, ``cProfile``,
+        ``line_profiler`` and coverage then point to the lines of the target
+        file, e.g. ``functions.py:123``. The file is written right away
+        (buffered and async writes are not used for this block), so that
+        it matches the code.
+
+        If the target file is also edited outside of IPython, e.g. in an
+        editor, ``%writeandexecute_watch`` runs the code blocks which were
+        changed there before the next cell.
         """
 
-        opts,args = self.parse_options(parameter_s,'i:d')
+        timer = _PhaseTimer()
+        opts,args = self.parse_options(parameter_s, _MAGIC_OPTIONS)
         if cell is None or cell == "":
             # this is actually catched by ipython itself and therfore never run
             raise UsageError('Nothing to save!')
@@ -85,77 +1096,909 @@ class WriteAndExecuteMagics(Magics):
         debug = False if not "d" in opts else True
         if not args:
             raise UsageError('Missing filename')
+        if 'o' in opts and 'p' not in opts:
+            raise UsageError('Outputs are only copied from a worker process: include "-p"')
         filename = args
+        timer.lap('parse')
         code_content = self.shell.input_transformer_manager.transform_cell(cell)
-        self._save_to_file(filename, identifier, code_content, debug=debug)
+        timer.lap('transform')
+        in_pool = 'p' in opts
+        # the code must match the file, so it is written right away
+        in_file = self.file_line_numbers or 'l' in opts
+        pypath = os.path.splitext(filename)[0] + '.py'
+        written = None
+        if (self.buffer_writes or 'b' in opts) and not (in_pool or in_file):
+            self._buffer_block(filename, identifier, code_content, debug=debug)
+            timer.lap('buffer')
+        else:
+            written = self._save_to_file(filename, identifier, code_content,
+                                         debug=debug, timer=timer)
+            if in_pool or in_file:
+                # the worker imports the file, so wait for the async write
+                if written is None:
+                    self._write_queue.join()
+                    self._report_write_errors()
+                self._report_write_errors(self._materialize([pypath], debug=debug))
+            timer.lap('write')
+
+        lineno = None
+        if in_file:
+            lineno = self._block_lineno(pypath, identifier)
+            if lineno is None and debug:
+                print("Code block %s not found in %s, compiled as a cell" % (identifier, pypath))
+            timer.lap('lineno')
+        if self.hot_patch:
+            changed = written is None or identifier in written
+            self._hot_patch(filename, identifier, code_content, changed,
+                            lineno=lineno or 1, debug=debug)
+            timer.lap('hot_patch')
+
+        if in_pool:
+            names = opts.get('o', '').replace(',', ' ').split()
+            self._submit(pypath, identifier, code_content, names,
+                         lineno=lineno or 1, debug=debug)
+            timer.lap('submit')
+        else:
+            if lineno is None:
+                code = self._compile(code_content, identifier)
+            else:
+                code = self._compile(code_content, identifier,
+                                     filename=os.path.abspath(pypath), lineno=lineno)
+            timer.lap('compile')
+            if code is None:
+                # Let IPython report the error (or run code with top-level
+                # await, which we can't compile ourself).
+                self.shell.run_cell(cell)
+            else:
+                self._run_compiled(code)
+            timer.lap('run')
+
+        self._timing_stats.add(pypath, identifier, timer)
+        if self.timing or 't' in opts:
+            print("Timing for %s in %s: %s" % (identifier, pypath, timer.format()))
+
+    def _hot_patch(self, path, identifier, code_content, changed, lineno=1, debug=False):
+        """Runs the changed code block in the namespace of the already
+        imported module of the target file.
+
+        `changed` tells if the block in the file changed (if unknown, because
+        the write is deferred, pass True). `lineno` is the line number of
+        the block in the file.
+        """
+        pypath = os.path.splitext(path)[0] + '.py'
+        module = _find_module(pypath)
+        if module is None:
+            return
+        key = (module.__name__, identifier)
+        digest = _digest(code_content.encode('utf-8'))
+        previous = self._patched.get(key)
+        if previous == digest or (previous is None and not changed):
+            return
+        if debug:
+            print("Updating module %s with block %s" % (module.__name__, identifier))
+        try:
+            exec(_compile_block(code_content, os.path.abspath(pypath), lineno),
+                 module.__dict__)
+        except Exception:
+            print("Could not update module %s:" % module.__name__, file=sys.stderr)
+            self.shell.showtraceback()
+        else:
+            self._patched[key] = digest
 
-        ip = get_ipython()
-        ip.run_cell(cell)
+    def _compile(self, code_content, identifier, filename=None, lineno=1):
+        """Compiles the already transformed cell content.
+
+        Returns a list of code objects which have to be run in order, or None
+        if the content could not be compiled. Unchanged code blocks are taken
+        from the code cache. With `filename`, the code is compiled as the
+        lines of that file starting at `lineno`, instead of as a cell.
+        """
+        shell = self.shell
+        self._code_cache.max_bytes = self.code_cache_size
+        key = _digest(u'\0'.join([identifier, shell.ast_node_interactivity,
+                                  str(shell.compile.flags),
+                                  str([id(t) for t in shell.ast_transformers]),
+                                  filename or u'', str(lineno),
+                                  code_content]).encode('utf-8'))
+        if filename is None:
+            cell_name = shell.compile.cache(code_content, shell.execution_count)
+        else:
+            cell_name = filename
+        code = self._code_cache.get(key)
+        if code is not None:
+            if not code or code[0].co_filename == cell_name:
+                return code
+            # the cell name contains the execution count, which is shown in
+            # the tracebacks, so only the file name has to be replaced
+            if hasattr(code[0], 'replace'):   # Required from Python 3.8
+                return [_with_filename(code_obj, cell_name) for code_obj in code]
+        try:
+            code_ast = shell.compile.ast_parse(code_content, filename=cell_name)
+            if lineno > 1:
+                ast.increment_lineno(code_ast, lineno - 1)
+            code_ast = shell.transform_ast(code_ast)
+            exec_nodes, interactive_nodes = _split_interactive(
+                code_ast.body, shell.ast_node_interactivity)
+            code = []
+            if exec_nodes:
+                mod = ast.Module(body=exec_nodes, type_ignores=[])
+                code.append(shell.compile(mod, cell_name, 'exec'))
+            for node in interactive_nodes:
+                code.append(shell.compile(ast.Interactive(body=[node]), cell_name, 'single'))
+        except (OverflowError, SyntaxError, ValueError, TypeError,
+                MemoryError, InputRejected):
+            return None
+        if self.code_cache_size > 0:
+            self._code_cache.put(key, code)
+        return code
+
+    def _run_compiled(self, code):
+        """Runs the code objects from `_compile` in the user namespace.
+
+        Stops at the first code object which raised an exception, which is
+        reported by IPython as for any other cell.
+        """
+        for code_obj in code:
+            if _run_sync(self.shell.run_code(code_obj)):
+                return False
+        return True
+
+    def _submit(self, pypath, identifier, code_content, names, lineno=1, debug=False):
+        """Runs the code block in the process pool."""
+        pool = self._get_pool()
+        future = pool.submit(_run_in_worker, os.path.abspath(pypath),
+                             code_content, names, os.getcwd(), lineno)
+        with self._lock:
+            self._futures[future] = (identifier, debug)
+        if debug:
+            print("Running code block %s in a worker process" % identifier)
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                try:
+                    from concurrent.futures import ProcessPoolExecutor
+                except ImportError:
+                    raise UsageError("Running code blocks in a process pool needs "
+                                     "concurrent.futures (the 'futures' package on Python 2)")
+                kwargs = {}
+                if sys.version_info >= (3, 7):
+                    # a forked kernel would inherit its threads and sockets
+                    import multiprocessing
+                    kwargs['mp_context'] = multiprocessing.get_context('spawn')
+                self._pool = ProcessPoolExecutor(self.pool_workers or None, **kwargs)
+                self._register_atexit()
+            return self._pool
+
+    def _collect_results(self, wait=False):
+        """Copies the results of the finished code blocks of the process
+        pool into the user namespace and reports their errors."""
+        with self._lock:
+            futures = list(self._futures)
+        if not futures:
+            return
+        if wait:
+            from concurrent.futures import wait as wait_for
+            wait_for(futures)
+        for future in futures:
+            if not future.done():
+                continue
+            with self._lock:
+                identifier, debug = self._futures.pop(future)
+            try:
+                results = future.result()
+                for name, value in results.items():
+                    if isinstance(value, _SharedArray):
+                        value = value.load()
+                    self.shell.user_ns[name] = value
+            except Exception as e:
+                if type(e).__name__ == 'BrokenProcessPool':
+                    with self._lock:
+                        self._pool = None
+                print("Code block %s failed in the worker process:" % identifier, file=sys.stderr)
+                # the traceback from the worker, if there is one
+                print(getattr(e, '__cause__', None) or "%s: %s" % (type(e).__name__, e),
+                      file=sys.stderr)
+            else:
+                if debug:
+                    print("Code block %s finished in a worker process" % identifier)
 
     def ensure_dir(self, f):
         d = os.path.dirname(f)
         if d and not os.path.exists(d):
             os.makedirs(d)
 
-    def _save_to_file(self, path, identifier, content, debug=False):
-            pypath = os.path.splitext(path)[0] + '.py'
-            code_identifier = "# -- ==%s== --" % identifier
-            new_content = []
-            if not os.path.isfile(pypath):
-                # The file does not exist, so simple create a new one
-                if debug:
-                    print("Created new file: %s" % pypath)
-                new_content.extend([u'# -*- coding: utf-8 -*-\n\n', code_identifier , content, code_identifier])
+    def _get_index(self, pypath):
+        """Returns a valid block index for `pypath`.
+
+        The in-memory index (or, if enabled, the sidecar index) is reused
+        as long as the stat signature of the file did not change, otherwise
+        the file is rescanned. A racy signature (see `_is_racy`) is never
+        trusted, neither in memory nor in the sidecar.
+        """
+        key = os.path.abspath(pypath)
+        signature = _stat_signature(pypath)
+        index = self._block_indexes.get(key)
+        if index is None or index.signature != signature or index.racy:
+            index = None
+            if self.index_sidecar and not _is_racy(signature):
+                index = _BlockIndex.load(_sidecar_path(pypath), signature)
+            if index is None:
+                index = _BlockIndex(signature, _scan_file(pypath))
+            self._block_indexes[key] = index
+        return index
+
+    def _block_lineno(self, pypath, identifier):
+        """Returns the line number of the first line of the code block
+        `identifier` in `pypath` or None if the file doesn't contain it."""
+        with self._write_lock:
+            try:
+                index = self._get_index(pypath)
+            except (IOError, OSError):
+                return None
+            offsets = index.markers.get(identifier, [])
+            if len(offsets) != 2:
+                return None
+            lineno = index.linenos.get(identifier)
+            if lineno is None:
+                lineno = index.linenos[identifier] = _count_lines(pypath, offsets[0][0])
+            # the code starts below the marker
+            return lineno + 1
+
+    @line_magic
+    def writeandexecute_flush(self, parameter_s=''):
+        """Writes all buffered code blocks of `%%writeandexecute`.
+
+        Each file is written once, with all buffered code blocks for it.
+        With ``SQLiteBlockStore.write_files = 'demand'``, the target files
+        are also written from the store.
+
+        Parameters
+        ----------
+
+        -d : (optional)
+            Write some debugging output. Default: -- (no debugging output)
+        """
+        opts, args = self.parse_options(parameter_s, 'd')
+        errors = self._flush(debug='d' in opts)
+        if self._store is not None:
+            # the blocks must be stored before the files are written
+            self._write_queue.join()
+            errors.extend(self._materialize(debug='d' in opts))
+        self._report_write_errors(errors)
+
+    @line_magic
+    def writeandexecute_wait(self, parameter_s=''):
+        """Waits until all files of `%%writeandexecute` are written and all
+        code blocks run with ``-p`` are finished.
+
+        Only needed with ``WriteAndExecuteMagics.async_writes``, where the
+        files are written in a background thread, and for ``-p``, where the
+        code blocks run in worker processes. Errors of the background writes
+        and of the code blocks are printed, the results of the code blocks
+        are copied into the user namespace. Buffered code blocks are not
+        written, use `%writeandexecute_flush` for that.
+        """
+        self._write_queue.join()
+        self._report_write_errors()
+        self._collect_results(wait=True)
+
+    @line_magic
+    def writeandexecute_sync(self, parameter_s=''):
+        """Writes the latest version of all `%%writeandexecute` cells of this
+        session into their files, without running them.
+
+        The cells are taken from the input history of the session. Of all
+        cells with the same identifier and file only the last one is used,
+        each file is written once, with all its code blocks. Relative
+        filenames are relative to the current working directory. Nothing
+        is executed, also not with ``WriteAndExecuteMagics.hot_patch``.
+
+        Parameters
+        ----------
+
+        -d : (optional)
+            Write some debugging output. Default: -- (no debugging output)
+        """
+        opts, args = self.parse_options(parameter_s, 'd')
+        debug = 'd' in opts
+        # pypath -> identifier -> last cell, in the order of the first cell
+        latest = OrderedDict()
+        for source in self.shell.history_manager.input_hist_raw:
+            parts = _split_magic_cell(source)
+            if parts is None or not parts[1].strip():
+                continue
+            line, cell = parts
+            try:
+                cell_opts, filename = self.parse_options(line, _MAGIC_OPTIONS)
+            except UsageError:
+                continue
+            if not cell_opts.get('i') or not filename:
+                continue
+            pypath = os.path.abspath(os.path.splitext(filename)[0] + '.py')
+            latest.setdefault(pypath, OrderedDict())[cell_opts['i']] = cell
+
+        # older writes of the same blocks must not overwrite the new versions
+        self._write_queue.join()
+        self._report_write_errors()
+        transform = self.shell.input_transformer_manager.transform_cell
+        for pypath, cells in latest.items():
+            blocks = OrderedDict((identifier, transform(cell))
+                                 for identifier, cell in cells.items())
+            with self._lock:
+                pending = self._pending.get(pypath)
+                for identifier in blocks if pending else ():
+                    pending.pop(identifier, None)
+            try:
+                written = self._save_blocks(pypath, blocks, debug=debug)
+            except Exception as e:
+                self._report_write_errors([(pypath, e)])
+                continue
+            if written:
+                print("Wrote %s (%s)" % (pypath, ", ".join(written)))
+            elif debug:
+                print("Unchanged %s" % pypath)
+
+    @line_magic
+    def writeandexecute_watch(self, parameter_s=''):
+        """Runs the code blocks of `%%writeandexecute` again which were
+        changed in their files outside of IPython, e.g. in an editor.
+
+        A background thread checks the stat signature of the watched files
+        every ``WriteAndExecuteMagics.watch_interval`` seconds. Only a file
+        which was changed is read again, and only its code blocks whose
+        content changed (or which were added) are run. They are run in the
+        user namespace (and, with ``WriteAndExecuteMagics.hot_patch``, in
+        the imported module of the file) before the next cell, with the
+        line numbers of the file. Blocks written by `%%writeandexecute`
+        itself are not run again.
+
+        Parameters
+        ----------
+
+        <filename> ... : str (optional)
+            The target files to watch. Default: all target files of
+            `%%writeandexecute`, also the ones written later
+
+        -s : (optional)
+            Stop watching all files. Default: -- (start watching)
+
+        -d : (optional)
+            Write some debugging output. Default: -- (no debugging output)
+        """
+        opts, args = self.parse_options(parameter_s, 'ds')
+        if 's' in opts:
+            self._stop_watching()
+            print("Stopped watching files")
+            return
+        pypaths = [os.path.abspath(os.path.splitext(filename)[0] + '.py')
+                   for filename in args.split()]
+        with self._write_lock:
+            # the files must not be written while their first version is read
+            with self._lock:
+                self._watch_debug = 'd' in opts
+                if not pypaths:
+                    self._watch_all = True
+                    pypaths = list(self._block_indexes)
+                new = [key for key in pypaths if key not in self._watched]
+            for key in new:
+                self._watch_file(key)
+                if self._watch_debug:
+                    print("Watching file: %s" % key)
+        with self._lock:
+            if self._watcher is None:
+                self._watch_stop = threading.Event()
+                self._watcher = threading.Thread(target=self._watch_loop,
+                                                 args=(self._watch_stop,),
+                                                 name='writeandexecute-watcher')
+                self._watcher.daemon = True
+                self._watcher.start()
+            count = len(self._watched)
+        if self._watch_all:
+            print("Watching all target files (%s so far)" % count)
+        else:
+            print("Watching %s files" % count)
+
+    def _watch_loop(self, stop):
+        while not stop.wait(self.watch_interval):
+            with self._lock:
+                keys = list(self._watched)
+            for key in keys:
+                self._scan_watched(key)
+
+    def _scan_watched(self, key):
+        """Reads the watched file `key` again if its stat signature changed
+        and queues its changed code blocks to run before the next cell."""
+        with self._lock:
+            state = self._watched.get(key)
+            if state is None:
+                return
+            generation = state.generation
+        try:
+            if _stat_signature(key) == state.signature and not state.racy:
+                return
+            signature, blocks = _read_blocks(key)
+        except (IOError, OSError):
+            # missing (for now), it has a new signature when it's back
+            return
+        with self._lock:
+            if self._watched.get(key) is not state or state.generation != generation:
+                # we wrote the file in the meantime, read it again next time
+                return
+            # The digests of missing blocks are kept: an editor which writes
+            # the file in place may be caught in the middle of it.
+            for identifier, (digest, code, lineno) in blocks.items():
+                if state.digests.get(identifier) != digest:
+                    self._watch_changes[(key, identifier)] = (code, lineno)
+                    state.digests[identifier] = digest
+            state.signature = signature
+            state.racy = _is_racy(signature)
+
+    def _watch_file(self, key):
+        """Starts watching the file `key`. The blocks it has now are not
+        run, the file is read before the watcher sees it."""
+        state = _WatchedFile()
+        try:
+            state.signature, blocks = _read_blocks(key)
+            state.racy = _is_racy(state.signature)
+        except (IOError, OSError):
+            # all its blocks are new once it exists
+            blocks = {}
+        state.digests = dict((identifier, block[0])
+                             for identifier, block in blocks.items())
+        with self._lock:
+            self._watched.setdefault(key, state)
+
+    def _watch_written(self, pypath, digests):
+        """Tells the watcher about the blocks (identifier -> digest) which we
+        wrote into `pypath`, so that they are not run again."""
+        key = os.path.abspath(pypath)
+        with self._lock:
+            state = self._watched.get(key)
+            if state is not None:
+                state.generation += 1
+                state.digests.update(digests)
+                for identifier in digests:
+                    self._watch_changes.pop((key, identifier), None)
+                return
+            if not self._watch_all:
+                return
+        self._watch_file(key)
+
+    def _stop_watching(self):
+        with self._lock:
+            watcher, stop = self._watcher, self._watch_stop
+            self._watcher = self._watch_stop = None
+            self._watched = {}
+            self._watch_all = False
+            self._watch_changes = OrderedDict()
+        if watcher is not None:
+            stop.set()
+            watcher.join()
+
+    def _run_watched_changes(self):
+        """Runs the changed code blocks found by the watcher."""
+        with self._lock:
+            changes, self._watch_changes = self._watch_changes, OrderedDict()
+            debug = self._watch_debug
+        for (key, identifier), (code_content, lineno) in changes.items():
+            print("Running changed code block %s of %s" % (identifier, key))
+            if self.hot_patch:
+                self._hot_patch(key, identifier, code_content, True,
+                                lineno=lineno, debug=debug)
+            code = self._compile(code_content, identifier, filename=key, lineno=lineno)
+            if code is not None:
+                self._run_compiled(code)
+                continue
+            try:
+                _compile_block(code_content, key, lineno)
+            except SyntaxError:
+                self.shell.showsyntaxerror()
             else:
-                # If file exist, read in the content and either replace the code or append it
-                in_code_block = False
-                included_new = False
-                lineno = 0
-                with io.open(pypath, 'r', encoding='utf-8') as f:
-                    for line in f:
-                        if line[-1] == "\n":
-                            line = line[:-1]
-                        lineno += 1
-                        if line.strip() == code_identifier:
-                            if included_new and not in_code_block:
-                                # we found a third one -> Error!
-                                raise Exception("Found more than two lines with identifier '%s' in file '%s' in line %s. "
-                                    "Please fix the file so that the identifier is included exactly two times." % (code_identifier, pypath, lineno))
-                            # Now we are either in the codeblock or just outside
-                            # Switch the state to either "in our codeblock" or outside again
-                            in_code_block = True if not in_code_block else False
-                            if not included_new:
-                                # The code was not included yet, so add it here...
-                                # No need to add a code indentifier to the end as we just add the ending indentifier from the last
-                                # time when the state is switched again.
-                                new_content.extend([code_identifier, content])
-                                included_new = True
-                        # This is something from other code cells, so just include it. All code
-                        # "in_code_block" is replaced, so do not include it
-                        if not in_code_block:
-                            new_content.append(line)
-                # the file is finished, ensure we didn't see only one identifier, but not the second one
-                if in_code_block:
+                print("Could not run code block %s of %s" % (identifier, key),
+                      file=sys.stderr)
+
+    @line_magic
+    def writeandexecute_stats(self, parameter_s=''):
+        """Shows how long the `%%writeandexecute` calls of this session took.
+
+        Prints a table with the number of calls, the total time and the
+        median (p50) and 95th percentile (p95) of the time per call for
+        each target file, identifier and phase. The phases are ``parse``,
+        ``transform``, ``scan`` (looking up the code block in the file),
+        ``write``, ``compile`` and ``run`` (running the code) plus
+        ``buffer``, ``hot_patch``, ``submit`` (to the process pool),
+        ``lineno`` (finding the line number of the block for ``-l``) and
+        ``store`` (storing the block in the SQLite store) if these options
+        are used, and ``retry`` (waiting after a concurrent write).
+
+        Parameters
+        ----------
+
+        -j : (optional)
+            Print the statistics as JSON (times in seconds).
+
+        -f <filename> : (optional)
+            Write the statistics as JSON to the given file.
+
+        -r : (optional)
+            Reset the statistics.
+        """
+        opts, args = self.parse_options(parameter_s, 'jf:r')
+        if 'f' in opts:
+            with io.open(opts['f'], 'w', encoding='utf-8') as f:
+                f.write(py3compat.cast_unicode(json.dumps(self._timing_stats.rows(), indent=1)))
+        if 'j' in opts:
+            print(json.dumps(self._timing_stats.rows(), indent=1))
+        elif 'f' not in opts and 'r' not in opts:
+            print(self._timing_stats.format_table())
+        if 'r' in opts:
+            self._timing_stats.clear()
+
+    def _save_to_file(self, path, identifier, content, debug=False, timer=None):
+        pypath = os.path.splitext(path)[0] + '.py'
+        with self._lock:
+            # buffered blocks for the same file must not overwrite this one later
+            blocks = self._pending.pop(os.path.abspath(pypath), OrderedDict())
+        blocks[identifier] = content
+        return self._write(pypath, blocks, debug=debug, timer=timer)
+
+    def _write(self, pypath, blocks, debug=False, timer=None):
+        """Writes `blocks` to `pypath`, either directly or, for async writes,
+        by queueing them for the writer thread.
+
+        Returns the identifiers of the written blocks or None, if the blocks
+        are queued.
+        """
+        if not self.async_writes:
+            return self._save_blocks(pypath, blocks, debug=debug, timer=timer)
+        with self._lock:
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._writer_loop,
+                                                name='writeandexecute-writer')
+                self._writer.daemon = True
+                self._writer.start()
+            self._register_atexit()
+        self._write_queue.put((pypath, blocks, debug))
+
+    def _writer_loop(self):
+        while True:
+            pypath, blocks, debug = self._write_queue.get()
+            try:
+                self._save_blocks(pypath, blocks, debug=debug)
+            except Exception as e:
+                with self._lock:
+                    self._write_errors.append((pypath, e))
+            finally:
+                self._write_queue.task_done()
+
+    def _save_blocks(self, pypath, blocks, debug=False, timer=None):
+        """Stores the code `blocks` (identifier -> content) of `pypath` with
+        the store (by default: writes them into the file). Returns the
+        identifiers of the blocks which were changed or added."""
+        return self._get_store().save_blocks(pypath, blocks, debug=debug, timer=timer)
+
+    def _get_store(self):
+        with self._lock:
+            old = None
+            if self._store is not None and type(self._store) is not self.store_class:
+                # store_class was changed
+                old, self._store = self._store, None
+            if self._store is None:
+                self._store = self.store_class(parent=self)
+                if self.shell is not None:
+                    # for %config
+                    self.shell.configurables.append(self._store)
+            store = self._store
+        if old is not None:
+            errors = self._close_store(old)
+            with self._lock:
+                self._write_errors.extend(errors)
+        return store
+
+    def _close_store(self, store=None):
+        """Writes the files of the store and closes it, returns the errors."""
+        if store is None:
+            with self._lock:
+                store, self._store = self._store, None
+            if store is None:
+                return []
+        try:
+            return store.materialize()
+        finally:
+            store.close()
+            if self.shell is not None and store in self.shell.configurables:
+                self.shell.configurables.remove(store)
+
+    def _materialize(self, pypaths=None, debug=False):
+        """Writes the files of the store, returns the errors."""
+        with self._lock:
+            store = self._store
+        if store is None:
+            return []
+        return store.materialize(pypaths, debug=debug)
+
+    def _write_blocks(self, pypath, blocks, debug=False, timer=None):
+        """Writes the code `blocks` (identifier -> content) into `pypath`.
+
+        All blocks are written in one pass, the file isn't touched if none of
+        them changed. Returns the identifiers of the blocks which were
+        changed or added.
+
+        The new version is prepared without holding a lock and only swapped
+        in if the file is still the version it is based on. Otherwise (the
+        file was changed by another process in the meantime) everything is
+        redone with the new version of the file.
+        """
+        if timer is None:
+            timer = _PhaseTimer()
+        new_blocks = OrderedDict()
+        for identifier, content in blocks.items():
+            marker = _code_identifier(identifier).encode('utf-8')
+            block = marker + b'\n' + py3compat.cast_unicode(content).encode('utf-8') + b'\n'
+            new_blocks[identifier] = (marker, block)
+
+        key = os.path.abspath(pypath)
+        delay = _RETRY_DELAY
+        with self._write_lock:
+            for attempt in range(self.write_retries + 1):
+                try:
+                    return self._try_save_blocks(pypath, new_blocks, debug=debug, timer=timer)
+                except _ConcurrentWrite:
+                    timer.lap('write')
+                    self._block_indexes.pop(key, None)
+                    if debug:
+                        print("File was changed concurrently, retrying: %s" % pypath)
+                time.sleep(delay * random.uniform(0.5, 1.5))
+                delay = min(2 * delay, _MAX_RETRY_DELAY)
+                timer.lap('retry')
+        raise IOError("Could not write to file '%s': it was changed by other "
+                      "writers %s times in a row." % (pypath, self.write_retries + 1))
+
+    def _try_save_blocks(self, pypath, new_blocks, debug=False, timer=None):
+        """One attempt of `_save_blocks`, raises `_ConcurrentWrite` if the
+        file was changed while preparing the new version."""
+        # (start, end, replacement) of the byte ranges to replace
+        splices = []
+        appended = []
+        changed = []
+        exists = os.path.isfile(pypath)
+        if not exists:
+            # The file does not exist, so simple create a new one
+            index = _BlockIndex(None, {})
+            appended = list(new_blocks)
+        else:
+            # If file exist, either replace the code or append it. Only
+            # the byte range of our blocks is touched, the rest of the
+            # file is copied as is.
+            index = self._get_index(pypath)
+            for identifier, (marker, block) in new_blocks.items():
+                code_identifier = _code_identifier(identifier)
+                offsets = index.markers.get(identifier, [])
+                if len(offsets) == 1:
                     raise Exception("Found only one line with identifier '%s' in file '%s'. "
                                     "Please fix the file so that the identifier is included exactly two times." % (code_identifier, pypath))
+                if len(offsets) > 2:
+                    # we found a third one -> Error!
+                    lineno = _count_lines(pypath, offsets[2][0])
+                    raise Exception("Found more than two lines with identifier '%s' in file '%s' in line %s. "
+                        "Please fix the file so that the identifier is included exactly two times." % (code_identifier, pypath, lineno))
+                if not offsets:
+                    appended.append(identifier)
+                    continue
+                # Replace everything from the first marker up to the
+                # second one, which is kept as is.
+                start, end = offsets[0][0], offsets[1][0]
+                known = index.hashes.get(identifier)
+                if known is None:
+                    with io.open(pypath, 'rb') as f:
+                        f.seek(start)
+                        known = _digest(f.read(end - start))
+                    index.hashes[identifier] = known
+                if known != _digest(block):
+                    splices.append((start, end, block))
+                    changed.append(identifier)
+            if not splices and not appended:
+                # Nothing changed, so don't touch the file at all
+                timer.lap('scan')
+                if debug:
+                    print("Unchanged, file not written: %s" % pypath)
+                return []
+        timer.lap('scan')
+
+        self.ensure_dir(pypath)
+        f = None
+        try:
+            if exists:
+                try:
+                    f = io.open(pypath, 'rb')
+                except (IOError, OSError):
+                    # removed in the meantime
+                    raise _ConcurrentWrite()
+                if _signature(os.fstat(f.fileno())) != index.signature:
+                    raise _ConcurrentWrite()
+            if appended:
                 # And if we didn't include our code yet, lets append it to the end...
-                if not included_new:
-                    new_content.extend(["\n", code_identifier, content, code_identifier, "\n"])
-
-            new_content = py3compat.cast_unicode(u'\n'.join(new_content))
-
-            #Now write the complete code back to the file
-            self.ensure_dir(pypath)
-            with io.open(pypath,'w', encoding='utf-8') as f:
-                if not py3compat.PY3 and not isinstance(new_content, unicode):
-                    # this branch is likely only taken for JSON on Python 2
-                    new_content = py3compat.str_to_unicode(new_content)
-                f.write(new_content)
+                units = []
+                for identifier in appended:
+                    marker, block = new_blocks[identifier]
+                    units.append(block + marker)
+                units = b'\n\n\n'.join(units)
+                if not exists:
+                    start = end = 0
+                    replacement = _FILE_HEADER + units
+                else:
+                    start = end = index.signature[1]
+                    if start:
+                        f.seek(start - 1)
+                        if f.read(1) == b'\n':
+                            start -= 1
+                    replacement = (b'\n\n\n' if end else b'\n\n') + units + b'\n\n'
+                splices.append((start, end, replacement))
+            splices.sort()
+
+            # Write the complete new code to a temporary file. As all writers
+            # replace the file (and never change it), `f` stays the version
+            # we are based on, even if the file is replaced in the meantime.
+            tmppath = _write_temp(pypath, _splice_file(f, splices))
+            if f is not None and os.name == 'nt':
+                # Windows can't replace a file which is open
+                f.close()
+                f = None
+
+            # While `f` is open, its inode can't be reused by a new version
+            # of the file, so an equal signature is the same file.
+            try:
+                with _file_lock(pypath):
+                    if exists:
+                        try:
+                            current = _stat_signature(pypath)
+                        except OSError:
+                            current = None
+                        if current != index.signature:
+                            raise _ConcurrentWrite()
+                    elif os.path.exists(pypath):
+                        raise _ConcurrentWrite()
+                    _commit_temp(tmppath, pypath)
+                    # the rename changes the ctime
+                    signature = _stat_signature(pypath)
+            except BaseException:
+                if os.path.exists(tmppath):
+                    os.unlink(tmppath)
+                raise
+        finally:
+            if f is not None:
+                f.close()
+
+        if debug:
+            if not exists:
+                print("Created new file: %s" % pypath)
+            print("Wrote cell to file: %s" % pypath)
+        if self.write_pyc:
+            import py_compile
+            try:
+                py_compile.compile(pypath, doraise=True)
+            except py_compile.PyCompileError as e:
+                # python won't use the outdated .pyc, so it's enough to
+                # mention it
                 if debug:
-                    print("Wrote cell to file: %s" % pypath)
+                    print("Could not write .pyc file: %s" % e.msg)
+
+        # update the index from the back, so that the offsets of the
+        # remaining splices stay valid
+        for start, end, replacement in reversed(splices):
+            index.splice(start, end, replacement)
+        for identifier, (marker, block) in new_blocks.items():
+            index.hashes[identifier] = _digest(block)
+        index.signature = signature
+        index.racy = _is_racy(signature)
+        self._watch_written(pypath, dict((identifier, index.hashes[identifier])
+                                         for identifier in new_blocks))
+        self._block_indexes[os.path.abspath(pypath)] = index
+        if self.index_sidecar and not index.racy:
+            # a racy signature becomes trusted once it is old enough, even
+            # if the file was changed again in the same tick
+            index.save(_sidecar_path(pypath))
+        timer.lap('write')
+        return changed + appended
+
+    def _buffer_block(self, path, identifier, content, debug=False):
+        pypath = os.path.splitext(path)[0] + '.py'
+        with self._lock:
+            blocks = self._pending.setdefault(os.path.abspath(pypath), OrderedDict())
+            blocks[identifier] = content
+            self._pending_debug = self._pending_debug or debug
+            if debug:
+                print("Buffered cell for file: %s" % pypath)
+            self._register_atexit()
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            if self.flush_timeout > 0:
+                self._flush_timer = threading.Timer(self.flush_timeout, self._flush_idle)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def _register_atexit(self):
+        with self._lock:
+            if not self._atexit_registered:
+                atexit.register(self._shutdown)
+                self._atexit_registered = True
+
+    def _flush(self, debug=False):
+        """Writes all buffered blocks and returns a list of ``(path, error)``
+        for the files which couldn't be written."""
+        errors = []
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            debug = debug or self._pending_debug
+            pending, self._pending = self._pending, OrderedDict()
+            self._pending_debug = False
+        for pypath, blocks in pending.items():
+            try:
+                self._write(pypath, blocks, debug=debug)
+            except Exception as e:
+                errors.append((pypath, e))
+        return errors
 
+    def _shutdown(self):
+        """Writes everything which is buffered or queued and reports errors."""
+        errors = self._flush()
+        self._write_queue.join()
+        errors.extend(self._close_store())
+        self._stop_watching()
+        self._report_write_errors(errors)
+        self._report_write_errors()
+        if self._pool is not None:
+            self._collect_results(wait=True)
+            self._pool.shutdown()
+            self._pool = None
+
+    def _flush_idle(self):
+        errors = self._flush()
+        with self._lock:
+            self._write_errors.extend(errors)
+
+    def _report_write_errors(self, errors=None):
+        if errors is None:
+            with self._lock:
+                errors, self._write_errors = self._write_errors, []
+        for pypath, e in errors:
+            print("Could not write to file '%s': %s" % (pypath, e), file=sys.stderr)
+
+    def _pre_run_cell(self, info=None):
+        self._run_watched_changes()
+
+    def _post_execute(self):
+        self._report_write_errors()
+        self._collect_results()
+
+
+def _register_magics(ip):
+    magics = WriteAndExecuteMagics(ip)
+    ip.register_magics(magics)
+    ip.events.register('pre_run_cell', magics._pre_run_cell)
+    ip.events.register('post_execute', magics._post_execute)
 
 
 def load_ipython_extension(ip):
-    ip.register_magics(WriteAndExecuteMagics)
+    _register_magics(ip)
     print ("'writeandexecute' magic loaded.")
+
+
+def unload_ipython_extension(ip):
+    magics = ip.magics_manager.registry.get('WriteAndExecuteMagics')
+    if magics is None:
+        return
+    for event, callback in [('pre_run_cell', magics._pre_run_cell),
+                            ('post_execute', magics._post_execute)]:
+        try:
+            ip.events.unregister(event, callback)
+        except ValueError:
+            pass
+    magics._shutdown()
+    # a reloaded module has new classes, which %config can't set on this one
+    if magics in ip.configurables:
+        ip.configurables.remove(magics)
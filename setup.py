@@ -33,5 +33,8 @@ setup(
     author_email='jupyter@googlegroups.org',
     url='https://github.com/ipython-contrib/IPython-extensions',
     packages = find_packages(exclude=['*test*']),
-    install_requires=['ipython']
+    install_requires=['ipython'],
+    entry_points={
+        'console_scripts': ['ipyext-export = ipyext.export:main'],
+    },
 )
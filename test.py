@@ -1,20 +1,38 @@
 # coding: utf-8
 
 """
-Small wrapper around IPythons testing runner
+Small wrapper around pytest
 
-It calls iptest with 'ipyext' as testgroup. You can pass
-arguments to nose by appending them after '--'
+Runs the tests of ipyext, on all cores if pytest-xdist is installed (pass
+'-n 0' to run them in one process). '--coverage' measures the coverage with
+pytest-cov, also of the code the magics run and of the worker processes.
+All other arguments are passed on to pytest.
 """
 from __future__ import print_function
 
-from IPython.testing.iptestcontroller import main
 import sys
 
-if '--coverage' in sys.argv:
-    print("Coverage will not see any data (because tests work via ipythons '.run_cell()'?)")
+try:
+    from importlib.util import find_spec   # Python 3.4+
+except ImportError:
+    from pkgutil import find_loader as find_spec
 
-# add our testgroup at the beginning of the arguments to iptest
-sys.argv[1:1] = ["ipyext"]
+import pytest
 
-main()
+
+def main(args):
+    if '--coverage' in args:
+        args.remove('--coverage')
+        args[0:0] = ['--cov=ipyext', '--cov-report=term-missing']
+
+    # don't import xdist here, pytest wants to import its plugins itself
+    if find_spec('xdist') is not None:
+        if not any(arg == '-n' or arg.startswith('--numprocesses') for arg in args):
+            args[0:0] = ['-n', 'auto']
+
+    return pytest.main(args)
+
+
+# the worker processes of %%writeandexecute -p import this module again
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))